@@ -0,0 +1,69 @@
+"""Biome raster aligned to a reference lat/lon grid.
+
+``shp_to_netcdf_aligned_to_reference`` rasterizes the ecoregion shapefile
+(see ``zone_raster``) onto the grid of a reference NetCDF file and writes
+``BIOME_ID`` (and, in ``'fraction'`` mode, ``BIOME_FRACTION``) with the
+ID -> name mapping as an attribute.
+"""
+
+import xarray as xr
+import numpy as np
+
+from zone_raster import rasterize_zones
+
+
+def shp_to_netcdf_aligned_to_reference(
+    shapefile, reference_nc, output_nc, eco_field="BIOME_NAME", start_id=1,
+    mode="last", supersample=8, workers=None, cache_dir="raster_cache"
+):
+    # Load reference NetCDF grid
+    ref_ds = xr.open_dataset(reference_nc)
+    lat = ref_ds["lat"].values
+    lon = ref_ds["lon"].values
+
+    # Rasterize in parallel tiles; repeated runs for the same shapefile,
+    # field, mode and grid are read from cache_dir.
+    #   mode="last":     cell-centre rule, later polygons win overlaps
+    #   mode="majority": zone covering most of each cell (supersample^2 sub-cells)
+    #   mode="fraction": majority IDs plus each zone's covered fraction per cell
+    zones = rasterize_zones(
+        shapefile, lat, lon, zone_field=eco_field, start_id=start_id, mode=mode,
+        supersample=supersample, workers=workers, cache_dir=cache_dir
+    )
+    raster = zones["labels"]
+    eco_mapping = zones["mapping"]
+
+    # Ensure longitude is sorted (in case reference grid wraps)
+    lon_sorted_idx = np.argsort(lon)
+    lon = lon[lon_sorted_idx]
+    raster = raster[:, lon_sorted_idx]
+
+    # Build xarray DataArray
+    da = xr.DataArray(
+        raster,
+        coords={"lat": lat, "lon": lon},
+        dims=("lat", "lon"),
+        name="BIOME_ID",
+        attrs={"long_name": "Ecoregion ID", "missing_value": -1}
+    )
+    da.coords["lon"].attrs["units"] = "degrees_east"
+    da.coords["lat"].attrs["units"] = "degrees_north"
+
+    # Create dataset and attach mapping
+    ds = da.to_dataset()
+    ds.attrs["eco_name_mapping"] = str(eco_mapping)
+    ds.attrs["rasterize_mode"] = mode
+
+    if "fraction" in zones:
+        ds["BIOME_FRACTION"] = xr.DataArray(
+            zones["fraction"][:, :, lon_sorted_idx],
+            coords={"biome": zones["zone_ids"], "lat": lat, "lon": lon},
+            dims=("biome", "lat", "lon"),
+            attrs={"long_name": "Fraction of each cell covered by each ecoregion",
+                   "units": "1", "supersample": supersample}
+        )
+
+    # Save output
+    ds.to_netcdf(output_nc)
+    print(f"Saved rasterized ecoregions aligned to {reference_nc} → {output_nc}")
+
@@ -0,0 +1,99 @@
+"""Global overview map of the biome raster (``biomes.overview.png``).
+
+matplotlib and cartopy are imported when a map is drawn, not on import.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+BIOMES = {1: 'Boreal Forests/Taiga',
+          2: 'Deserts & Xeric Shrublands',
+          3: 'Flooded Grasslands & Savannas',
+          4: 'Mangroves',
+          5: 'Mediterranean Forests, Woodlands & Scrub',
+          6: 'Montane Grasslands & Shrublands',
+          7: 'Rock and Ice',
+          8: 'Temperate Broadleaf & Mixed Forests',
+          9: 'Temperate Conifer Forests',
+          10: 'Temperate Grasslands, Savannas & Shrublands',
+          11: 'Tropical & Subtropical Coniferous Forests',
+          12: 'Tropical & Subtropical Dry Broadleaf Forests',
+          13: 'Tropical & Subtropical Grasslands, Savannas & Shrublands',
+          14: 'Tropical & Subtropical Moist Broadleaf Forests',
+          15: 'Tundra'}
+
+HEX_COLORS = [
+    '#2D5016',   # 1: Boreal Forests/Taiga - dark evergreen
+    '#E8A965',   # 2: Deserts & Xeric Shrublands - warm orange
+    '#6BCDCD',   # 3: Flooded Grasslands & Savannas - aqua blue
+    '#1B4D3E',   # 4: Mangroves - dark teal green
+    '#C17E5D',   # 5: Mediterranean Forests, Woodlands & Scrub - terracotta
+    '#9B6B9E',   # 6: Montane Grasslands & Shrublands - purple
+    '#E8F4F8',   # 7: Rock and Ice - icy blue-white
+    '#4A7C59',   # 8: Temperate Broadleaf & Mixed Forests - medium forest green
+    '#1F5E3D',   # 9: Temperate Conifer Forests - deep forest green
+    '#D4A837',   # 10: Temperate Grasslands, Savannas & Shrublands - golden yellow
+    '#3D6B3D',   # 11: Tropical & Subtropical Coniferous Forests - tropical evergreen
+    '#8FAF4D',   # 12: Tropical & Subtropical Dry Broadleaf Forests - lime green
+    '#E8954A',   # 13: Tropical & Subtropical Grasslands, Savannas & Shrublands - burnt orange
+    '#228B22',   # 14: Tropical & Subtropical Moist Broadleaf Forests - vibrant rainforest green
+    '#8B7FA8'    # 15: Tundra - lavender purple
+]
+
+
+def plot_biome_overview(biome_file, output='biomes.overview.png', font_path=None, dpi=300,
+                        show=False):
+    """Draw the biome raster on a Robinson map with a legend of biome names."""
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    import matplotlib.font_manager as font_manager
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap
+    from matplotlib.patches import Patch
+
+    if font_path and os.path.exists(font_path):
+        font_manager.fontManager.addfont(font_path)
+        prop = font_manager.FontProperties(fname=font_path)
+        plt.rcParams['font.family'] = 'sans-serif'
+        plt.rcParams['font.sans-serif'] = prop.get_name()
+
+    ds = xr.open_dataset(biome_file)['BIOME_ID']
+    X, Y = np.meshgrid(ds.lon, ds.lat)
+
+    plt.style.use('dark_background')
+    fig = plt.figure(figsize=(12, 7))
+    ax = fig.add_subplot(111, projection=ccrs.Robinson())
+    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.25)
+
+    cmap = ListedColormap(HEX_COLORS, name="biome_cmap")
+    cf = ax.contourf(X, Y, ds, levels=np.arange(1, 16), cmap=cmap,
+                     transform=ccrs.PlateCarree())
+
+    cbar_ax = fig.add_axes([0.3, 0.20, 0.4, 0.03])
+    plt.colorbar(cf, cax=cbar_ax, orientation='horizontal')
+
+    legend_handles = [Patch(facecolor=HEX_COLORS[index - 1]) for index in BIOMES]
+    ax.legend(bbox_to_anchor=(0.50, -0.3),
+              loc='lower center', borderaxespad=0.,
+              handles=legend_handles,
+              labels=list(BIOMES.values()),
+              ncols=4,
+              labelspacing=0.7,
+              columnspacing=0.7,
+              fontsize=8)
+
+    ax.set_title("Global Biomes", fontsize=14, loc='left')
+    ax.set_extent([-180, 180, -90, 90])
+    ax.add_feature(cfeature.COASTLINE.with_scale('50m'), linewidths=0.5)
+    ax.add_feature(cfeature.STATES.with_scale('50m'), linewidths=0.5)
+    ax.add_feature(cfeature.BORDERS.with_scale('50m'), linewidths=0.5)
+    plt.savefig(output, dpi=dpi)
+    if show:
+        plt.show()
+    plt.close(fig)
+    return output
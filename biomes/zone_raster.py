@@ -0,0 +1,249 @@
+"""Tiled, parallel and cached rasterization of polygon zones onto a lat/lon grid.
+
+The target grid is split into tiles. For each tile, an STRtree over the
+polygons selects only the ones whose bounds intersect it, those polygons
+are clipped to the tile, and only they are burned in. Tiles are rasterized
+on a process pool. Three ownership modes are available:
+
+``'last'``
+    Cell-centre rule with the last polygon winning overlaps, as a single
+    ``features.rasterize`` call over the whole grid would give.
+``'majority'``
+    Each cell is split into ``supersample**2`` sub-cells; the cell takes
+    the zone (or no zone) that covers the most of them.
+``'fraction'``
+    As ``'majority'``, and the covered fraction of every zone is kept,
+    giving each cell a zone-fraction vector.
+
+Results are cached on disk under a key made from the shapefile contents,
+the zone field and the grid definition, so a repeated run is a file read
+and a new grid only costs the rasterization itself.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CACHE_VERSION = 1
+MODES = ('last', 'majority', 'fraction')
+DEFAULT_TILE = 120
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj')
+
+# Per-worker polygons, set by _init_worker
+_geoms = None
+_ids = None
+_tree = None
+
+
+def shapefile_digest(shapefile):
+    """sha256 of the shapefile and its sidecar files' contents."""
+    base, _ = os.path.splitext(shapefile)
+    h = hashlib.sha256()
+    for ext in SHAPEFILE_PARTS:
+        path = base + ext
+        if not os.path.exists(path):
+            continue
+        h.update(ext.encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def grid_definition(lat, lon):
+    """Raster layout of a regular cell-centre grid.
+
+    Rows are ordered north to south and columns west to east in -180..180,
+    whatever the order of ``lat``/``lon``; ``row_order``/``col_order`` map
+    that layout back to the input order.
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    wrapped = (lon + 180) % 360 - 180
+    col_order = np.argsort(wrapped, kind='stable')
+    row_order = np.argsort(-lat, kind='stable')
+    return {
+        'lat': lat[row_order], 'lon': wrapped[col_order],
+        'dy': float(abs(lat[1] - lat[0])), 'dx': float(abs(lon[1] - lon[0])),
+        'row_order': row_order, 'col_order': col_order,
+    }
+
+
+def _tile_transform(grid, rows, cols, supersample):
+    from rasterio.transform import from_origin
+    west = grid['lon'][cols.start] - grid['dx'] / 2
+    north = grid['lat'][rows.start] + grid['dy'] / 2
+    return from_origin(west, north, grid['dx'] / supersample, grid['dy'] / supersample)
+
+
+def tiles(shape, tile=DEFAULT_TILE):
+    """(row slice, column slice) windows covering ``shape``."""
+    return [(slice(r, min(r + tile, shape[0])), slice(c, min(c + tile, shape[1])))
+            for r in range(0, shape[0], tile) for c in range(0, shape[1], tile)]
+
+
+# =============================================================================
+# Worker side
+# =============================================================================
+
+def _init_worker(wkb, ids):
+    global _geoms, _ids, _tree
+    import shapely
+    _geoms = shapely.from_wkb(wkb)
+    _ids = np.asarray(ids)
+    _tree = shapely.STRtree(_geoms)
+
+
+def rasterize_tile(grid, rows, cols, mode, supersample, n_zones, fill=-1):
+    """Zone labels of one tile, or per-zone sub-cell counts in ``'fraction'`` mode.
+
+    Slot 0 of the counts holds sub-cells outside every zone.
+    """
+    import shapely
+    from rasterio import features
+
+    s = 1 if mode == 'last' else supersample
+    height, width = rows.stop - rows.start, cols.stop - cols.start
+    west = grid['lon'][cols.start] - grid['dx'] / 2
+    east = grid['lon'][cols.stop - 1] + grid['dx'] / 2
+    north = grid['lat'][rows.start] + grid['dy'] / 2
+    south = grid['lat'][rows.stop - 1] - grid['dy'] / 2
+
+    # Candidates in input order, so later polygons still win overlaps
+    hits = np.sort(_tree.query(shapely.box(west, south, east, north)))
+    burned = np.full((height * s, width * s), fill, dtype=np.int32)
+    if len(hits):
+        clipped = shapely.clip_by_rect(_geoms[hits], west, south, east, north)
+        keep = ~shapely.is_empty(clipped)
+        shapes = list(zip(clipped[keep], _ids[hits][keep].tolist()))
+        if shapes:
+            features.rasterize(shapes, out=burned,
+                               transform=_tile_transform(grid, rows, cols, s), fill=fill)
+    if mode == 'last':
+        return burned
+
+    # Sub-cell counts per (zone, cell), uncovered sub-cells in slot 0
+    cell = (np.arange(height * s)[:, None] // s) * width + np.arange(width * s)[None, :] // s
+    zone = np.where(burned == fill, 0, burned - _ids.min() + 1)
+    counts = np.bincount((zone * height * width + cell).ravel(),
+                         minlength=(n_zones + 1) * height * width)
+    counts = counts.reshape(n_zones + 1, height, width).astype(np.uint16)
+    if mode == 'fraction':
+        return counts
+    best = counts.argmax(axis=0)
+    return np.where(best == 0, fill, best - 1 + _ids.min()).astype(np.int32)
+
+
+def _run_tile(args):
+    rows, cols = args[1], args[2]
+    return rows, cols, rasterize_tile(*args)
+
+
+# =============================================================================
+# Driver side
+# =============================================================================
+
+def load_zones(shapefile, zone_field, start_id=1):
+    """Valid polygons of ``shapefile`` with integer zone ids and a name mapping.
+
+    Ids follow the sorted category codes of ``zone_field`` plus
+    ``start_id``. Only invalid geometries are repaired with ``buffer(0)``.
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(shapefile)
+    gdf = gdf.dropna(subset=['geometry', zone_field])
+    gdf = gdf.to_crs('EPSG:4326')
+    gdf = gdf.copy()
+    gdf['ZONE_ID'] = gdf[zone_field].astype('category').cat.codes + start_id
+    invalid = ~gdf.geometry.is_valid
+    if invalid.any():
+        gdf.loc[invalid, 'geometry'] = gdf.geometry[invalid].buffer(0)
+
+    mapping_df = gdf[['ZONE_ID', zone_field]].drop_duplicates().sort_values('ZONE_ID')
+    mapping = {int(k): str(v) for k, v in zip(mapping_df['ZONE_ID'], mapping_df[zone_field])}
+    return gdf.geometry.to_numpy(), gdf['ZONE_ID'].to_numpy(np.int32), mapping
+
+
+def rasterize_zones(shapefile, lat, lon, zone_field='BIOME_NAME', start_id=1, mode='last',
+                    supersample=8, tile=DEFAULT_TILE, workers=None, cache_dir='raster_cache'):
+    """Zone raster of ``shapefile`` on the ``lat``/``lon`` cell-centre grid.
+
+    Parameters
+    ----------
+    mode : {'last', 'majority', 'fraction'}
+        Cell ownership rule (see module docstring).
+    supersample : int
+        Sub-cells per cell side for ``'majority'`` and ``'fraction'``.
+    cache_dir : str or None
+        Where results are cached; None disables the cache.
+
+    Returns
+    -------
+    dict
+        ``labels`` (int32, -1 outside every zone), ``mapping`` ({id: name})
+        and, for ``'fraction'``, ``fraction`` of shape (zone, lat, lon) with
+        ``zone_ids``. Arrays follow the order of ``lat`` and ``lon``.
+    """
+    import shapely
+
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}; choose from {MODES}")
+    grid = grid_definition(lat, lon)
+
+    cache_path = None
+    if cache_dir is not None:
+        key = json.dumps({
+            'version': CACHE_VERSION, 'shapefile': shapefile_digest(shapefile),
+            'field': zone_field, 'start_id': start_id, 'mode': mode,
+            'supersample': supersample if mode != 'last' else 1,
+            'lat': np.asarray(lat, dtype=np.float64).round(8).tolist(),
+            'lon': np.asarray(lon, dtype=np.float64).round(8).tolist(),
+        }, sort_keys=True)
+        cache_path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.npz')
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as npz:
+                result = {k: npz[k] for k in npz.files}
+            result['mapping'] = {int(k): v for k, v in json.loads(str(result['mapping'])).items()}
+            print(f"Zone raster loaded from cache: {cache_path}")
+            return result
+
+    geoms, ids, mapping = load_zones(shapefile, zone_field, start_id)
+    zone_ids = np.arange(ids.min(), ids.max() + 1, dtype=np.int32)
+    n_zones = len(zone_ids)
+    shape = (len(grid['lat']), len(grid['lon']))
+    windows = tiles(shape, tile)
+
+    labels = np.full(shape, -1, dtype=np.int32)
+    counts = np.zeros((n_zones + 1,) + shape, dtype=np.uint16) if mode == 'fraction' else None
+    tasks = [(grid, rows, cols, mode, supersample, n_zones) for rows, cols in windows]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                             initargs=(shapely.to_wkb(geoms), ids)) as pool:
+        for rows, cols, out in pool.map(_run_tile, tasks, chunksize=4):
+            if mode == 'fraction':
+                counts[:, rows, cols] = out
+            else:
+                labels[rows, cols] = out
+
+    result = {'zone_ids': zone_ids}
+    if mode == 'fraction':
+        best = counts.argmax(axis=0)
+        labels = np.where(best == 0, -1, zone_ids[np.maximum(best - 1, 0)]).astype(np.int32)
+        result['fraction'] = counts[1:].astype(np.float32) / supersample**2
+
+    # Back to the order of the input coordinates
+    inv_rows = np.argsort(grid['row_order'])
+    inv_cols = np.argsort(grid['col_order'])
+    result['labels'] = labels[inv_rows][:, inv_cols]
+    if 'fraction' in result:
+        result['fraction'] = result['fraction'][:, inv_rows][:, :, inv_cols]
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{cache_path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(tmp, mapping=json.dumps(mapping), **result)
+        os.replace(tmp, cache_path)
+    result['mapping'] = mapping
+    return result
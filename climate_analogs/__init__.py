@@ -0,0 +1,24 @@
+"""Command-line front end of the climate analog pipeline.
+
+    python -m climate_analogs metrics --files '/data/ERA5/wbgtmax_*_daily_ERA5.nc'
+    python -m climate_analogs rasterize-biomes --mode majority
+    python -m climate_analogs plot metrics --workers 8
+    python -m climate_analogs zonal-stats --area-weighted
+    python -m climate_analogs analogs query --lat 40.0 --lon -105.25 -k 10
+    python -m climate_analogs analogs atlas -k 10
+
+The pipeline modules in ``wbgt/`` and ``biomes/`` import each other by bare
+name, as when the scripts are run from their own directory; importing this
+package puts both directories on ``sys.path`` so they resolve the same way.
+Nothing else is imported until a subcommand runs.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIRS = (os.path.join(ROOT, 'wbgt'), os.path.join(ROOT, 'biomes'))
+
+for _path in SOURCE_DIRS:
+    if _path not in sys.path:
+        sys.path.append(_path)
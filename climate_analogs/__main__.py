@@ -0,0 +1,3 @@
+from climate_analogs.cli import main
+
+main()
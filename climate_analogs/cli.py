@@ -0,0 +1,199 @@
+"""``python -m climate_analogs <command>``.
+
+Only ``argparse`` and the config are imported at startup. Each handler
+imports its pipeline module when it runs, so xarray/dask, rasterio,
+geopandas, matplotlib and cartopy are loaded only by the commands that use
+them, and a query does not pay for the plotting stack.
+"""
+
+import argparse
+import sys
+
+from climate_analogs.config import load_config
+
+GB = 1024 ** 3
+
+
+def _metrics(args, config, extra):
+    from metric_registry import MONTHS, SEASONS
+    from metrics_pipeline import run_metrics
+
+    windows = {'seasons': SEASONS, 'months': MONTHS, 'none': None}[args.windows]
+    run_metrics(args.files or config['era5_files'], args.biomes or config['biome_file'],
+                args.start_year, args.end_year,
+                output_dir=args.output_dir or config['output_dir'],
+                cache_dir=None if args.no_cache else 'wbgt_year_cache',
+                quantile_method=args.quantile_method,
+                memory_budget=int(args.memory_budget * GB),
+                spell_min_days=args.spell_min_days or None, keep_years=not args.no_years,
+                windows=windows, store_path=None if args.store == 'none' else args.store,
+                store_compression=args.store_compression, geotiffs=not args.no_geotiffs,
+                multiband_path=args.multiband, zarr_path=args.zarr,
+                report_path=None if args.report == 'none' else args.report,
+                backend=args.backend, workers=args.workers,
+                worker_memory=int(args.worker_memory * GB) if args.worker_memory else None,
+                autotune=not args.no_autotune,
+                rechunk_dir=None if args.rechunk_dir == 'none' else args.rechunk_dir)
+
+
+def _rasterize_biomes(args, config, extra):
+    from biome_grid import shp_to_netcdf_aligned_to_reference
+
+    shp_to_netcdf_aligned_to_reference(
+        shapefile=args.shapefile or config['shapefile'],
+        reference_nc=args.reference or config['reference_grid'],
+        output_nc=args.output, eco_field=args.field, mode=args.mode,
+        supersample=args.supersample, workers=args.workers,
+        cache_dir=None if args.no_cache else 'raster_cache')
+
+
+def _plot(args, config, extra):
+    font = config['font'] if args.font is None else (args.font or None)
+    if args.what == 'overview':
+        from biome_overview import plot_biome_overview
+        plot_biome_overview(args.biomes or config['biome_file'], args.output, font_path=font)
+        print(f"Saved {args.output}")
+        return
+    from biome_figures import render_metric_figures
+    render_metric_figures(args.metrics or config['metrics'], args.biomes or config['biome_file'],
+                          outdir=args.outdir, variables=args.variables,
+                          regrid_method=args.regrid_method, workers=args.workers,
+                          force=args.force, font_path=font, biomes=args.biome_ids)
+
+
+def _forward(module, command=None, options=()):
+    """Handler running ``module.main`` with config paths ahead of the user's options."""
+
+    def run(args, config, extra):
+        import importlib
+        name = None if command is None else command(args)
+        argv = [] if name is None else [name]
+        for option, key in options:
+            argv += [option, config[key]]
+        importlib.import_module(module(args) if callable(module) else module).main(argv + extra)
+
+    return run
+
+
+def _analogs_module(args):
+    if args.action == 'atlas':
+        return 'analog_atlas'
+    return 'analog_matcher' if args.action in ('build-ivf', 'match') else 'analog_index'
+
+
+def _analogs_command(args):
+    # The atlas script has no subcommand
+    return {'build-ivf': 'build', 'atlas': None}.get(args.action, args.action)
+
+
+def _analogs(args, config, extra):
+    options = [('--index', 'index')]
+    if args.action in ('build', 'query'):
+        options += [('--metrics', 'metrics'), ('--biomes', 'biome_file')]
+    _forward(_analogs_module, _analogs_command, options)(args, config, extra)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m climate_analogs',
+                                     description='Climate analogs of WBGT heat metrics.')
+    parser.add_argument('--config', help='JSON file of paths and settings '
+                                         '(default: $CLIMATE_ANALOGS_CONFIG)')
+    sub = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+    p = sub.add_parser('metrics', help='compute the WBGT metrics from the daily ERA5 stack')
+    p.add_argument('--files', help='glob of the yearly wbgtmax files')
+    p.add_argument('--biomes', help='biome raster (land mask)')
+    p.add_argument('--start-year', type=int, default=1950)
+    p.add_argument('--end-year', type=int, default=2020)
+    p.add_argument('--output-dir')
+    p.add_argument('--quantile-method', choices=['exact', 'histogram', 'tdigest'],
+                   default='exact', help='p95 estimator: exact (two passes), histogram '
+                                         '(one pass, within about 0.1 degC) or tdigest')
+    p.add_argument('--memory-budget', type=float, default=16, help='GiB')
+    p.add_argument('--spell-min-days', type=int, default=3, help='0 skips the spell metrics')
+    p.add_argument('--windows', choices=['seasons', 'months', 'none'], default='seasons')
+    p.add_argument('--no-years', action='store_true',
+                   help='skip the per-year cube, trends and decadal means')
+    p.add_argument('--store', default='wbgt_metrics.store', help="metric store, or 'none'")
+    p.add_argument('--store-compression', choices=['zlib'], default=None)
+    p.add_argument('--no-geotiffs', action='store_true')
+    p.add_argument('--multiband', help='also write every metric as a band of this COG')
+    p.add_argument('--zarr', help='also write the exported metrics to this Zarr store')
+    p.add_argument('--report', default='wbgt_run_report.json',
+                   help="JSON report of per-stage time, memory and I/O, or 'none'")
+    p.add_argument('--no-cache', action='store_true')
+    p.add_argument('--backend', choices=['synchronous', 'threads', 'processes', 'distributed'],
+                   default='threads', help='where the metric tiles run')
+    p.add_argument('--workers', type=int, help='concurrent tiles (default: one per CPU)')
+    p.add_argument('--worker-memory', type=float, help='GiB per worker')
+    p.add_argument('--no-autotune', action='store_true',
+                   help='one dask chunk per yearly file instead of tuned chunks')
+    p.add_argument('--rechunk-dir', default='wbgt_rechunked',
+                   help="where a rechunked copy of the stack may be written, or 'none'")
+    p.set_defaults(handler=_metrics)
+
+    p = sub.add_parser('rasterize-biomes', help='rasterize the ecoregion shapefile')
+    p.add_argument('--shapefile')
+    p.add_argument('--reference', help='NetCDF file whose lat/lon grid is used')
+    p.add_argument('--output', default='biomes.analog.gridded.nc')
+    p.add_argument('--field', default='BIOME_NAME')
+    p.add_argument('--mode', choices=['last', 'majority', 'fraction'], default='last')
+    p.add_argument('--supersample', type=int, default=8)
+    p.add_argument('--workers', type=int)
+    p.add_argument('--no-cache', action='store_true')
+    p.set_defaults(handler=_rasterize_biomes)
+
+    p = sub.add_parser('plot', help='draw the biome overview or the per-biome metric maps')
+    p.add_argument('what', choices=['overview', 'metrics'])
+    p.add_argument('--metrics', help='metrics NetCDF file or metric store')
+    p.add_argument('--biomes', help='biome raster')
+    p.add_argument('--output', default='biomes.overview.png', help='overview file')
+    p.add_argument('--outdir', default='figures', help='metric map directory')
+    p.add_argument('--variables', nargs='+')
+    p.add_argument('--biome-ids', type=int, nargs='+')
+    p.add_argument('--regrid-method', choices=['conservative', 'bilinear'],
+                   default='conservative')
+    p.add_argument('--font', help="font file ('' for the matplotlib default)")
+    p.add_argument('--workers', type=int)
+    p.add_argument('--force', action='store_true', help='redraw up-to-date figures')
+    p.set_defaults(handler=_plot)
+
+    p = sub.add_parser('zonal-stats', add_help=False,
+                       help='per-biome/ecoregion summary table (options of zonal_stats.py)')
+    p.set_defaults(handler=_forward('zonal_stats', options=[('--metrics', 'metrics'),
+                                                             ('--biomes', 'biome_file')]))
+
+    p = sub.add_parser('analogs', help='build or query the analog index, write the atlas of '
+                                       'every cell\'s analogs, or match other periods/models '
+                                       '(options of analog_index.py, analog_atlas.py and '
+                                       'analog_matcher.py)')
+    p.add_argument('action', choices=['build', 'query', 'atlas', 'build-ivf', 'match'])
+    p.set_defaults(handler=_analogs)
+
+    p = sub.add_parser('benchmark', add_help=False,
+                       help='time each pipeline stage on synthetic data (options of '
+                            'benchmark.py)')
+    p.set_defaults(handler=_forward('benchmark'))
+
+    p = sub.add_parser('serve', add_help=False,
+                       help='local HTTP query service (options of analog_service.py)')
+    p.set_defaults(handler=_forward('analog_service', options=[
+        ('--metrics', 'metrics'), ('--biomes', 'biome_file'), ('--index', 'index')]))
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    forwarded = args.handler not in (_metrics, _rasterize_biomes, _plot)
+    if extra and not forwarded:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    args.handler(args, config, extra)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,41 @@
+"""Paths and settings shared by the subcommands.
+
+Defaults are the NCAR locations the scripts were written for. A JSON file
+given with ``--config`` (or named by ``$CLIMATE_ANALOGS_CONFIG``) overrides
+any of them; command-line options override both.
+
+    {"era5_files": "/data/ERA5/wbgtmax_*_daily_ERA5.nc",
+     "biome_file": "/data/biomes.analog.gridded.nc", "font": null}
+"""
+
+import json
+import os
+
+CONFIG_ENV = 'CLIMATE_ANALOGS_CONFIG'
+
+DEFAULTS = {
+    'era5_files': '/glade/campaign/ral/risc/jsallen/TNC/ERA5_heat/wbgtmax_*_daily_ERA5.nc',
+    'biome_file': '/glade/u/home/jsallen/projects/tnc_2025/analogs/biomes/'
+                  'biomes.analog.gridded.nc',
+    'shapefile': 'Ecoregions2017.shp',
+    'reference_grid': '/glade/campaign/ral/risc/jsallen/CPC/regrid_025/precip.1979.nc',
+    'font': '/glade/work/jsallen/conda-envs/earth/fonts/Avenir-Medium.otf',
+    'metrics': 'wbgt_annual_metrics.nc',
+    'index': 'wbgt_analog_index.npz',
+    'output_dir': '.',
+}
+
+
+def load_config(path=None):
+    """Defaults updated from ``path`` (or ``$CLIMATE_ANALOGS_CONFIG``), if any."""
+    config = dict(DEFAULTS)
+    path = path or os.environ.get(CONFIG_ENV)
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        unknown = set(overrides) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"{path}: unknown settings {sorted(unknown)}; "
+                             f"known: {sorted(DEFAULTS)}")
+        config.update(overrides)
+    return config
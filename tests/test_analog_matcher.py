@@ -0,0 +1,81 @@
+"""Approximate (IVF) analog search against exact k-d tree search."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from analog_index import AnalogIndex  # noqa: E402
+from analog_matcher import IVFIndex, recall  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def index():
+    # Clustered features, like neighbouring cells of a metric grid
+    rng = np.random.default_rng(0)
+    n, nvar = 3000, 5
+    centres = rng.normal(scale=3.0, size=(30, nvar))
+    features = centres[rng.integers(len(centres), size=n)] + rng.normal(size=(n, nvar))
+    biome = rng.choice([1, 4, 7], size=n, p=[0.5, 0.3, 0.2])
+    ones = np.ones(nvar)
+    return AnalogIndex(features, np.arange(n), biome, np.arange(n), np.arange(1),
+                       [f'v{i}' for i in range(nvar)], 0 * ones, ones, ones, features)
+
+
+@pytest.fixture(scope='module')
+def ivf(index):
+    return IVFIndex.build(index.features, index.biome, cells_per_list=100)
+
+
+def test_lists_are_biome_pure(ivf, index):
+    assert ivf.n_lists > 3
+    assert ivf.offsets[-1] == len(index.features)
+    assert np.array_equal(np.sort(ivf.rows), np.arange(len(index.features)))
+    for i in range(ivf.n_lists):
+        rows = ivf.rows[ivf.offsets[i]:ivf.offsets[i + 1]]
+        assert (index.biome[rows] == ivf.list_biome[i]).all()
+
+
+def test_probing_every_list_is_exact(ivf, index):
+    stats = recall(ivf, index, index.features, index.biome, k=10, nprobe=ivf.n_lists,
+                   sample=300)
+    assert stats == {'recall': 1.0, 'novelty_exact': 1.0, 'queries': 300}
+
+    rows, dist, novelty = ivf.search(index.features[:20], index.biome[:20], k=5,
+                                     nprobe=ivf.n_lists)
+    np.testing.assert_allclose(novelty, 0, atol=1e-6)
+    assert (rows[:, 0] == np.arange(20)).all()
+    assert (np.diff(dist, axis=1) >= 0).all()
+    assert (index.biome[rows] == index.biome[:20, None]).all()
+
+
+def test_default_nprobe_recall(ivf, index):
+    queries = index.features + np.random.default_rng(1).normal(scale=0.3,
+                                                               size=index.features.shape)
+    stats = recall(ivf, index, queries, index.biome, k=10, nprobe=8, sample=500)
+    assert stats['queries'] == 500
+    assert stats['recall'] >= 0.99
+    assert stats['novelty_exact'] >= 0.99
+    assert recall(ivf, index, queries, index.biome, k=10, nprobe=1,
+                  sample=500)['recall'] <= stats['recall']
+
+
+def test_short_biomes_are_padded(ivf, index):
+    small = np.flatnonzero(index.biome == 7)[:3]
+    sub = IVFIndex.build(index.features[small], index.biome[small])
+    rows, dist, _ = sub.search(index.features[small[:1]], 7, k=5)
+    assert (rows[0, 3:] == -1).all() and np.isinf(dist[0, 3:]).all()
+    assert set(rows[0, :3]) == {0, 1, 2}
+    assert ivf.search(index.features[:1], 99, k=3)[0].tolist() == [[-1, -1, -1]]
+
+
+def test_save_load(ivf, index, tmp_path):
+    path = str(tmp_path / 'ivf.npz')
+    ivf.save(path)
+    loaded = IVFIndex.load(path)
+    q = index.features[::97]
+    for a, b in zip(ivf.search(q, index.biome[::97]), loaded.search(q, index.biome[::97])):
+        np.testing.assert_array_equal(a, b)
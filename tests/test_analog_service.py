@@ -0,0 +1,90 @@
+"""Status codes of the query service, answered without opening a socket."""
+
+import asyncio
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from analog_index import AnalogIndex  # noqa: E402
+from analog_service import AnalogService, Server  # noqa: E402
+from metric_store import open_metrics  # noqa: E402
+from metrics_pipeline import run_metrics  # noqa: E402
+from synthetic_era5 import ensure_synthetic  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    root = tmp_path_factory.mktemp('service')
+    data = ensure_synthetic(str(root / 'data'), resolution=4.0, years=2)
+    ds = run_metrics(data['files'], data['biome_file'], data['start_year'], data['end_year'],
+                     output_dir=str(root / 'run'), cache_dir=None, keep_years=False,
+                     store_path=None, geotiffs=False, report_path=None,
+                     backend='synchronous')
+    biomes = xr.open_dataset(data['biome_file'])
+    index = AnalogIndex.build(ds, biomes)
+    metrics = open_metrics(str(root / 'run' / 'wbgt_annual_metrics.nc'), decode_timedelta=False)
+    return AnalogService(metrics, biomes, index), index
+
+
+def _get(server, target):
+    status, ctype, body = asyncio.run(server.respond(target))
+    return status, (body if ctype == 'image/png' else json.loads(body))
+
+
+def _land_point(index):
+    cell = index.cells[len(index.cells) // 2]
+    return float(index.lat[cell // len(index.lon)]), float(index.lon[cell % len(index.lon)])
+
+
+def test_ok(service):
+    svc, index = service
+    server = Server(svc, workers=2)
+    lat, lon = _land_point(index)
+    status, body = _get(server, f'/point?lat={lat}&lon={lon}')
+    assert status == 200 and body['biome'] is not None
+    status, body = _get(server, f'/analogs?lat={lat}&lon={lon}&k=3')
+    assert status == 200 and len(body['analogs']) == 3
+    status, body = _get(server, '/tiles/days_above_31C/1/0/0.png?vmin=0&vmax=100')
+    assert status == 200 and body[:4] == b'\x89PNG'
+
+
+@pytest.mark.parametrize('target', ['/nothing', '/tiles/no_such_metric/1/0/0.png'])
+def test_not_found(service, target):
+    status, _ = _get(Server(service[0], workers=1), target)
+    assert status == 404
+
+
+@pytest.mark.parametrize('target', ['/point?lat=nan&lon=0', '/point?lat=1&lon=inf',
+                                    '/point?lat=abc&lon=0', '/analogs?lon=0',
+                                    '/tiles/days_above_31C/2/1/1.png?vmin=nan',
+                                    '/tiles/days_above_31C/2/1/1.png?vmax=-inf',
+                                    '/tiles/days_above_31C/1/5/0.png'])
+def test_bad_request(service, target):
+    status, body = _get(Server(service[0], workers=1), target)
+    assert status == 400, body
+
+
+def test_bug_is_500(service, monkeypatch):
+    svc, index = service
+    server = Server(svc, workers=1)
+
+    def broken(lat, lon):
+        return np.arange(3)[10]
+
+    monkeypatch.setattr(svc, 'point', broken)
+    status, body = _get(server, '/point?lat=0&lon=0')
+    assert status == 500 and body['error'].startswith('IndexError')
+
+
+def test_without_index(service):
+    svc, _ = service
+    bare = AnalogService.__new__(AnalogService)
+    bare.__dict__.update(svc.__dict__, index=None)
+    status, body = _get(Server(bare, workers=1), '/analogs?lat=0&lon=0')
+    assert status == 404 and 'index' in body['error']
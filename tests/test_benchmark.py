@@ -0,0 +1,25 @@
+"""The benchmark entry point on the smallest synthetic stack."""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+import benchmark  # noqa: E402
+
+
+def test_stages_run_from_a_relative_workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    benchmark.main(['--size', 'tiny', '--workdir', 'bench', '--backend', 'synchronous',
+                    '--stages', 'index', 'metrics', 'percentiles', 'zonal_stats',
+                    '--quantile-methods', 'histogram', '--label', 'smoke'])
+
+    with open(os.path.join('bench', 'history.json')) as f:
+        history = json.load(f)
+    stages = history[-1]['stages']
+    assert history[-1]['label'] == 'smoke'
+    for name in ('index', 'metrics', 'percentiles[histogram]', 'zonal_stats'):
+        assert stages[name]['status'] == 'ok', (name, stages[name])
+    assert os.path.exists(os.path.join('bench', 'run', 'wbgt_annual_metrics.nc'))
+    assert not os.path.exists(os.path.join('bench', 'run', 'bench'))
@@ -0,0 +1,59 @@
+"""``python -m climate_analogs`` subcommands forwarded to the pipeline scripts."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from climate_analogs.cli import main  # noqa: E402
+from metrics_pipeline import run_metrics  # noqa: E402
+from synthetic_era5 import ensure_synthetic  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def outputs(tmp_path_factory):
+    root = tmp_path_factory.mktemp('cli')
+    data = ensure_synthetic(str(root / 'data'), resolution=4.0, years=2)
+    run_metrics(data['files'], data['biome_file'], data['start_year'], data['end_year'],
+                output_dir=str(root / 'run'), cache_dir=None, keep_years=False,
+                store_path=None, geotiffs=False, report_path=None, backend='synchronous')
+    return root, data['biome_file']
+
+
+def test_analogs_build_query_and_atlas(outputs, capsys):
+    root, biome_file = outputs
+    index = str(root / 'index.npz')
+    main(['analogs', 'build', '--metrics', str(root / 'run' / 'wbgt_annual_metrics.nc'),
+          '--biomes', biome_file, '--index', index])
+    assert os.path.exists(index)
+
+    from analog_index import AnalogIndex
+    loaded = AnalogIndex.load(index)
+    cell = loaded.cells[len(loaded.cells) // 2]
+    lat, lon = loaded.lat[cell // len(loaded.lon)], loaded.lon[cell % len(loaded.lon)]
+    capsys.readouterr()
+    main(['analogs', 'query', '--index', index, '--lat', str(lat), '--lon', str(lon), '-k', '3'])
+    lines = capsys.readouterr().out.strip().splitlines()
+    assert lines[0].split()[:4] == ['lat', 'lon', 'biome', 'distance']
+    assert len(lines) == 4
+
+    atlas = str(root / 'atlas.nc')
+    main(['analogs', 'atlas', '--index', index, '-k', '3', '--workers', '1',
+          '--output', atlas])
+    ds = xr.open_dataset(atlas)
+    assert ds['analog_cell'].shape[-1] == 3
+    assert int((ds['analog_cell'].values >= 0).sum()) == 3 * len(loaded.cells)
+    assert np.isfinite(ds['analog_distance'].values[ds['analog_cell'].values >= 0]).all()
+
+
+@pytest.mark.parametrize('command', [['serve'], ['zonal-stats'], ['benchmark'],
+                                     ['analogs', 'atlas'], ['analogs', 'match']])
+def test_forwarded_scripts_take_argv(command, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        main(command + ['--help'])
+    assert exit_info.value.code == 0
+    assert capsys.readouterr().out.startswith('usage:')
@@ -0,0 +1,50 @@
+"""Tasks run by ``ExecutionBackend`` and the dask config they leave behind."""
+
+import os
+import sys
+
+import dask
+import dask.array as dsa
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from execution import ExecutionBackend  # noqa: E402
+from run_report import RunReport  # noqa: E402
+
+
+def _scheduled_sum(n):
+    """``n`` and the dask scheduler active while summing a small array."""
+    total = int(dsa.ones(n, chunks=max(1, n // 4)).sum().compute())
+    return total, dask.config.get('scheduler', None)
+
+
+@pytest.mark.parametrize('kind', ['synchronous', 'threads', 'processes'])
+def test_map_runs_in_order_on_synchronous_dask(kind):
+    with ExecutionBackend(kind, workers=4) as backend:
+        results = backend.map(_scheduled_sum, [(n,) for n in range(1, 17)])
+    assert [total for total, _ in results] == list(range(1, 17))
+    assert {scheduler for _, scheduler in results} == {'synchronous'}
+
+
+@pytest.mark.parametrize('kind', ['synchronous', 'threads'])
+def test_map_restores_dask_scheduler(kind):
+    before = dask.config.get('scheduler', None)
+    for _ in range(5):
+        with ExecutionBackend(kind, workers=4) as backend:
+            backend.map(_scheduled_sum, [(n,) for n in range(1, 33)])
+        assert dask.config.get('scheduler', None) == before
+
+
+def test_map_reports_tasks(tmp_path):
+    report = RunReport('test', verbose=False)
+    with report.stage('compute') as stage:
+        with ExecutionBackend('threads', workers=2) as backend:
+            backend.map(_scheduled_sum, [(n,) for n in range(1, 5)])
+    assert stage.info['execution']['tasks'] == 4
+    assert stage.info['execution']['backend'] == 'threads'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError, match='Unknown backend'):
+        ExecutionBackend('gpu')
@@ -0,0 +1,53 @@
+"""Bootstrap intervals from the per-year cubes written by ``run_metrics``."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from metric_bootstrap import bootstrap_dataset, open_yearly  # noqa: E402
+from land_vector import LandVector  # noqa: E402
+from metrics_pipeline import run_metrics  # noqa: E402
+from synthetic_era5 import ensure_synthetic  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def yearly_file(tmp_path_factory):
+    root = tmp_path_factory.mktemp('bootstrap')
+    data = ensure_synthetic(str(root / 'data'), resolution=4.0, years=3)
+    run_metrics(data['files'], data['biome_file'], data['start_year'], data['end_year'],
+                output_dir=str(root / 'run'), cache_dir=None, spell_min_days=3,
+                keep_years=True, windows=None, store_path=None, geotiffs=False,
+                report_path=None, backend='synchronous')
+    return str(root / 'run' / 'wbgt_yearly_metrics.nc'), data['biome_file']
+
+
+def test_day_counts_read_as_numbers(yearly_file):
+    path, _ = yearly_file
+    cubes = open_yearly(path)
+    assert cubes['days_above_31C'].dtype.kind == 'f'
+    assert float(cubes['days_above_31C'].min()) >= 0
+
+
+def test_intervals_are_nan_off_land(yearly_file):
+    path, biome_file = yearly_file
+    cubes = open_yearly(path)
+    ds = bootstrap_dataset(cubes, replicates=50)
+    land = LandVector.from_biomes(xr.open_dataset(biome_file), cubes['latitude'],
+                                  cubes['longitude']).mask
+    for name in ('days_above_31C', 'longest_spell_31C', 'wbgtmax_annual_mean'):
+        ci = ds[f'{name}_ci'].values
+        assert np.isnan(ci[:, ~land]).all(), name
+        assert np.isfinite(ci[:, land]).all(), name
+        assert np.nanmin(ci) >= (0 if name != 'wbgtmax_annual_mean' else -50), name
+
+
+def test_decoded_timedeltas_are_rejected(yearly_file):
+    path, _ = yearly_file
+    with xr.open_dataset(path) as decoded:
+        with pytest.raises(ValueError, match='open_yearly'):
+            bootstrap_dataset({'days_above_31C': decoded['days_above_31C']}, replicates=10)
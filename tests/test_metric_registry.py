@@ -0,0 +1,133 @@
+"""``compute_metrics`` against per-year references computed with numpy."""
+
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from execution import ExecutionBackend  # noqa: E402
+from metric_registry import SEASONS, compute_metrics  # noqa: E402
+from run_report import RunReport  # noqa: E402
+from wbgt_metrics import annual_metrics, compute_annual_metrics  # noqa: E402
+from year_cache import YearCache  # noqa: E402
+
+THRESHOLD = 29
+MIN_DAYS = 3
+
+
+@pytest.fixture(scope='module')
+def stack():
+    time = pd.date_range('2003-01-01', '2005-12-31')
+    rng = np.random.default_rng(1)
+    # Slow swings around the threshold give runs of every length, some across New Year
+    phase = rng.uniform(0, 2 * np.pi, size=(1, 3, 4))
+    days = np.arange(len(time))[:, None, None]
+    values = 28 + 3 * np.sin(days / 4.0 + phase) + rng.normal(0, 1, size=(len(time), 3, 4))
+    values[rng.random(values.shape) < 0.02] = np.nan
+    values[:, 0, 0] = np.nan            # a cell without data
+    values[:40, 1, 1] = 35              # a run from the first day
+    values[-30:, 2, 3] = 35             # a run up to the last day
+    return xr.DataArray(values.astype(np.float32), dims=('time', 'lat', 'lon'),
+                        coords={'time': time}, name='wbgtmax')
+
+
+def _runs(hot):
+    """``(start, stop)`` of every run of True in a 1-D mask."""
+    padded = np.r_[False, hot, False]
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[0::2], edges[1::2]))
+
+
+def _reference(da):
+    """Per-year mean, days above, and spell statistics of every cell, by numpy."""
+    values = da.values.reshape(da.sizes['time'], -1)
+    years = da['time'].dt.year.values
+    all_years = np.unique(years)
+    out = {k: np.full((len(all_years), values.shape[1]), np.nan) for k in
+           ('mean', 'above', 'longest', 'spells', 'length')}
+    for c in range(values.shape[1]):
+        x = values[:, c]
+        runs = _runs(x >= THRESHOLD)
+        for y, year in enumerate(all_years):
+            in_year = years == year
+            if np.isnan(x[in_year]).all():
+                continue
+            out['mean'][y, c] = np.nanmean(x[in_year])
+            out['above'][y, c] = np.sum(x[in_year] >= THRESHOLD)
+            # A run counts in the year of its last day
+            lengths = [b - a for a, b in runs if years[b - 1] == year]
+            spells = [n for n in lengths if n >= MIN_DAYS]
+            out['longest'][y, c] = max(lengths, default=0)
+            out['spells'][y, c] = len(spells)
+            out['length'][y, c] = np.mean(spells) if spells else np.nan
+    return out
+
+
+def test_returns_fields_and_yearly(stack):
+    fields, yearly = compute_metrics(stack, ['wbgtmax_annual_mean'])
+    assert yearly is None and set(fields) == {'wbgtmax_annual_mean'}
+    fields, yearly = compute_annual_metrics(stack, keep_years=True)
+    assert yearly['days_above_31C'].dims == ('year', 'lat', 'lon')
+    assert yearly['days_above_31C'].dtype == np.uint16
+
+
+@pytest.mark.parametrize('backend', ['synchronous', 'threads'])
+def test_annual_metrics_match_numpy(stack, backend):
+    with ExecutionBackend(backend, workers=3) as executor:
+        fields, yearly = compute_annual_metrics(
+            stack, spell_min_days=MIN_DAYS, keep_years=True, backend=executor,
+            memory_budget=64 * 1024)
+    ref = _reference(stack)
+
+    # Cell 0 has no data (counts come back 0, not NaN); compare the others
+    def field(name):
+        return fields[name].values.reshape(-1)[1:]
+
+    with warnings.catch_warnings():
+        # Mean of empty slice: the cell without data
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = {k: np.nanmean(v[:, 1:], axis=0) for k, v in ref.items()}
+    np.testing.assert_allclose(field('wbgtmax_annual_mean'), expected['mean'], rtol=1e-5)
+    np.testing.assert_allclose(field(f'days_above_{THRESHOLD}C'), expected['above'])
+    np.testing.assert_allclose(field(f'longest_spell_{THRESHOLD}C'), expected['longest'])
+    np.testing.assert_allclose(field(f'spells_{THRESHOLD}C'), expected['spells'])
+    np.testing.assert_allclose(field(f'mean_spell_length_{THRESHOLD}C'), expected['length'],
+                               rtol=1e-5)
+    p95 = np.nanquantile(stack.values.reshape(len(stack), -1)[:, 1:], 0.95, axis=0)
+    np.testing.assert_allclose(field('wbgtmax_p95'), p95, rtol=1e-6)
+
+    cube = yearly[f'longest_spell_{THRESHOLD}C'].values.reshape(3, -1)
+    assert np.array_equal(cube[:, 1:], ref['longest'][:, 1:])
+
+
+def test_seasons_match_numpy(stack):
+    fields, _ = compute_annual_metrics(stack, windows=SEASONS)
+    months = stack['time'].dt.month.values
+    years = stack['time'].dt.year.values
+    for s, (season, season_months) in enumerate(SEASONS.items()):
+        in_season = np.isin(months, season_months)
+        counts = np.stack([np.sum(stack.values[in_season & (years == y)] >= THRESHOLD, axis=0)
+                           for y in np.unique(years)])
+        expected = counts.mean(axis=0)
+        actual = fields[f'days_above_{THRESHOLD}C_by_season'].sel(season=season).values
+        np.testing.assert_allclose(actual[1:, :], expected[1:, :], err_msg=season)
+
+
+def test_cached_years_are_not_read_again(stack, tmp_path):
+    metrics = annual_metrics(spell_min_days=MIN_DAYS)
+    report = RunReport('test', verbose=False)
+    with report.stage('first') as first:
+        cold, _ = compute_metrics(stack, metrics, cache=YearCache(str(tmp_path)))
+    with report.stage('second') as second:
+        warm, _ = compute_metrics(stack, metrics, cache=YearCache(str(tmp_path)))
+    assert first.counters['pass1_years_read'] == 3
+    assert second.counters.get('pass1_years_read', 0) == 0
+    assert second.counters['pass1_years'] == 3
+    for name in cold:
+        np.testing.assert_array_equal(cold[name].values, warm[name].values, err_msg=name)
@@ -0,0 +1,58 @@
+"""Metric stores written by ``run_metrics`` and read back with ``open_metrics``."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from metric_store import MetricStore, open_metrics  # noqa: E402
+from metrics_pipeline import run_metrics, yearly_store_path  # noqa: E402
+from synthetic_era5 import ensure_synthetic  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def run_dir(tmp_path_factory):
+    root = tmp_path_factory.mktemp('store')
+    data = ensure_synthetic(str(root / 'data'), resolution=4.0, years=2)
+    run_metrics(data['files'], data['biome_file'], data['start_year'], data['end_year'],
+                output_dir=str(root / 'run'), cache_dir=None, spell_min_days=3,
+                keep_years=True, windows=None, store_path='annual.store', geotiffs=False,
+                report_path=None, backend='synchronous')
+    return root / 'run'
+
+
+def test_yearly_store_path():
+    assert yearly_store_path('wbgt_metrics.store') == 'wbgt_metrics_yearly.store'
+    assert yearly_store_path('annual.store/') == 'annual_yearly.store'
+    assert yearly_store_path('metrics/out.store') == os.path.join('metrics', 'out_yearly.store')
+
+
+def test_annual_and_yearly_stores_both_kept(run_dir):
+    annual = open_metrics(str(run_dir / 'annual.store'))
+    yearly = open_metrics(str(run_dir / 'annual_yearly.store'))
+    assert annual['days_above_31C'].dims == ('latitude', 'longitude')
+    assert yearly['days_above_31C'].dims == ('year', 'latitude', 'longitude')
+    assert yearly.sizes['year'] == 2
+
+
+def test_store_round_trip(run_dir):
+    ds = xr.open_dataset(run_dir / 'wbgt_annual_metrics.nc')
+    store = open_metrics(str(run_dir / 'annual.store'))
+    for name in ('wbgtmax_annual_mean', 'days_above_31C', 'longest_spell_31C'):
+        expected, actual = ds[name].values, store[name].values
+        assert np.array_equal(np.isnan(expected), np.isnan(actual)), name
+        # Packed at 0.01 resolution
+        np.testing.assert_allclose(actual, expected, atol=0.006, equal_nan=True, err_msg=name)
+
+
+def test_point_matches_grid(run_dir):
+    store = MetricStore(str(run_dir / 'annual.store'))
+    ds = store.to_dataset()
+    field = ds['wbgtmax_annual_mean']
+    i, j = np.argwhere(np.isfinite(field.values))[0]
+    lat, lon = float(field['latitude'][i]), float(field['longitude'][j])
+    assert store.point(lat, lon)['wbgtmax_annual_mean'] == pytest.approx(float(field[i, j]))
@@ -0,0 +1,81 @@
+"""Regridding weights between regular lat/lon grids."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from regrid import Regridder  # noqa: E402
+
+
+def _grid(step, lon0=0.0):
+    lat = np.arange(-90 + step / 2, 90, step)
+    lon = np.arange(lon0 + step / 2, lon0 + 360, step)
+    return lat, lon
+
+
+def _areas(lat, lon):
+    step_lat, step_lon = lat[1] - lat[0], lon[1] - lon[0]
+    band = np.sin(np.deg2rad(lat + step_lat / 2)) - np.sin(np.deg2rad(lat - step_lat / 2))
+    return np.outer(band, np.full(len(lon), np.deg2rad(step_lon)))
+
+
+def test_conservative_preserves_constants_and_area_integrals():
+    src, dst = _grid(1.0), _grid(2.5)
+    rg = Regridder.build(*src, *dst, 'conservative')
+    np.testing.assert_allclose(np.asarray(rg.weights.sum(axis=1)).ravel(), 1.0)
+
+    rng = np.random.default_rng(0)
+    field = rng.normal(size=(3, len(src[0]), len(src[1])))
+    out = rg.apply(field)
+    assert out.shape == (3, len(dst[0]), len(dst[1]))
+    np.testing.assert_allclose(rg.apply(np.ones(field.shape[1:])), 1.0)
+    np.testing.assert_allclose((out * _areas(*dst)).sum(axis=(1, 2)),
+                               (field * _areas(*src)).sum(axis=(1, 2)), rtol=1e-10, atol=1e-9)
+
+
+def test_periodic_longitude_matches_shifted_grid():
+    # 0..360 metrics onto a -180..180 grid of the same cells is a roll
+    src, dst = _grid(2.0), _grid(2.0, lon0=-180.0)
+    field = np.random.default_rng(1).normal(size=(len(src[0]), len(src[1])))
+    out = Regridder.build(*src, *dst, 'conservative').apply(field)
+    np.testing.assert_allclose(out, np.roll(field, len(src[1]) // 2, axis=1), atol=1e-12)
+
+
+def test_nan_sources_are_left_out():
+    src, dst = _grid(1.0), _grid(2.0)
+    field = np.full((len(src[0]), len(src[1])), 5.0)
+    field[0, 0] = np.nan            # one of four sources of dst[0, 0]
+    field[2:4, 2:4] = np.nan        # all four sources of dst[1, 1]
+    out = Regridder.build(*src, *dst, 'conservative').apply(field)
+    assert out[0, 0] == pytest.approx(5.0)
+    assert np.isnan(out[1, 1])
+    assert np.isfinite(out).sum() == out.size - 1
+
+
+def test_bilinear_reproduces_linear_fields():
+    src, dst = _grid(2.0), _grid(1.0)
+    lat2d, lon2d = np.meshgrid(src[0], src[1], indexing='ij')
+    out = Regridder.build(*src, *dst, 'bilinear').apply(0.5 * lat2d + 3.0)
+    interior = (dst[0] > src[0][0]) & (dst[0] < src[0][-1])
+    expected = np.broadcast_to((0.5 * dst[0] + 3.0)[:, None], out.shape)
+    np.testing.assert_allclose(out[interior], expected[interior], atol=1e-10)
+
+
+def test_cached_weights_are_reused(tmp_path):
+    src, dst = _grid(3.0), _grid(4.0, lon0=-180.0)
+    first = Regridder.cached(*src, *dst, cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 1
+    second = Regridder.cached(*src, *dst, cache_dir=str(tmp_path))
+    assert (first.weights != second.weights).nnz == 0
+    assert second.method == 'conservative'
+    other = Regridder.cached(*src, *dst, method='bilinear', cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 2 and other.method == 'bilinear'
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError, match='Unknown regridding method'):
+        Regridder.build(*_grid(10.0), *_grid(20.0), 'nearest')
@@ -0,0 +1,54 @@
+"""Streaming quantile estimators against ``np.nanquantile``."""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'wbgt'))
+
+from streaming_quantiles import DEFAULT_BIN_WIDTH, HistogramSketch, streaming_quantiles  # noqa: E402
+
+QUANTILES = (0.0, 0.01, 0.5, 0.95, 0.99, 1.0)
+
+
+def _skewed(n_time, n_cells, seed=0):
+    rng = np.random.default_rng(seed)
+    values = (rng.gamma(2, 2, size=(n_time, n_cells)) + 10).astype(np.float32)
+    values[rng.random(values.shape) < 0.05] = np.nan
+    return values
+
+
+@pytest.mark.parametrize('n_time', [10, 533, 5000])
+def test_histogram_within_a_bin_width(n_time):
+    # Sparse tail bins: the estimate interpolates between order statistics
+    values = _skewed(n_time, 200)
+    sketch = HistogramSketch(200)
+    for start in range(0, n_time, 97):
+        sketch.update(values[start:start + 97])
+    estimate = sketch.quantiles(QUANTILES)
+    expected = np.nanquantile(values, QUANTILES, axis=0)
+    assert np.abs(estimate - expected).max() <= DEFAULT_BIN_WIDTH
+
+
+def test_histogram_empty_cells_are_nan():
+    values = _skewed(20, 3)
+    values[:, 1] = np.nan
+    sketch = HistogramSketch(3)
+    sketch.update(values)
+    assert np.isnan(sketch.quantiles([0.5])[0, 1])
+
+
+@pytest.mark.parametrize('method, tolerance', [('exact', 1e-5), ('histogram', DEFAULT_BIN_WIDTH),
+                                               ('tdigest', 0.5)])
+def test_streaming_quantiles_match_numpy(method, tolerance):
+    values = _skewed(730, 6 * 8).reshape(730, 6, 8)
+    da = xr.DataArray(values, dims=('time', 'latitude', 'longitude'),
+                      coords={'time': pd.date_range('2001-01-01', periods=730)})
+    # A small budget forces several tiles and time blocks
+    result = streaming_quantiles(da, (0.5, 0.95), method=method, memory_budget=64 * 1024)
+    expected = np.nanquantile(values, (0.5, 0.95), axis=0)
+    np.testing.assert_allclose(result.values, expected, atol=tolerance)
@@ -0,0 +1,162 @@
+"""Batch top-k analogs for every land cell (the analog atlas).
+
+For each biome, query cells and reference cells are tiled into blocks and
+squared distances come from one matrix product per block pair,
+``|a|^2 + |b|^2 - 2 a.b``. Each query block keeps a running top-k while the
+reference blocks stream past, so memory stays at one block pair. Query
+blocks are spread over a process pool.
+
+The atlas is written as ``analog_cell`` (int32 flat grid index of each
+analog, -1 where none) and ``analog_distance`` (float32) on the metric grid:
+
+    python analog_atlas.py --index wbgt_analog_index.npz -k 10 --workers 8
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from analog_index import AnalogIndex
+
+# Block sizes keep one (query x reference) float32 distance tile near 4 MB
+QUERY_BLOCK = 512
+REFERENCE_BLOCK = 2048
+
+# Per-worker copies of the feature table, set by _init_worker
+_features = None
+_sq_norms = None
+
+
+def _init_worker(features):
+    global _features, _sq_norms
+    _features = features
+    _sq_norms = np.einsum('ij,ij->i', features, features)
+
+
+def topk_block(queries, references, k, reference_block=REFERENCE_BLOCK):
+    """Top-k nearest ``references`` rows of each ``queries`` row.
+
+    Both arguments are row indices into the worker feature table; a query
+    never matches itself. Returns ``(rows, squared_distances)`` of shape
+    ``(len(queries), k)``, padded with -1/inf.
+    """
+    q = _features[queries]
+    q_norm = _sq_norms[queries][:, None]
+    best_d = np.full((len(queries), k), np.inf, dtype=np.float32)
+    best_r = np.full((len(queries), k), -1, dtype=np.int64)
+
+    for start in range(0, len(references), reference_block):
+        ref = references[start:start + reference_block]
+        d = q_norm + _sq_norms[ref][None, :] - 2 * (q @ _features[ref].T)
+        np.maximum(d, 0, out=d)
+        d[queries[:, None] == ref[None, :]] = np.inf
+
+        # Only rows with a candidate closer than their current k-th best
+        # need merging; after the first blocks that is a small minority
+        hit = d < best_d.max(axis=1, keepdims=True)
+        active = np.flatnonzero(hit.any(axis=1))
+        if len(active) == 0:
+            continue
+        cand_d = np.concatenate([best_d[active],
+                                 np.where(hit[active], d[active], np.inf)], axis=1)
+        cand_r = np.concatenate([best_r[active],
+                                 np.broadcast_to(ref, (len(active), len(ref)))], axis=1)
+        keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+        best_d[active] = np.take_along_axis(cand_d, keep, axis=1)
+        best_r[active] = np.take_along_axis(cand_r, keep, axis=1)
+
+    order = np.argsort(best_d, axis=1, kind='stable')
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    best_r = np.take_along_axis(best_r, order, axis=1)
+    best_r[~np.isfinite(best_d)] = -1
+    return queries, best_r, best_d
+
+
+def compute_atlas(index, k=10, workers=None, query_block=QUERY_BLOCK,
+                  reference_block=REFERENCE_BLOCK):
+    """Top-k same-biome analogs of every indexed cell.
+
+    Returns
+    -------
+    rows : ndarray of int64, shape (cells, k)
+        Index rows of the analogs (-1 where the biome has fewer than k+1 cells).
+    distances : ndarray of float32, shape (cells, k)
+        Feature-space Euclidean distances.
+    """
+    features = np.ascontiguousarray(index.features, dtype=np.float32)
+    tasks = []
+    for b in index.biomes:
+        members = index.members(b)
+        for start in range(0, len(members), query_block):
+            tasks.append((members[start:start + query_block], members))
+
+    rows = np.full((len(features), k), -1, dtype=np.int64)
+    dist = np.full((len(features), k), np.inf, dtype=np.float32)
+    workers = workers or os.cpu_count()
+    t0 = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(features,)) as pool:
+        futures = [pool.submit(topk_block, queries, refs, k, reference_block)
+                   for queries, refs in tasks]
+        for future in futures:
+            queries, r, d = future.result()
+            rows[queries], dist[queries] = r, d
+            done += len(queries)
+    elapsed = time.perf_counter() - t0
+    print(f"  {done} cells in {elapsed:.1f} s ({done / max(elapsed, 1e-9):,.0f} cells/s, "
+          f"{workers} workers)")
+    return rows, np.sqrt(dist)
+
+
+def atlas_dataset(index, rows, dist):
+    """Grid-aligned atlas: int32 analog cells and float32 distances per rank."""
+    n_lat, n_lon = len(index.lat), len(index.lon)
+    k = rows.shape[1]
+    cell = np.full((n_lat * n_lon, k), -1, dtype=np.int32)
+    distance = np.full((n_lat * n_lon, k), np.nan, dtype=np.float32)
+    found = rows >= 0
+    cell[index.cells] = np.where(found, index.cells[np.where(found, rows, 0)], -1)
+    distance[index.cells] = np.where(found, dist, np.nan)
+
+    dims = ('lat', 'lon', 'rank')
+    coords = {'lat': index.lat, 'lon': index.lon, 'rank': np.arange(1, k + 1)}
+    return xr.Dataset(
+        {
+            'analog_cell': (dims, cell.reshape(n_lat, n_lon, k), {
+                'long_name': 'Flat grid index (lat * n_lon + lon) of the k-th closest analog',
+                'comment': '-1 where the cell has no analog'}),
+            'analog_distance': (dims, distance.reshape(n_lat, n_lon, k), {
+                'long_name': 'Standardized metric distance to the k-th closest analog',
+                'units': '1'}),
+        },
+        coords=coords,
+        attrs={'variables': ', '.join(index.variables),
+               'description': 'Top-k climate analogs within the same biome'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--index', default='wbgt_analog_index.npz')
+    parser.add_argument('--output', default='wbgt_analog_atlas.nc')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--query-block', type=int, default=QUERY_BLOCK)
+    parser.add_argument('--reference-block', type=int, default=REFERENCE_BLOCK)
+    args = parser.parse_args(argv)
+
+    index = AnalogIndex.load(args.index)
+    print(f"Computing top-{args.k} analogs for {len(index.cells)} cells...")
+    rows, dist = compute_atlas(index, args.k, args.workers, args.query_block,
+                               args.reference_block)
+    ds = atlas_dataset(index, rows, dist)
+    ds.to_netcdf(args.output, encoding={v: {'zlib': True, 'complevel': 4} for v in ds.data_vars})
+    print(f"Atlas saved to: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""Biome-constrained climate analog search.
+
+An ``AnalogIndex`` holds one feature vector per land cell, built from the
+variables of ``wbgt_annual_metrics.nc`` (z-scored over land, then scaled by
+optional per-variable weights), partitioned by ``BIOME_ID``. A variable with
+an extra dimension, such as ``days_above_29C_by_season``, adds one feature
+per label (``days_above_29C_by_season[JJA]``), so cells can be matched on
+seasonal profiles. A k-d tree per
+biome answers "which cells are most similar to this location" in
+milliseconds; trees are built the first time their biome is queried.
+
+    python analog_index.py build
+    python analog_index.py query --lat 40.0 --lon -105.25 -k 10
+"""
+
+import argparse
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from biome_index import BiomeIndex
+from land_vector import LandVector, align_biomes
+from metric_store import open_metrics
+
+# Variables used as analog features unless a subset is given
+DEFAULT_VARIABLES = ['wbgtmax_annual_mean', 'wbgtmax_p95', 'days_above_p95',
+                     'days_above_27C', 'days_above_29C', 'days_above_31C']
+
+
+def _grid_names(ds):
+    lat = 'latitude' if 'latitude' in ds.dims else 'lat'
+    lon = 'longitude' if 'longitude' in ds.dims else 'lon'
+    return lat, lon
+
+
+def feature_fields(metrics_ds, variables):
+    """Feature names, their base variables and ``(lat, lon)`` fields.
+
+    A variable with extra dims gives one feature per label, named
+    ``variable[label]`` (labels of several dims joined by commas).
+    """
+    lat_name, lon_name = _grid_names(metrics_ds)
+    names, bases, fields = [], [], []
+    for v in variables:
+        da = metrics_ds[v]
+        extra = [d for d in da.dims if d not in (lat_name, lon_name)]
+        if not extra:
+            names.append(v)
+            bases.append(v)
+            fields.append(da.transpose(lat_name, lon_name).values)
+            continue
+        stacked = da.stack(feature=extra).transpose('feature', lat_name, lon_name)
+        for label, field in zip(stacked['feature'].values, stacked.values):
+            label = ','.join(map(str, label)) if isinstance(label, tuple) else str(label)
+            names.append(f'{v}[{label}]')
+            bases.append(v)
+            fields.append(field)
+    return names, bases, fields
+
+
+class AnalogIndex:
+    """Per-biome nearest-neighbour index over standardized metric vectors.
+
+    Parameters
+    ----------
+    features : ndarray, shape (cells, variables)
+        Standardized, weighted feature vectors of the indexed cells.
+    cells : ndarray of int
+        Flat ``(lat, lon)`` index of each row of ``features``.
+    biome : ndarray of int
+        ``BIOME_ID`` of each row.
+    lat, lon : ndarray
+        Grid coordinates, used to map query locations to cells.
+    variables : list of str
+        Feature names, in column order.
+    mean, std, weights : ndarray
+        Per-variable standardization, to map raw metric values to features.
+    values : ndarray, shape (cells, variables)
+        Raw metric values of the indexed cells, for reporting.
+    """
+
+    def __init__(self, features, cells, biome, lat, lon, variables, mean, std, weights, values):
+        order = np.argsort(cells)
+        self.features = np.asarray(features, dtype=np.float32)[order]
+        self.values = np.asarray(values, dtype=np.float32)[order]
+        self.cells = np.asarray(cells, dtype=np.int64)[order]
+        self.biome = np.asarray(biome, dtype=np.int16)[order]
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.variables = list(variables)
+        self.mean = np.asarray(mean)
+        self.std = np.asarray(std)
+        self.weights = np.asarray(weights)
+        self.partition = BiomeIndex(self.biome)
+        self._trees = {}
+
+    @classmethod
+    def build(cls, metrics_ds, biome_ds, variables=None, weights=None):
+        """Index the land cells of ``metrics_ds`` that have every variable.
+
+        ``weights`` maps variable (or feature) names to multipliers applied
+        after z-scoring (default 1); a weight of 0 drops the variable's
+        influence.
+        """
+        variables = list(variables or [v for v in DEFAULT_VARIABLES if v in metrics_ds])
+        lat_name, lon_name = _grid_names(metrics_ds)
+        lat, lon = metrics_ds[lat_name], metrics_ds[lon_name]
+
+        land = LandVector.from_biomes(biome_ds, lat, lon)
+        biome = land.pack(align_biomes(biome_ds, lat, lon).values).astype(np.int16)
+        names, bases, fields = feature_fields(metrics_ds, variables)
+        columns = [land.pack(field) for field in fields]
+        variables = names
+        values = np.stack(columns, axis=1).astype(np.float64)
+        complete = np.isfinite(values).all(axis=1)
+        values, biome, cells = values[complete], biome[complete], land.index[complete]
+
+        mean = values.mean(axis=0)
+        std = values.std(axis=0)
+        std[std == 0] = 1
+        weights = weights or {}
+        w = np.array([weights.get(v, weights.get(b, 1.0)) for v, b in zip(variables, bases)])
+        features = (values - mean) / std * w
+        return cls(features, cells, biome, lat.values, lon.values, variables, mean, std, w, values)
+
+    def transform(self, metrics_ds):
+        """Feature vectors of the indexed cells from another metrics dataset.
+
+        ``metrics_ds`` must be on the index grid and hold the index's base
+        variables (a future period, another model). The index's own
+        standardization is applied, so distances are comparable with the
+        indexed features. Returns ``(features, values)``, both
+        ``(cells, variables)``; rows with a missing value are NaN.
+        """
+        bases = list(dict.fromkeys(v.split('[')[0] for v in self.variables))
+        names, _, fields = feature_fields(metrics_ds, bases)
+        missing = set(self.variables) - set(names)
+        if missing:
+            raise KeyError(f"Features missing from the dataset: {sorted(missing)}")
+        by_name = dict(zip(names, fields))
+        values = np.stack([np.asarray(by_name[v], dtype=np.float64).ravel()[self.cells]
+                           for v in self.variables], axis=1)
+        features = (values - self.mean) / self.std * self.weights
+        return features.astype(np.float32), values.astype(np.float32)
+
+    # -------------------------------------------------------------------------
+    # Storage
+    # -------------------------------------------------------------------------
+
+    def save(self, path):
+        np.savez(path, features=self.features, cells=self.cells, biome=self.biome,
+                 lat=self.lat, lon=self.lon, variables=np.array(self.variables),
+                 mean=self.mean, std=self.std, weights=self.weights, values=self.values)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(npz['features'], npz['cells'], npz['biome'], npz['lat'], npz['lon'],
+                       [str(v) for v in npz['variables']], npz['mean'], npz['std'],
+                       npz['weights'], npz['values'])
+
+    # -------------------------------------------------------------------------
+    # Queries
+    # -------------------------------------------------------------------------
+
+    @property
+    def biomes(self):
+        return self.partition.ids
+
+    def members(self, b):
+        """Rows of biome ``b``."""
+        return self.partition.cells_of(b)
+
+    def _tree(self, b):
+        """k-d tree and row indices of biome ``b``, built on first use."""
+        if b not in self._trees:
+            rows = self.members(b)
+            self._trees[b] = (cKDTree(self.features[rows]), rows)
+        return self._trees[b]
+
+    def locate(self, lat, lon):
+        """Row of the indexed cell containing (``lat``, ``lon``)."""
+        i = int(np.abs(self.lat - lat).argmin())
+        j = int(np.abs((self.lon - lon + 180) % 360 - 180).argmin())
+        flat = i * len(self.lon) + j
+        row = int(np.searchsorted(self.cells, flat))
+        if row == len(self.cells) or self.cells[row] != flat:
+            raise ValueError(f"({lat}, {lon}) is not a land cell with complete metrics")
+        return row
+
+    def nearest(self, vectors, k=10, biomes=None, exclude=None):
+        """k most similar rows to each feature vector among ``biomes``.
+
+        Returns ``(rows, distances)`` arrays of shape ``(len(vectors), k)``,
+        padded with -1/inf when fewer than k candidates exist.
+        """
+        vectors = np.atleast_2d(vectors)
+        n_query = len(vectors)
+        extra = 0 if exclude is None else 1
+        best_d = np.full((n_query, 0), np.inf)
+        best_r = np.full((n_query, 0), -1, dtype=np.int64)
+        for b in (self.biomes if biomes is None else biomes):
+            if b not in self.biomes:
+                continue
+            tree, rows = self._tree(b)
+            kk = min(k + extra, len(rows))
+            d, i = tree.query(vectors, k=kk)
+            d, i = d.reshape(n_query, kk), i.reshape(n_query, kk)
+            best_d = np.concatenate([best_d, d], axis=1)
+            best_r = np.concatenate([best_r, rows[i]], axis=1)
+
+        if exclude is not None:
+            best_d = np.where(best_r == np.asarray(exclude).reshape(-1, 1), np.inf, best_d)
+        order = np.argsort(best_d, axis=1, kind='stable')[:, :k]
+        rows = np.take_along_axis(best_r, order, axis=1)
+        dist = np.take_along_axis(best_d, order, axis=1)
+        if rows.shape[1] < k:
+            pad = k - rows.shape[1]
+            rows = np.pad(rows, ((0, 0), (0, pad)), constant_values=-1)
+            dist = np.pad(dist, ((0, 0), (0, pad)), constant_values=np.inf)
+        rows[~np.isfinite(dist)] = -1
+        return rows, dist
+
+    def query(self, lat, lon, k=10, biomes=None, frame=True):
+        """The ``k`` closest analogs of the cell at (``lat``, ``lon``).
+
+        By default only cells of the same biome are searched; ``biomes``
+        widens the search to the listed ``BIOME_ID`` values.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per analog with its location, biome, feature distance
+            and raw metric values, closest first. With ``frame=False`` the
+            same columns as a dict of arrays, without importing pandas.
+        """
+        row = self.locate(lat, lon)
+        allowed = [int(self.biome[row])] if biomes is None else list(biomes)
+        rows, dist = self.nearest(self.features[row], k=k, biomes=allowed, exclude=row)
+        rows, dist = rows[0], dist[0]
+        rows, dist = rows[rows >= 0], dist[rows >= 0]
+        return self.describe(rows, dist) if frame else self.columns(rows, dist)
+
+    def columns(self, rows, dist=None):
+        """The given rows' locations and raw metric values, column by column."""
+        cells = self.cells[rows]
+        table = {
+            'lat': self.lat[cells // len(self.lon)],
+            'lon': self.lon[cells % len(self.lon)],
+            'biome': self.biome[rows],
+        }
+        if dist is not None:
+            table['distance'] = dist
+        for j, v in enumerate(self.variables):
+            table[v] = self.values[rows, j]
+        return table
+
+    def describe(self, rows, dist=None):
+        """Table of the given rows' locations and raw metric values."""
+        import pandas as pd
+        return pd.DataFrame(self.columns(rows, dist))
+
+
+def format_columns(table):
+    """Plain-text table of a dict of equal-length columns, one row per line."""
+    cells = {name: [f'{v:.6g}' if isinstance(v, (float, np.floating)) else str(v)
+                    for v in values]
+             for name, values in table.items()}
+    n = len(next(iter(cells.values()), []))
+    cells = {'': [str(i) for i in range(n)], **cells}
+    widths = {name: max([len(name)] + [len(v) for v in values])
+              for name, values in cells.items()}
+    lines = ['  '.join(name.rjust(widths[name]) for name in cells)]
+    lines += ['  '.join(values[i].rjust(widths[name]) for name, values in cells.items())
+              for i in range(n)]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('--metrics', default='wbgt_annual_metrics.nc',
+                        help='metrics NetCDF file or metric store directory')
+    parser.add_argument('--biomes', default='/glade/u/home/jsallen/projects/tnc_2025/analogs/'
+                                            'biomes/biomes.analog.gridded.nc')
+    parser.add_argument('--index', default='wbgt_analog_index.npz')
+    parser.add_argument('--lat', type=float)
+    parser.add_argument('--lon', type=float)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--allow-biomes', type=int, nargs='*',
+                        help='BIOME_IDs to search (default: the query cell\'s biome)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        import xarray as xr
+
+        index = AnalogIndex.build(open_metrics(args.metrics), xr.open_dataset(args.biomes))
+        index.save(args.index)
+        print(f"Indexed {len(index.cells)} cells in {len(index.biomes)} biomes -> {args.index}")
+    else:
+        index = AnalogIndex.load(args.index)
+        print(format_columns(index.query(args.lat, args.lon, k=args.k,
+                                        biomes=args.allow_biomes, frame=False)))
+
+
+if __name__ == '__main__':
+    main()
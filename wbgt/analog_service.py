@@ -0,0 +1,425 @@
+"""Local HTTP service for point metrics, analog queries and map tiles.
+
+The metric grids (a NetCDF file or a ``metric_store`` directory), the biome
+raster and the analog index are loaded once; requests are then answered
+from memory:
+
+* ``GET /variables`` - metric names, units, dims and colour ranges
+* ``GET /point?lat=40&lon=-105.25`` - every metric and the biome of a cell
+* ``GET /analogs?lat=40&lon=-105.25&k=10[&biomes=4,5]`` - closest analogs
+* ``GET /tiles/<var>/<z>/<x>/<y>.png[?biome=4&vmin=..&vmax=..&season=JJA]``
+  - a 256x256 Web Mercator (XYZ) tile coloured on the fly, with cells of
+  other biomes transparent when ``biome`` is given
+* ``GET /stats`` - cache sizes and hit rates
+
+Requests are parsed on an asyncio event loop and computed on a bounded
+thread pool; numpy releases the GIL for the heavy parts. Tiles and query
+results go through separate bounded LRU caches, and concurrent requests for
+the same uncached key share one computation. Only the standard library and
+numpy are needed (PNGs are encoded with zlib).
+
+    python analog_service.py --metrics wbgt_metrics.store --port 8765
+    curl 'http://127.0.0.1:8765/point?lat=40&lon=-105.25'
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import struct
+import threading
+import traceback
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import xarray as xr
+
+from analog_index import AnalogIndex
+from land_vector import align_biomes
+from metric_store import open_metrics
+
+TILE_SIZE = 256
+
+# ColorBrewer YlOrRd, low to high
+COLORMAP = ['#ffffcc', '#ffeda0', '#fed976', '#feb24c', '#fd8d3c', '#fc4e2a', '#e31a1c',
+            '#bd0026', '#800026']
+
+
+class NotFound(Exception):
+    """A request for something the service does not have (answered 404)."""
+
+
+def _grid_names(ds):
+    lat = 'latitude' if 'latitude' in ds.dims else 'lat'
+    lon = 'longitude' if 'longitude' in ds.dims else 'lon'
+    return lat, lon
+
+
+def _lookup_table(colors=COLORMAP, n=256):
+    """``(n, 4)`` uint8 RGBA ramp through ``colors``."""
+    anchors = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in colors], dtype=float)
+    x = np.linspace(0, 1, len(anchors))
+    t = np.linspace(0, 1, n)
+    rgb = np.stack([np.interp(t, x, anchors[:, j]) for j in range(3)], axis=1)
+    return np.concatenate([rgb, np.full((n, 1), 255)], axis=1).round().astype(np.uint8)
+
+
+def encode_png(rgba):
+    """PNG bytes of an ``(h, w, 4)`` uint8 image."""
+    h, w, _ = rgba.shape
+    raw = np.concatenate([np.zeros((h, 1), dtype=np.uint8), rgba.reshape(h, -1)], axis=1)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+
+def tile_lonlat(z, x, y, size=TILE_SIZE):
+    """Longitudes and latitudes of the pixel centres of XYZ tile ``(z, x, y)``."""
+    n = 2 ** z
+    px = (x + (np.arange(size) + 0.5) / size) / n
+    py = (y + (np.arange(size) + 0.5) / size) / n
+    return px * 360 - 180, np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * py))))
+
+
+def _nearest(values, coord, period=None):
+    """Index of the nearest regular-grid coordinate; -1 outside the grid."""
+    values = np.asarray(values, dtype=np.float64)
+    step = values[1] - values[0]
+    coord = np.asarray(coord, dtype=np.float64)
+    if period is not None:
+        coord = (coord - values[0]) % period + values[0]
+    i = np.round((coord - values[0]) / step).astype(np.int64)
+    if period is not None:
+        return i % len(values)
+    return np.where((i >= 0) & (i < len(values)), i, -1)
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by entry count."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / total if total else None}
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return _jsonable(value.tolist())
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if not math.isfinite(value) else float(value)
+    return value
+
+
+class AnalogService:
+    """The loaded grids and the request handlers (thread-safe, read-only).
+
+    Parameters
+    ----------
+    metrics_ds : xr.Dataset
+        Metric fields on a regular ``(lat, lon)`` grid.
+    biome_ds : xr.Dataset
+        ``biomes.analog.gridded.nc``.
+    index : AnalogIndex, optional
+        Analog index for ``/analogs``.
+    """
+
+    def __init__(self, metrics_ds, biome_ds, index=None):
+        lat_name, lon_name = _grid_names(metrics_ds)
+        self.lat = metrics_ds[lat_name].values
+        self.lon = metrics_ds[lon_name].values
+        self.periodic = abs(len(self.lon) * abs(self.lon[1] - self.lon[0]) - 360) < 1e-6
+        self.biome = align_biomes(biome_ds, self.lat, self.lon).values
+        self.fields, self.info = {}, {}
+        for name, da in metrics_ds.data_vars.items():
+            if da.dims[-2:] != (lat_name, lon_name):
+                continue
+            values = da.values.astype(np.float32)
+            land = values[..., np.isfinite(self.biome) & (self.biome >= 1)]
+            lo, hi = (np.nanpercentile(land, [2, 98]).tolist() if np.isfinite(land).any()
+                      else (0.0, 1.0))
+            self.fields[name] = values
+            self.info[name] = {
+                'dims': list(da.dims),
+                'labels': {d: [str(v) for v in da[d].values] for d in da.dims[:-2]},
+                'units': da.attrs.get('units'), 'long_name': da.attrs.get('long_name'),
+                'vmin': lo, 'vmax': hi}
+        self.index = index
+        self.lut = _lookup_table()
+
+    # -------------------------------------------------------------------------
+    # Handlers
+    # -------------------------------------------------------------------------
+
+    def _cell(self, lat, lon):
+        i = int(_nearest(self.lat, lat))
+        j = int(_nearest(self.lon, lon, 360.0 if self.periodic else None))
+        if i < 0 or j < 0:
+            raise ValueError(f"({lat}, {lon}) is outside the grid")
+        return i, j
+
+    def point(self, lat, lon):
+        """Every metric and the biome of the cell nearest to ``(lat, lon)``."""
+        i, j = self._cell(lat, lon)
+        metrics = {}
+        for name, values in self.fields.items():
+            value = values[..., i, j]
+            if value.ndim:
+                labels = self.info[name]['labels']
+                value = dict(zip(labels[next(iter(labels))], value.tolist())) \
+                    if len(labels) == 1 else value.tolist()
+            metrics[name] = value
+        biome = self.biome[i, j]
+        return {'lat': float(self.lat[i]), 'lon': float(self.lon[j]),
+                'biome': int(biome) if np.isfinite(biome) and biome >= 1 else None,
+                'metrics': metrics}
+
+    def analogs(self, lat, lon, k=10, biomes=None):
+        """The ``k`` closest analogs of ``(lat, lon)`` as a list of records."""
+        if self.index is None:
+            raise NotFound('no analog index loaded')
+        table = self.index.query(lat, lon, k=k, biomes=biomes)
+        return {'lat': lat, 'lon': lon, 'analogs': table.to_dict(orient='records')}
+
+    def _field(self, name, selection):
+        if name not in self.fields:
+            raise NotFound(f"unknown variable {name!r}")
+        values, labels = self.fields[name], self.info[name]['labels']
+        for axis, (dim, options) in enumerate(labels.items()):
+            if dim not in selection:
+                raise ValueError(f"{name} needs ?{dim}= (one of {', '.join(options)})")
+            if selection[dim] not in options:
+                raise ValueError(f"{dim}={selection[dim]!r} not one of {', '.join(options)}")
+            values = np.take(values, options.index(selection[dim]), axis=0)
+        return values
+
+    def tile(self, name, z, x, y, biome=None, vmin=None, vmax=None, selection=None):
+        """PNG of XYZ tile ``(z, x, y)`` of a metric, optionally one biome only."""
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"tile {z}/{x}/{y} does not exist")
+        field = self._field(name, selection or {})
+        vmin = self.info[name]['vmin'] if vmin is None else vmin
+        vmax = self.info[name]['vmax'] if vmax is None else vmax
+        lon, lat = tile_lonlat(z, x, y)
+        rows = _nearest(self.lat, lat)
+        cols = _nearest(self.lon, lon, 360.0 if self.periodic else None)
+        inside = (rows >= 0)[:, None] & (cols >= 0)[None, :]
+        values = field[rows[:, None], cols[None, :]]
+        show = inside & np.isfinite(values)
+        if biome is not None:
+            show &= self.biome[rows[:, None], cols[None, :]] == biome
+        scaled = np.clip((np.where(show, values, vmin) - vmin) / ((vmax - vmin) or 1), 0, 1)
+        rgba = self.lut[np.round(scaled * (len(self.lut) - 1)).astype(np.intp)]
+        rgba[~show] = 0
+        return encode_png(rgba)
+
+
+def _encoded(compute):
+    """``compute()`` as response bytes (PNGs as they are, the rest as JSON)."""
+    body = compute()
+    return body if isinstance(body, bytes) else json.dumps(_jsonable(body)).encode()
+
+
+class Server:
+    """asyncio HTTP/1.1 front end of an ``AnalogService``.
+
+    Parameters
+    ----------
+    service : AnalogService
+    workers : int, optional
+        Threads computing uncached responses.
+    tile_cache, query_cache : int
+        Entries kept in the tile and query-result LRU caches.
+    """
+
+    def __init__(self, service, workers=None, tile_cache=4096, query_cache=4096):
+        self.service = service
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.tiles = LRUCache(tile_cache)
+        self.queries = LRUCache(query_cache)
+        self._pending = {}
+
+    def _route(self, path, params):
+        """(cache, key, function) of a request; raises for bad requests."""
+        s = self.service
+
+        def num(name, default=None, cast=float):
+            if name not in params:
+                if default is None:
+                    raise ValueError(f"missing ?{name}=")
+                return default
+            value = cast(params[name])
+            if not math.isfinite(value):
+                raise ValueError(f"?{name}= must be a finite number")
+            return value
+
+        parts = [p for p in path.split('/') if p]
+        if parts == ['variables']:
+            return None, None, lambda: s.info
+        if parts == ['stats']:
+            return None, None, lambda: {'tiles': self.tiles.stats(),
+                                        'queries': self.queries.stats()}
+        if parts == ['point']:
+            lat, lon = num('lat'), num('lon')
+            return self.queries, ('point', lat, lon), lambda: s.point(lat, lon)
+        if parts == ['analogs']:
+            lat, lon, k = num('lat'), num('lon'), num('k', 10, int)
+            biomes = ([int(b) for b in params['biomes'].split(',')]
+                      if params.get('biomes') else None)
+            key = ('analogs', lat, lon, k, tuple(biomes or ()))
+            return self.queries, key, lambda: s.analogs(lat, lon, k, biomes)
+        if len(parts) == 5 and parts[0] == 'tiles' and parts[4].endswith('.png'):
+            name, z, x, y = parts[1], int(parts[2]), int(parts[3]), int(parts[4][:-4])
+            biome = num('biome', -1, int)
+            biome = None if biome < 0 else biome
+            vmin, vmax = (num(v) if v in params else None for v in ('vmin', 'vmax'))
+            selection = {k: v for k, v in params.items()
+                         if k not in ('biome', 'vmin', 'vmax')}
+            key = ('tile', name, z, x, y, biome, vmin, vmax, tuple(sorted(selection.items())))
+            return self.tiles, key, lambda: s.tile(name, z, x, y, biome, vmin, vmax, selection)
+        raise NotFound(f'not found: {path}')
+
+    async def respond(self, target):
+        """``(status, content type, body)`` of a GET request."""
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            cache, key, compute = self._route(url.path, params)
+            body = None if cache is None else cache.get(key)
+            if body is None:
+                if key in self._pending:
+                    body = await asyncio.shield(self._pending[key])
+                else:
+                    # Encoded in the pool, so requests sharing the future get bytes too
+                    future = asyncio.get_running_loop().run_in_executor(
+                        self.pool, _encoded, compute)
+                    if cache is not None:
+                        self._pending[key] = future
+                    try:
+                        body = await future
+                    finally:
+                        self._pending.pop(key, None)
+                    if cache is not None:
+                        cache.put(key, body)
+        except NotFound as e:
+            return 404, 'application/json', json.dumps({'error': str(e)}).encode()
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        except Exception as e:
+            # A bug, not a bad request: answer it and keep the connection
+            traceback.print_exc()
+            message = f'{type(e).__name__}: {e}'
+            return 500, 'application/json', json.dumps({'error': message}).encode()
+        ctype = 'image/png' if body[:4] == b'\x89PNG' else 'application/json'
+        return 200, ctype, body
+
+    async def handle(self, reader, writer):
+        """Serve GET requests on one connection, with keep-alive."""
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   500: 'Internal Server Error'}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if method == 'GET':
+                    status, ctype, body = await self.respond(target)
+                else:
+                    status, ctype, body = 405, 'application/json', b'{"error": "GET only"}'
+                keep = (version == 'HTTP/1.1'
+                        and headers.get('connection', '').lower() != 'close')
+                writer.write((f'{version} {status} {reasons[status]}\r\n'
+                              f'Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n'
+                              f'Connection: {"keep-alive" if keep else "close"}\r\n\r\n')
+                             .encode('latin-1') + body)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--metrics', default='wbgt_annual_metrics.nc',
+                        help='metrics NetCDF file or metric store directory')
+    parser.add_argument('--biomes', default='/glade/u/home/jsallen/projects/tnc_2025/analogs/'
+                                            'biomes/biomes.analog.gridded.nc')
+    parser.add_argument('--index', default='wbgt_analog_index.npz',
+                        help='analog index for /analogs (skipped if missing)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--tile-cache', type=int, default=4096, help='tiles kept in memory')
+    parser.add_argument('--query-cache', type=int, default=4096,
+                        help='point/analog results kept in memory')
+    args = parser.parse_args(argv)
+
+    index = AnalogIndex.load(args.index) if os.path.exists(args.index) else None
+    service = AnalogService(open_metrics(args.metrics, decode_timedelta=False),
+                            xr.open_dataset(args.biomes), index)
+    print(f"Loaded {len(service.fields)} metrics on a {len(service.lat)}x{len(service.lon)} grid"
+          f"{'' if index is None else f', {len(index.cells)} indexed cells'}")
+    server = Server(service, args.workers, args.tile_cache, args.query_cache)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+"""Benchmark of the metric pipeline stages on synthetic ERA5-like data.
+
+Generates (or reuses) a synthetic ``wbgtmax`` stack and biome raster with
+``synthetic_era5``, then runs each stage in a fresh process and records its
+wall time, peak resident memory and bytes read and written:
+
+    index         reference sidecar of the stack (``era5_index``)
+    metrics       ``run_metrics`` without GeoTIFFs: every metric, the per-year
+                  cube, trends and the metric store
+    percentiles   ``streaming_quantiles`` of p95 alone, once per method
+    geotiffs      COG export of the 2-D metrics (needs rasterio)
+    zonal_stats   area-weighted per-biome table
+    plotting      per-biome maps of a few metrics (needs matplotlib, cartopy)
+
+A fresh process per stage keeps one stage's imports, caches and
+fragmentation out of the next one's peak. Peak RSS is the stage process's
+high-water mark, reset after its imports where Linux allows it; bytes read
+are the characters its read calls returned (page-cache hits included) and,
+separately, what came from the block device. Reads by worker processes that
+a stage starts itself are not counted.
+
+Every run appends one record to a JSON history; each stage is compared with
+its latest earlier run on the same data and settings, so a change can be
+checked for a speedup or regression on identical inputs:
+
+    python benchmark.py --size small --label "before"
+    python benchmark.py --size small --label "after" --repeat 3
+    python benchmark.py --size medium --memory-budget 1 --stages metrics percentiles
+"""
+
+import argparse
+import contextlib
+import importlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from run_report import code_version, host_info, io_counters, peak_rss, reset_peak_rss
+from synthetic_era5 import SIZES, ensure_synthetic
+
+STAGES = ('index', 'metrics', 'percentiles', 'geotiffs', 'zonal_stats', 'plotting')
+
+# Modules imported before a stage's clock starts
+STAGE_MODULES = {
+    'index': ('era5_index',),
+    'metrics': ('metrics_pipeline',),
+    'percentiles': ('era5_index', 'land_vector', 'streaming_quantiles'),
+    'geotiffs': ('raster_export', 'rasterio'),
+    'zonal_stats': ('zonal_stats',),
+    'plotting': ('biome_figures', 'matplotlib', 'cartopy'),
+}
+
+# Optional dependencies without which a stage is skipped
+STAGE_REQUIRES = {
+    'geotiffs': ('rasterio',),
+    'plotting': ('matplotlib', 'cartopy'),
+}
+
+QUANTILE_METHODS = ('exact', 'histogram', 'tdigest')
+PLOT_VARIABLES = ('wbgtmax_annual_mean', 'days_above_31C')
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+
+# -----------------------------------------------------------------------------
+# Stages; each takes the run settings and returns a small summary dict
+# -----------------------------------------------------------------------------
+
+def _paths(config):
+    run = config['run_dir']
+    return {
+        'sidecar': os.path.join(run, 'wbgtmax_synthetic_index.json'),
+        'metrics': os.path.join(run, 'wbgt_annual_metrics.nc'),
+    }
+
+
+def _stage_index(config):
+    from era5_index import build_index
+
+    sidecar = _paths(config)['sidecar']
+    if os.path.exists(sidecar):
+        os.remove(sidecar)
+    index = build_index(config['files'], sidecar)
+    return {'files': len(index['files'])}
+
+
+def _stage_metrics(config):
+    from metric_registry import SEASONS
+    from metrics_pipeline import run_metrics
+
+    ds = run_metrics(config['files'], config['biome_file'], config['start_year'],
+                     config['end_year'], output_dir=config['run_dir'],
+                     index_path=os.path.basename(_paths(config)['sidecar']), cache_dir=None,
+                     quantile_method=config['quantile_method'],
+                     memory_budget=config['memory_budget'], windows=SEASONS,
+                     geotiffs=False, backend=config['backend'], workers=config['workers'])
+    return {'variables': len(ds.data_vars) - 1}
+
+
+def _land_stack(config):
+    import xarray as xr
+
+    from era5_index import open_indexed
+    from land_vector import LandVector
+
+    da = open_indexed(_paths(config)['sidecar'], config['files'])['wbgtmax']
+    land = LandVector.from_biomes(xr.open_dataset(config['biome_file']),
+                                  da['latitude'], da['longitude'])
+    return land.pack_dataarray(da)
+
+
+def _stage_percentiles(config, method):
+    import numpy as np
+
+    from streaming_quantiles import streaming_quantiles
+
+    p95 = streaming_quantiles(_land_stack(config), (0.95,), method=method,
+                              memory_budget=config['memory_budget'])
+    return {'p95_mean': round(float(np.nanmean(p95.values)), 3)}
+
+
+def _stage_geotiffs(config):
+    import xarray as xr
+
+    from metrics_pipeline import FILL_VALUE
+    from raster_export import export_rasters
+
+    ds = xr.open_dataset(_paths(config)['metrics'])
+    variables = [v for v in ds.data_vars if ds[v].ndim == 2]
+    written = export_rasters(ds, variables, prefix=os.path.join(config['run_dir'], 'wbgt_'),
+                             nodata=FILL_VALUE)
+    return {'files': len(written)}
+
+
+def _stage_zonal_stats(config):
+    import xarray as xr
+
+    from metric_store import open_metrics
+    from zonal_stats import write_table, zonal_statistics
+
+    table = zonal_statistics(open_metrics(_paths(config)['metrics']),
+                             {'biome': xr.open_dataset(config['biome_file'])},
+                             area_weighted=True)
+    write_table(table, os.path.join(config['run_dir'], 'wbgt_zonal_stats.csv'))
+    return {'rows': len(table)}
+
+
+def _stage_plotting(config):
+    from biome_figures import render_metric_figures
+
+    written = render_metric_figures(_paths(config)['metrics'], config['biome_file'],
+                                    outdir=os.path.join(config['run_dir'], 'figures'),
+                                    variables=list(config['plot_variables']),
+                                    workers=config['workers'], force=True, font_path=None)
+    return {'figures': len(written)}
+
+
+STAGE_FUNCTIONS = {
+    'index': _stage_index,
+    'metrics': _stage_metrics,
+    'percentiles': _stage_percentiles,
+    'geotiffs': _stage_geotiffs,
+    'zonal_stats': _stage_zonal_stats,
+    'plotting': _stage_plotting,
+}
+
+
+def run_stage(stage, config, *args):
+    """Run one stage in this process and measure it.
+
+    Meant to be called in a fresh process (see ``benchmark``). The stage's
+    modules are imported before the clock starts; its output is discarded
+    unless ``config['verbose']``.
+    """
+    for module in STAGE_MODULES[stage]:
+        importlib.import_module(module)
+    peak_reset = reset_peak_rss()
+    before = io_counters()
+    output = contextlib.nullcontext() if config['verbose'] else \
+        contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        summary = STAGE_FUNCTIONS[stage](config, *args)
+    seconds = time.perf_counter() - start
+    after = io_counters()
+    delta = {k: after[k] - before[k] for k in after}
+    return {
+        'status': 'ok',
+        'seconds': round(seconds, 4),
+        'peak_rss': peak_rss(),
+        'peak_rss_includes_imports': not peak_reset,
+        'bytes_read': delta.get('rchar'),
+        'disk_bytes_read': delta.get('read_bytes'),
+        'bytes_written': delta.get('wchar'),
+        'summary': summary,
+    }
+
+
+def _missing(stage):
+    return [m for m in STAGE_REQUIRES.get(stage, ()) if importlib.util.find_spec(m) is None]
+
+
+def benchmark(config, stages=STAGES, methods=QUANTILE_METHODS, repeat=1):
+    """Run ``stages`` ``repeat`` times each; ``{name: result}``.
+
+    The percentile stage is run once per estimator in ``methods``, as
+    ``percentiles[<method>]``. A result keeps the fastest run's
+    measurements, the times of all runs and ``status`` ``'ok'``,
+    ``'skipped'`` (missing optional dependency) or ``'failed'``.
+    """
+    jobs = []
+    for stage in stages:
+        if stage == 'percentiles':
+            jobs += [(f'percentiles[{m}]', stage, (m,)) for m in methods]
+        else:
+            jobs.append((stage, stage, ()))
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, stage, args in jobs:
+        missing = _missing(stage)
+        if missing:
+            results[name] = {'status': 'skipped', 'reason': f"missing {', '.join(missing)}"}
+            print(f"  {name:<24} skipped ({results[name]['reason']})")
+            continue
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    runs.append(pool.submit(run_stage, stage, config, *args).result())
+                except Exception as e:  # recorded; the remaining stages still run
+                    runs = [{'status': 'failed', 'error': f'{type(e).__name__}: {e}'}]
+                    break
+        if runs[0]['status'] == 'failed':
+            results[name] = runs[0]
+            print(f"  {name:<24} failed: {runs[0]['error']}")
+            continue
+        best = min(runs, key=lambda r: r['seconds'])
+        results[name] = dict(best, runs=[r['seconds'] for r in runs])
+        print(f"  {name:<24} {best['seconds']:8.2f} s  {best['peak_rss'] / MB:8.0f} MB peak  "
+              f"{(best['bytes_read'] or 0) / MB:8.0f} MB read")
+    return results
+
+
+# -----------------------------------------------------------------------------
+# History
+# -----------------------------------------------------------------------------
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def append_history(path, record):
+    """Append ``record`` to the JSON list at ``path`` (written atomically)."""
+    history = load_history(path) + [record]
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp, path)
+    return history
+
+
+def baselines(history, record):
+    """``{stage: earlier record}``: per stage, the latest earlier record with the
+    same data and settings in which that stage ran."""
+    found = {}
+    for old in reversed(history):
+        if old['data'] != record['data'] or old['settings'] != record['settings']:
+            continue
+        for name in record['stages']:
+            if name not in found and old['stages'].get(name, {}).get('status') == 'ok':
+                found[name] = old
+    return found
+
+
+def compare(record, history):
+    """Print each stage's time and peak memory against its baseline run."""
+    found = baselines(history, record)
+    if not found:
+        return
+    print("\nAgainst the previous run of the same data and settings:")
+    for name, result in record['stages'].items():
+        if result.get('status') != 'ok' or name not in found:
+            continue
+        baseline = found[name]
+        old = baseline['stages'][name]
+        label = baseline.get('label') or baseline.get('version') or baseline['timestamp']
+        speedup = old['seconds'] / result['seconds'] if result['seconds'] else float('inf')
+        memory = result['peak_rss'] / old['peak_rss'] if old['peak_rss'] else float('nan')
+        print(f"  {name:<24} {old['seconds']:8.2f} -> {result['seconds']:8.2f} s "
+              f"({speedup:5.2f}x)   peak memory x{memory:.2f}   vs {label}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', choices=list(SIZES), default='small',
+                        help='synthetic grid and length: ' + ', '.join(
+                            f'{k} = {r} deg x {y} years' for k, (r, y) in SIZES.items()))
+    parser.add_argument('--resolution', type=float, help='overrides --size')
+    parser.add_argument('--years', type=int, help='overrides --size')
+    parser.add_argument('--chunks', type=int, nargs=3, metavar=('TIME', 'LAT', 'LON'),
+                        help='on-disk chunk shape of the synthetic files')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--quantile-methods', nargs='+', choices=QUANTILE_METHODS,
+                        default=list(QUANTILE_METHODS), help='estimators of the percentile stage')
+    parser.add_argument('--quantile-method', choices=QUANTILE_METHODS, default='exact',
+                        help='p95 estimator of the metrics stage')
+    parser.add_argument('--memory-budget', type=float, default=8, help='GiB')
+    parser.add_argument('--backend', choices=['synchronous', 'threads', 'processes',
+                                              'distributed'], default='threads',
+                        help='where the metric tiles run')
+    parser.add_argument('--workers', type=int, help='metric workers and plotting processes')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage; the fastest '
+                                                              'is kept')
+    parser.add_argument('--workdir', default='wbgt_benchmark',
+                        help='synthetic data, stage outputs and the history')
+    parser.add_argument('--history', help='JSON history (default: <workdir>/history.json)')
+    parser.add_argument('--label', help='name of this run in the history')
+    parser.add_argument('--verbose', action='store_true', help="show the stages' output")
+    args = parser.parse_args(argv)
+
+    resolution, years = SIZES[args.size]
+    resolution, years = args.resolution or resolution, args.years or years
+    print(f"Synthetic data: {resolution} deg x {years} years")
+    data = ensure_synthetic(os.path.join(args.workdir, 'data'), resolution, years,
+                            chunks=args.chunks)
+
+    run_dir = os.path.join(args.workdir, 'run')
+    os.makedirs(run_dir, exist_ok=True)
+    settings = {
+        'quantile_method': args.quantile_method,
+        'memory_budget': int(args.memory_budget * GB),
+        'backend': args.backend,
+        'workers': args.workers,
+        'plot_variables': list(PLOT_VARIABLES),
+    }
+    config = dict(data, **settings, run_dir=run_dir, verbose=args.verbose)
+    stages = [s for s in STAGES if s in args.stages]
+    if any(s in stages for s in ('percentiles', 'metrics')) and 'index' not in stages \
+            and not os.path.exists(_paths(config)['sidecar']):
+        stages.insert(0, 'index')
+
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'version': code_version(),
+        'label': args.label,
+        'data': {'resolution': resolution, 'years': years, 'shape': data['shape'],
+                 'chunks': args.chunks},
+        'settings': settings,
+        'host': host_info(),
+        'stages': benchmark(config, stages, args.quantile_methods, args.repeat),
+    }
+    history_path = args.history or os.path.join(args.workdir, 'history.json')
+    history = append_history(history_path, record)
+    print(f"\nAppended to {history_path}")
+    compare(record, history[:-1])
+
+
+if __name__ == '__main__':
+    main()
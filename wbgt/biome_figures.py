@@ -0,0 +1,125 @@
+"""Per-biome maps of every metric (``figures/biome.XX.<var>.png``).
+
+``render_metric_figures`` is the body of ``temperature.analogs.by.biome.py``
+as a function: the metrics are put on the biome grid, each biome's
+p15/p85 contour range comes from one sort per variable, and the figures are
+drawn by ``biome_maps.render_figures`` (which imports matplotlib and cartopy
+in its workers only).
+"""
+
+import numpy as np
+import xarray as xr
+
+from biome_index import BiomeIndex
+from biome_maps import FONT_PATH, biome_window, figure_job, render_figures, wrap_grid
+from metric_store import open_metrics
+from regrid import Regridder
+
+BIOME_NAMES = {
+    1: 'Boreal Forests/Taiga',
+    2: 'Deserts & Xeric Shrublands',
+    3: 'Flooded Grasslands & Savannas',
+    4: 'Mangroves',
+    5: 'Mediterranean Forests, Woodlands & Scrub',
+    6: 'Montane Grasslands & Shrublands',
+    7: 'Rock and Ice',
+    8: 'Temperate Broadleaf & Mixed Forests',
+    9: 'Temperate Conifer Forests',
+    10: 'Temperate Grasslands, Savannas & Shrublands',
+    11: 'Tropical & Subtropical Coniferous Forests',
+    12: 'Tropical & Subtropical Dry Broadleaf Forests',
+    13: 'Tropical & Subtropical Grasslands, Savannas & Shrublands',
+    14: 'Tropical & Subtropical Moist Broadleaf Forests',
+    15: 'Tundra',
+}
+
+# Variables not mapped per biome
+SKIP_VARIABLES = ('days_above_p95',)
+
+
+def render_metric_figures(metrics_path, biome_file, outdir='figures', variables=None,
+                          regrid_method='conservative', workers=None, force=False,
+                          font_path=FONT_PATH, biomes=None):
+    """Draw every biome's map of every 2-D metric.
+
+    Parameters
+    ----------
+    metrics_path : str
+        Metrics NetCDF file or metric store directory. A ``year`` dim, if
+        present, is averaged over.
+    biome_file : str
+        ``biomes.analog.gridded.nc``; maps are drawn on its grid, regridding
+        the metrics (``regrid_method``) when their grid differs.
+    variables : list of str, optional
+        Metrics to map (default: every 2-D metric but ``SKIP_VARIABLES``).
+    workers, force, font_path
+        See ``biome_maps.render_figures``.
+    biomes : list of int, optional
+        ``BIOME_ID`` values to draw (default: all).
+
+    Returns
+    -------
+    list of str
+        Figures rendered (up-to-date figures are skipped).
+    """
+    raw_ds = open_metrics(metrics_path, decode_timedelta=False)
+    clim_ds = raw_ds.mean(dim='year', keep_attrs=True) if 'year' in raw_ds.dims else raw_ds
+    lat_name = 'latitude' if 'latitude' in clim_ds.dims else 'lat'
+    lon_name = 'longitude' if 'longitude' in clim_ds.dims else 'lon'
+    if variables is None:
+        variables = [v for v, da in clim_ds.data_vars.items()
+                     if da.dims == (lat_name, lon_name) and v not in SKIP_VARIABLES]
+
+    biome_ds = xr.open_dataset(biome_file)
+
+    # Put the metrics on the biome grid. The weights are built once per pair
+    # of grids and reused from regrid_weights/ afterwards
+    if not (np.array_equal(clim_ds[lat_name].values, biome_ds.lat.values)
+            and np.array_equal(clim_ds[lon_name].values, biome_ds.lon.values)):
+        print(f"Regridding metrics onto the biome grid ({regrid_method})...")
+        regridder = Regridder.cached(clim_ds[lat_name].values, clim_ds[lon_name].values,
+                                     biome_ds.lat.values, biome_ds.lon.values, regrid_method)
+        clim_ds = regridder.apply_dataset(clim_ds[variables])
+
+    # Columns in -180..180 order, so the projected mesh has no dateline seam
+    lon_order, lon = wrap_grid(biome_ds.lon.values)
+    lat = biome_ds.lat.values
+
+    # Biome membership is indexed once; the p15/p85 contour ranges of every
+    # biome come from a single sort per variable instead of a global mask per biome
+    biome_index = BiomeIndex(biome_ds['BIOME_ID'].values[:, lon_order])
+    clim_values = {var: clim_ds[var].values[:, lon_order] for var in variables}
+    contour_range = {var: dict(zip(biome_index.ids,
+                                   biome_index.percentiles(clim_values[var], [15, 85],
+                                                           method='closest_observation')))
+                     for var in variables}
+
+    groups = []
+    for b, biome in BIOME_NAMES.items():
+        if b not in biome_index.ids or (biomes is not None and b not in biomes):
+            continue
+        print(b, biome)
+
+        # Each map covers only its biome's extent
+        rows, cols, extent = biome_window(biome_index.cells_of(b), lat, lon)
+        jobs = []
+        for var in variables:
+            # 15th and 85th percentiles, rounded to a tenth, as contour limits
+            lo, hi = np.round(contour_range[var][b], 1)
+            if lo >= hi:
+                print(f"  {var}: Skipping - p15={lo} >= p85={hi} (no range)")
+                continue
+            levels = np.linspace(lo, hi, 11)
+            print(f"  {var}: p15={lo}, p85={hi}")
+
+            units = raw_ds[var].attrs.get('units', '')
+            long_name = raw_ds[var].attrs.get('long_name', var)
+
+            # Expand to the full grid only for plotting, then crop to the biome window
+            values = biome_index.scatter(clim_values[var], b)[rows, cols]
+            jobs.append(figure_job(f'{outdir}/biome.{b:02d}.{var}.png', values, levels,
+                                   biome + f" and {long_name}", units, rows, cols, extent))
+        groups.append(jobs)
+
+    return render_figures(groups, lat, lon, outdir=outdir, workers=workers,
+                          font_path=font_path, force=force)
@@ -0,0 +1,242 @@
+"""Parallel, incremental rendering of the per-biome metric maps.
+
+Every ``figures/biome.XX.<var>.png`` used to be drawn serially, and each one
+rebuilt the Robinson projection, re-read and re-projected the 50 m
+coastline/state/border features and reprojected a full-grid ``contourf``.
+Here figures are rendered by a process pool, one task per biome:
+
+* each worker projects the grid mesh to Robinson once, so ``contourf`` runs
+  directly in map coordinates;
+* the basemap (ocean fill and boundary lines) is drawn once per worker and
+  map extent, then laid over each figure as an RGBA image;
+* each map is cropped to its biome's data extent, so only that part of the
+  grid is contoured;
+* a manifest of content hashes lets unchanged figures be skipped.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from year_cache import array_digest
+
+# Bump when the figure layout changes, to re-render everything once
+RENDER_VERSION = 1
+
+FIGSIZE = (9, 5)
+DPI = 500
+GLOBAL_EXTENT = (-180, 180, -90, 90)
+FONT_PATH = '/glade/work/jsallen/conda-envs/earth/fonts/Avenir-Medium.otf'
+MANIFEST = '.render_manifest.json'
+
+# Per-worker state, set by _init_worker
+_mesh = None
+_basemaps = {}
+_features = None
+
+
+def wrap_grid(lon):
+    """Column order that puts ``lon`` in ascending -180..180 form.
+
+    Returns ``(order, wrapped_lon)``; apply ``order`` to the last axis of
+    every field so the projected mesh has no seam at the dateline.
+    """
+    wrapped = (np.asarray(lon) + 180) % 360 - 180
+    order = np.argsort(wrapped, kind='stable')
+    return order, wrapped[order]
+
+
+def biome_window(cells, lat, lon, margin=2.0):
+    """Row/column slices and lon/lat extent covering a biome's cells.
+
+    ``cells`` are flat ``(lat, lon)`` indices on the wrapped grid. The
+    extent is padded by ``margin`` degrees and falls back to the global
+    extent when the biome spans the globe anyway.
+    """
+    n_lon = len(lon)
+    rows, cols = cells // n_lon, cells % n_lon
+    r0, r1 = rows.min(), rows.max()
+    c0, c1 = cols.min(), cols.max()
+    lat_lo, lat_hi = sorted((lat[r0], lat[r1]))
+    extent = (max(lon[c0] - margin, -180), min(lon[c1] + margin, 180),
+              max(lat_lo - margin, -90), min(lat_hi + margin, 90))
+    if extent[1] - extent[0] > 300:
+        extent = GLOBAL_EXTENT[:2] + extent[2:]
+    if extent[3] - extent[2] > 140:
+        extent = extent[:2] + GLOBAL_EXTENT[2:]
+    extent = tuple(float(e) for e in extent)
+
+    # Grid window covering the extent plus one cell, so contours reach its edge
+    def _window(coord, lo, hi):
+        inside = np.flatnonzero((coord >= lo) & (coord <= hi))
+        return slice(int(max(inside.min() - 1, 0)), int(min(inside.max() + 2, len(coord))))
+
+    return _window(lat, extent[2], extent[3]), _window(lon, extent[0], extent[1]), extent
+
+
+# =============================================================================
+# Worker side
+# =============================================================================
+
+def _init_worker(lat, lon, font_path):
+    global _mesh, _features
+    import matplotlib
+    matplotlib.use('Agg')
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    import matplotlib.font_manager as font_manager
+    import matplotlib.pyplot as plt
+
+    if font_path and os.path.exists(font_path):
+        font_manager.fontManager.addfont(font_path)
+        prop = font_manager.FontProperties(fname=font_path)
+        plt.rcParams['font.family'] = 'sans-serif'
+        plt.rcParams['font.sans-serif'] = prop.get_name()
+
+    X, Y = np.meshgrid(lon, lat)
+    xyz = ccrs.Robinson().transform_points(ccrs.PlateCarree(), X, Y)
+    _mesh = (xyz[..., 0], xyz[..., 1])
+    # Built once, so Natural Earth geometries are read and projected once per worker
+    _features = [
+        (cfeature.OCEAN, {'facecolor': 'gainsboro'}),
+        (cfeature.COASTLINE.with_scale('50m'), {'linewidths': 0.3}),
+        (cfeature.STATES.with_scale('50m'), {'linewidths': 0.3}),
+        (cfeature.BORDERS.with_scale('50m'), {'linewidths': 0.3}),
+    ]
+
+
+def _map_axes(fig, extent):
+    import cartopy.crs as ccrs
+    ax = fig.add_subplot(111, projection=ccrs.Robinson())
+    fig.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.15)
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    return ax
+
+
+def _basemap(extent, dpi):
+    """RGBA image of the basemap features over the axes box of ``extent``."""
+    key = (extent, dpi)
+    if key not in _basemaps:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=FIGSIZE)
+        ax = _map_axes(fig, extent)
+        fig.patch.set_alpha(0)
+        ax.patch.set_visible(False)
+        ax.spines['geo'].set_visible(False)
+        for feature, style in _features:
+            ax.add_feature(feature, **style)
+        fig.set_dpi(dpi)
+        fig.canvas.draw()
+        image = np.asarray(fig.canvas.buffer_rgba())
+        box = ax.get_window_extent()
+        height = image.shape[0]
+        rows = slice(int(round(height - box.y1)), int(round(height - box.y0)))
+        cols = slice(int(round(box.x0)), int(round(box.x1)))
+        _basemaps[key] = image[rows, cols].copy()
+        plt.close(fig)
+    return _basemaps[key]
+
+
+def render_biome(jobs):
+    """Render one biome's figures; returns ``(path, digest)`` of each success."""
+    import cartopy.crs as ccrs
+    import colormaps as cmaps
+    import matplotlib.pyplot as plt
+
+    pcrs = ccrs.Robinson()
+    done = []
+    for job in jobs:
+        rows, cols, extent = job['rows'], job['cols'], job['extent']
+        fig = plt.figure(figsize=FIGSIZE)
+        try:
+            ax = _map_axes(fig, extent)
+            cf = ax.contourf(_mesh[0][rows, cols], _mesh[1][rows, cols], job['values'],
+                             levels=job['levels'], cmap=cmaps.nice_gfdl, transform=pcrs,
+                             extend='both')
+            xlim, ylim = ax.get_xlim(), ax.get_ylim()
+            ax.imshow(_basemap(extent, job['dpi']), extent=(*xlim, *ylim), origin='upper',
+                      transform=pcrs, interpolation='nearest', zorder=2)
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+            ax.set_title(job['title'], fontsize=11, loc='left')
+
+            cbar_ax = fig.add_axes([0.20, 0.10, 0.60, 0.03])
+            plt.colorbar(cf, cax=cbar_ax, orientation='horizontal', label=job['units'])
+            tmp = job['path'] + '.tmp.png'
+            fig.savefig(tmp, dpi=job['dpi'])
+            os.replace(tmp, job['path'])
+            done.append((job['path'], job['digest']))
+        except Exception as e:
+            print(f"  ERROR plotting {job['path']}: {type(e).__name__}: {e}")
+        finally:
+            plt.close(fig)
+    return done
+
+
+# =============================================================================
+# Driver side
+# =============================================================================
+
+def figure_job(path, values, levels, title, units, rows, cols, extent, dpi=DPI):
+    """One figure: cropped field, contour levels, labels and its content hash."""
+    values = np.asarray(values, dtype=np.float32)
+    levels = np.asarray(levels, dtype=np.float64)
+    meta = json.dumps([RENDER_VERSION, title, units, [float(e) for e in extent], dpi,
+                       rows.start, rows.stop, cols.start, cols.stop])
+    digest = array_digest(values, levels, np.frombuffer(meta.encode(), dtype=np.uint8))
+    return {'path': path, 'values': values, 'levels': levels, 'title': title, 'units': units,
+            'rows': rows, 'cols': cols, 'extent': tuple(float(e) for e in extent),
+            'dpi': dpi, 'digest': digest}
+
+
+def _load_manifest(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def render_figures(groups, lat, lon, outdir='figures', workers=None, font_path=FONT_PATH,
+                   force=False):
+    """Render ``groups`` (lists of ``figure_job`` dicts) on a process pool.
+
+    Figures whose file exists and whose content hash matches the manifest in
+    ``outdir`` are skipped unless ``force`` is set. ``lat``/``lon`` are the
+    wrapped grid of the jobs' row/column windows.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    manifest_path = os.path.join(outdir, MANIFEST)
+    manifest = _load_manifest(manifest_path)
+
+    def stale(job):
+        return (force or not os.path.exists(job['path'])
+                or manifest.get(os.path.basename(job['path'])) != job['digest'])
+
+    groups = [[job for job in jobs if stale(job)] for jobs in groups]
+    groups = [jobs for jobs in groups if jobs]
+    n_jobs = sum(len(jobs) for jobs in groups)
+    if n_jobs == 0:
+        print("  All figures up to date")
+        return []
+
+    workers = min(workers or os.cpu_count(), len(groups))
+    print(f"  Rendering {n_jobs} figures on {workers} workers...")
+    t0 = time.perf_counter()
+    rendered = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(lat, lon, font_path)) as pool:
+        # Largest biomes first, so the pool drains evenly
+        order = sorted(groups, key=lambda jobs: -sum(j['values'].size for j in jobs))
+        for done in pool.map(render_biome, order):
+            for path, digest in done:
+                manifest[os.path.basename(path)] = digest
+                rendered.append(path)
+            tmp = f'{manifest_path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp, manifest_path)
+    print(f"  {len(rendered)} figures in {time.perf_counter() - t0:.1f} s")
+    return rendered
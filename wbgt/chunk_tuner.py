@@ -0,0 +1,273 @@
+"""Dask chunk shapes for the daily stack, from its on-disk layout and a memory budget.
+
+How the stack is cut into dask chunks decides both parallelism and how often
+each compressed on-disk chunk is decoded. ``tune_chunks`` reads the HDF5
+chunk shape recorded in the ``era5_index`` sidecar and picks:
+
+* for time reductions (every per-cell metric): whole-longitude latitude
+  bands spanning a year, at least ``TASKS_PER_WORKER`` bands per worker,
+  with the band's accumulator state and one loaded block within the
+  worker's share of the budget. Full rows keep each band contiguous on the
+  packed land-cell axis, so ``plan_tiles`` can give each worker whole bands;
+* for spatial reductions: full-grid slabs of consecutive days.
+
+Band edges and slab lengths are rounded to whole on-disk chunks. When the
+files are chunked against the access pattern (typically one full-grid chunk
+per day, read by many bands), every on-disk chunk is decoded once per band
+on every pass. If that re-reading costs more than writing the stack once in
+the tuned layout, the plan asks for ``rechunk_stack`` to write an
+intermediate copy (deflated float32, about the size of the source) and the
+passes read that instead:
+
+    index = load_index('wbgtmax_ERA5_index.json', files)
+    plan = tune_chunks(disk_layout(index), 16 * 1024**3, workers=32)
+    if plan.rechunk:
+        files = rechunk_stack(index, 'wbgt_rechunked', plan.disk_chunks)
+    da = open_indexed(sidecar, files, chunks=plan.chunks)['wbgtmax']
+"""
+
+import json
+import os
+
+import numpy as np
+
+from execution import TASKS_PER_WORKER
+from streaming import BLOCK_BYTES_PER_VALUE
+
+REDUCTIONS = ('time', 'space')
+
+# Cost of writing the intermediate copy and reading it back, in reads of the
+# source stack; rechunking pays off when the extra decodes exceed it
+REWRITE_COST = 2.0
+
+# Largest on-disk chunk written by ``rechunk_stack`` (uncompressed bytes)
+MAX_DISK_CHUNK_BYTES = 64 * 1024 ** 2
+
+MANIFEST = 'rechunk.json'
+
+
+def disk_layout(index):
+    """Dimensions, per-file shape and on-disk chunk shape of an indexed stack.
+
+    Files that cannot be read chunk by chunk (no h5py, unsupported filters)
+    count as one chunk per file.
+    """
+    dims = index['dims']
+    spatial = [len(index['spatial'][d]) for d in dims if d != 'time']
+    n_time = max(len(e['time']) for e in index['files'])
+    layout = index['files'][0]['layout']
+    shape = [n_time] + spatial
+    return {
+        'dims': dims,
+        'shape': shape,
+        'n_files': len(index['files']),
+        'chunk_shape': list(layout['chunk_shape']) if layout else shape,
+        'itemsize': np.dtype(layout['dtype']).itemsize if layout else 4,
+        'compressed': bool(layout and layout['filters']),
+    }
+
+
+def _edges(n, size):
+    return [(a, min(a + size, n)) for a in range(0, n, max(1, int(size)))]
+
+
+def read_amplification(shape, disk_chunks, chunks):
+    """On-disk chunk decodes per chunk stored, when reading in ``chunks``.
+
+    1.0 means every on-disk chunk is decoded once; a day-per-chunk file read
+    in ten latitude bands gives 10.
+    """
+    total = 1.0
+    for n, disk, size in zip(shape, disk_chunks, chunks):
+        reads = 0
+        for a, b in _edges(n, disk):
+            reads += sum(1 for c, d in _edges(n, size) if c < b and a < d) * (b - a)
+        total *= reads / n
+    return total
+
+
+def _align(value, step, limit):
+    """``value`` rounded down to whole on-disk chunks of ``step``, where possible."""
+    if value >= limit:
+        return int(limit)
+    return int(value if step > value else value // step * step)
+
+
+class ChunkPlan:
+    """Dask chunking chosen by ``tune_chunks``.
+
+    Attributes
+    ----------
+    chunks : dict
+        Dask chunk length per dimension, for ``open_indexed(chunks=...)``.
+    disk_chunks : list of int
+        On-disk chunk shape the chunks are read from: the source's, or the
+        intermediate's when ``rechunk`` is set.
+    amplification : float
+        Decodes per on-disk chunk of the source layout.
+    rechunk : bool
+        Whether the stack should be rewritten with ``rechunk_stack`` first.
+    worker_budget : int
+        Bytes each concurrent task may use.
+    """
+
+    def __init__(self, reduction, chunks, disk_chunks, amplification, rechunk, workers,
+                 worker_budget):
+        self.reduction = reduction
+        self.chunks = chunks
+        self.disk_chunks = disk_chunks
+        self.amplification = amplification
+        self.rechunk = rechunk
+        self.workers = workers
+        self.worker_budget = worker_budget
+
+    def as_dict(self):
+        return {'reduction': self.reduction, 'chunks': self.chunks,
+                'disk_chunks': self.disk_chunks, 'amplification': round(self.amplification, 3),
+                'rechunk': self.rechunk, 'workers': self.workers,
+                'worker_budget': self.worker_budget}
+
+    def __repr__(self):
+        return f'ChunkPlan({self.as_dict()})'
+
+
+def tune_chunks(layout, memory_budget, workers=1, reduction='time', passes=2,
+                state_bytes_per_cell=0, allow_rechunk=True):
+    """Chunk shape of the stack for ``workers`` concurrent tasks.
+
+    Parameters
+    ----------
+    layout : dict
+        From ``disk_layout``.
+    memory_budget : int
+        Bytes for all workers together; each task gets an equal share, half
+        of it for accumulator state and half for its loaded block (as in
+        ``streaming.plan_tiles``).
+    workers : int
+        Concurrent tasks.
+    reduction : {'time', 'space'}
+        Reduce over time per cell (latitude bands) or over the grid per day
+        (full-grid slabs).
+    passes : int
+        Reads of the stack by the run, to weigh re-reading against a rewrite.
+    state_bytes_per_cell : int
+        Accumulator bytes per grid cell of a time reduction (per land cell
+        times the land fraction for a land-packed run).
+    allow_rechunk : bool
+        If False, never plan an intermediate copy.
+
+    Returns
+    -------
+    ChunkPlan
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"Unknown reduction {reduction!r}; expected one of {REDUCTIONS}")
+    dims, shape, disk = layout['dims'], layout['shape'], layout['chunk_shape']
+    n_time, n_rows, n_cols = shape
+    workers = max(1, int(workers))
+    worker_budget = int(memory_budget // workers)
+    half = worker_budget // 2
+
+    if reduction == 'time':
+        # Bands: enough for every worker, each with its state in half the share
+        rows = -(-n_rows // (workers * TASKS_PER_WORKER)) if workers > 1 else n_rows
+        if state_bytes_per_cell:
+            rows = min(rows, max(1, half // (state_bytes_per_cell * n_cols)))
+        # ... and at least one day of the band in the other half
+        rows = max(1, min(rows, half // (n_cols * BLOCK_BYTES_PER_VALUE)))
+        steps = int(min(n_time, max(1, half // (rows * n_cols * BLOCK_BYTES_PER_VALUE))))
+        wanted = [steps, rows, n_cols]
+    else:
+        steps = int(max(1, half // (n_rows * n_cols * BLOCK_BYTES_PER_VALUE)))
+        steps = min(steps, -(-n_time // workers) if workers > 1 else n_time)
+        wanted = [steps, n_rows, n_cols]
+    target = [_align(w, d, n) for w, d, n in zip(wanted, disk, shape)]
+
+    amplification = read_amplification(shape, disk, target)
+    rechunk = allow_rechunk and passes * (amplification - 1) > REWRITE_COST
+    disk_chunks = list(disk)
+    if rechunk:
+        target = wanted
+        disk_chunks = list(target)
+        # Split the time axis of the new chunks to bound each chunk's decode
+        while (disk_chunks[0] > 1 and np.prod(disk_chunks) * layout['itemsize']
+               > MAX_DISK_CHUNK_BYTES):
+            disk_chunks[0] = -(-disk_chunks[0] // 2)
+    chunks = {d: int(c) for d, c in zip(dims, target)}
+    return ChunkPlan(reduction, chunks, [int(c) for c in disk_chunks], amplification, rechunk,
+                     workers, worker_budget)
+
+
+def rechunk_stack(index, directory, disk_chunks, memory_budget=None, variable=None):
+    """Copy every indexed file to ``directory`` with ``disk_chunks`` on disk.
+
+    Copies whose source fingerprint and chunk shape match ``rechunk.json``
+    are kept, so only new or changed years are rewritten. Each file is read
+    in latitude bands of whole output chunks that fit ``memory_budget``
+    (default: the whole file at once) and written one band at a time.
+
+    Returns
+    -------
+    list of str
+        Paths of the copies, in the order of the index.
+    """
+    import dask.array as dsa
+    import netCDF4
+    import xarray as xr
+
+    from era5_index import read_file_variable
+
+    variable = variable or index['variable']
+    dims = index['dims']
+    spatial = {d: np.asarray(index['spatial'][d]) for d in dims if d != 'time'}
+    meta = index['meta']
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    paths = []
+    for entry in index['files']:
+        path = os.path.join(directory, os.path.basename(entry['path']))
+        paths.append(path)
+        record = {'size': entry['size'], 'mtime_ns': entry['mtime_ns'],
+                  'chunks': list(disk_chunks)}
+        if manifest.get(entry['path']) == record and os.path.exists(path):
+            continue
+        print(f"  Rechunking {os.path.basename(entry['path'])} to {tuple(disk_chunks)}")
+
+        shape = [len(entry['time'])] + [len(v) for v in spatial.values()]
+        chunks = [min(c, s) for c, s in zip(disk_chunks, shape)]
+        rows = shape[1]
+        if memory_budget is not None:
+            # Source block, its decoded copy and the write buffer; whole
+            # output chunks even if one exceeds the budget
+            fit = memory_budget // (3 * 4 * shape[0] * shape[2])
+            rows = max(chunks[1], _align(fit, chunks[1], shape[1]))
+        ds = xr.Dataset(
+            {variable: (dims, dsa.zeros(shape, chunks=chunks, dtype=np.float32), meta['attrs'])},
+            coords={'time': np.asarray(entry['time'], dtype=np.int64).astype('datetime64[ns]'),
+                    **{d: xr.Variable(d, v, meta['coord_attrs'].get(d, {}))
+                       for d, v in spatial.items()}})
+        for key in ('_FillValue', 'missing_value', 'scale_factor', 'add_offset'):
+            ds[variable].attrs.pop(key, None)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        # Coordinates and metadata only; the bands are written below
+        ds.to_netcdf(tmp, compute=False,
+                     encoding={variable: {'zlib': True, 'complevel': 1, 'shuffle': True,
+                                          'chunksizes': tuple(chunks)}})
+        for a, b in _edges(shape[1], rows):
+            band = read_file_variable(entry, variable, (slice(None), slice(a, b), slice(None)))
+            # HDF5 holds written chunks until the file is closed, so each
+            # band gets a session of its own
+            with netCDF4.Dataset(tmp, 'a') as nc:
+                nc[variable].set_auto_maskandscale(False)
+                nc[variable][:, a:b, :] = band
+            del band
+        os.replace(tmp, path)
+        manifest[entry['path']] = record
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+    return paths
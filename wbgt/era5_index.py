@@ -0,0 +1,316 @@
+"""Reference sidecar for the yearly ERA5 NetCDF stack.
+
+``xr.open_mfdataset`` opens and decodes every file and cross-checks their
+coordinates before anything is computed, which takes minutes on the shared
+filesystem. ``build_index`` does that work once and records, per file, its
+fingerprint, time values and HDF5 chunk byte layout in a JSON sidecar.
+``open_indexed`` then builds the lazy dataset from the sidecar alone (only a
+``stat`` per file) and reads chunks straight from their byte offsets.
+
+Files whose size or mtime changed, and files added to or removed from the
+glob, are re-indexed automatically the next time the index is opened.
+"""
+
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+import xarray as xr
+
+try:
+    import h5py
+except ImportError:  # byte-level reads need h5py; without it files are read whole
+    h5py = None
+
+INDEX_VERSION = 1
+
+# HDF5 filter ids that the byte-level reader can undo
+H5Z_DEFLATE, H5Z_SHUFFLE, H5Z_FLETCHER32 = 1, 2, 3
+SUPPORTED_FILTERS = {H5Z_DEFLATE, H5Z_SHUFFLE, H5Z_FLETCHER32}
+
+# CF attributes applied when decoding raw chunks
+DECODE_ATTRS = ('_FillValue', 'missing_value', 'scale_factor', 'add_offset')
+
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _plain(value):
+    """JSON-safe copy of a NetCDF attribute value."""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _chunk_layout(path, variable):
+    """Byte layout of ``variable`` in ``path``, or None if it can't be read raw."""
+    if h5py is None:
+        return None
+    with h5py.File(path, 'r') as f:
+        dset = f[variable]
+        plist = dset.id.get_create_plist()
+        filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        if not set(filters) <= SUPPORTED_FILTERS:
+            return None
+        layout = {'dtype': dset.dtype.str, 'shape': list(dset.shape), 'filters': filters,
+                  'attrs': {k: _plain(dset.attrs[k]) for k in DECODE_ATTRS if k in dset.attrs}}
+        if dset.chunks is None:
+            layout['chunk_shape'] = list(dset.shape)
+            layout['chunks'] = [[[0] * dset.ndim, dset.id.get_offset(), dset.id.get_storage_size(), 0]]
+            layout['filters'] = []
+        else:
+            layout['chunk_shape'] = list(dset.chunks)
+            layout['chunks'] = []
+            for i in range(dset.id.get_num_chunks()):
+                info = dset.id.get_chunk_info(i)
+                layout['chunks'].append([list(info.chunk_offset), info.byte_offset,
+                                         info.size, info.filter_mask])
+    return layout
+
+
+def _index_file(path, variable):
+    """Sidecar entry, spatial coordinates and attributes of one file."""
+    with xr.open_dataset(path) as ds:
+        da = ds[variable]
+        entry = {
+            'path': os.path.abspath(path),
+            **_fingerprint(path),
+            'time': da['time'].values.astype('datetime64[ns]').astype(np.int64).tolist(),
+            'layout': _chunk_layout(path, variable),
+        }
+        grid = {'dims': list(da.dims),
+                'spatial': {d: np.asarray(da[d].values).tolist() for d in da.dims if d != 'time'}}
+        meta = {'attrs': {k: _plain(v) for k, v in da.attrs.items()},
+                'coord_attrs': {d: {k: _plain(v) for k, v in da[d].attrs.items()}
+                                for d in da.dims}}
+    return entry, grid, meta
+
+
+def build_index(files, sidecar, variable='wbgtmax', previous=None):
+    """Index ``files`` (a glob or list) and write the JSON sidecar.
+
+    Entries in ``previous`` whose fingerprint still matches are reused, so
+    only new or changed files are opened. Every file must share one grid;
+    that check happens here instead of on every open.
+    """
+    paths = sorted(glob.glob(files)) if isinstance(files, str) else sorted(files)
+    if not paths:
+        raise FileNotFoundError(f"No input files match {files!r}")
+    reuse = {}
+    if previous is not None and previous.get('variable') == variable:
+        reuse = {e['path']: e for e in previous['files']
+                 if os.path.exists(e['path'])
+                 and {k: e[k] for k in ('size', 'mtime_ns')} == _fingerprint(e['path'])}
+
+    entries = []
+    grid = meta = None
+    if any(os.path.abspath(p) in reuse for p in paths):
+        grid = {'dims': previous['dims'], 'spatial': previous['spatial']}
+        meta = previous['meta']
+    for path in paths:
+        if os.path.abspath(path) in reuse:
+            entries.append(reuse[os.path.abspath(path)])
+            continue
+        print(f"  Indexing {os.path.basename(path)}")
+        entry, file_grid, file_meta = _index_file(path, variable)
+        if grid is None:
+            grid, meta = file_grid, file_meta
+        elif file_grid != grid:
+            raise ValueError(f"{path} does not share the grid of the other indexed files")
+        entries.append(entry)
+    entries.sort(key=lambda e: e['time'][0])
+
+    index = {'version': INDEX_VERSION, 'variable': variable, **grid, 'meta': meta,
+             'files': entries}
+    tmp = f'{sidecar}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, sidecar)
+    return index
+
+
+def _is_stale(index, files):
+    """True if any indexed file changed, or the set of ``files`` differs."""
+    if files is not None:
+        paths = sorted(glob.glob(files)) if isinstance(files, str) else files
+        if sorted(os.path.abspath(p) for p in paths) != sorted(e['path'] for e in index['files']):
+            return True
+    for e in index['files']:
+        try:
+            if {k: e[k] for k in ('size', 'mtime_ns')} != _fingerprint(e['path']):
+                return True
+        except FileNotFoundError:
+            return True
+    return False
+
+
+def load_index(sidecar, files=None, variable='wbgtmax'):
+    """Read the sidecar, re-indexing any files that changed since it was built."""
+    index = None
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION or index.get('variable') != variable:
+            index = None
+
+    if index is not None:
+        if not _is_stale(index, files):
+            return index
+        print(f"Input files changed since {sidecar} was built; updating index...")
+        if files is None:
+            files = [e['path'] for e in index['files'] if os.path.exists(e['path'])]
+    elif files is None:
+        raise FileNotFoundError(f"No index at {sidecar} and no input files given")
+    else:
+        print(f"Building index {sidecar}...")
+    return build_index(files, sidecar, variable, previous=index)
+
+
+# =============================================================================
+# Reading chunks from byte offsets
+# =============================================================================
+
+def _unshuffle(raw, itemsize):
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def _decode_chunk(raw, filters, filter_mask, itemsize):
+    """Undo the HDF5 filter pipeline (applied in reverse order on read)."""
+    for i, fid in reversed(list(enumerate(filters))):
+        if filter_mask & (1 << i):
+            continue
+        if fid == H5Z_FLETCHER32:
+            raw = raw[:-4]
+        elif fid == H5Z_DEFLATE:
+            raw = zlib.decompress(raw)
+        elif fid == H5Z_SHUFFLE:
+            raw = _unshuffle(raw, itemsize)
+    return raw
+
+
+def _cf_decode(values, attrs):
+    """Mask fill values and apply scale/offset as xarray's decoding does."""
+    out_dtype = np.float32
+    if 'scale_factor' in attrs or 'add_offset' in attrs:
+        scale = np.asarray(attrs.get('scale_factor', 1.0))
+        out_dtype = np.result_type(np.float32, scale.dtype)
+    out = values.astype(out_dtype)
+    for key in ('_FillValue', 'missing_value'):
+        if key in attrs:
+            for fill in np.atleast_1d(attrs[key]):
+                out[values == fill] = np.nan
+    if 'scale_factor' in attrs:
+        out *= np.asarray(attrs['scale_factor'], dtype=out_dtype)
+    if 'add_offset' in attrs:
+        out += np.asarray(attrs['add_offset'], dtype=out_dtype)
+    return out
+
+
+def read_file_variable(entry, variable, region=None):
+    """Decoded ``(time, ...)`` array of one indexed file.
+
+    ``region`` (a tuple of slices with unit step) limits the read to part of
+    the file; only the HDF5 chunks that intersect it are read and decoded.
+    """
+    layout = entry['layout']
+    if layout is None:
+        with xr.open_dataset(entry['path']) as ds:
+            da = ds[variable] if region is None else ds[variable][region]
+            return da.values.astype(np.float32)
+
+    dtype = np.dtype(layout['dtype'])
+    shape, chunk_shape = layout['shape'], layout['chunk_shape']
+    if region is None:
+        region = tuple(slice(0, s) for s in shape)
+    region = tuple(slice(*r.indices(s)[:2]) for r, s in zip(region, shape))
+    raw_values = np.empty([r.stop - r.start for r in region], dtype=dtype)
+    with open(entry['path'], 'rb') as f:
+        fd = f.fileno()
+        for origin, offset, size, mask in layout['chunks']:
+            # Part of the chunk inside both the array and the region; edge
+            # chunks are stored full-size
+            part = tuple(slice(max(o, r.start), min(o + c, s, r.stop))
+                         for o, c, s, r in zip(origin, chunk_shape, shape, region))
+            if any(p.start >= p.stop for p in part):
+                continue
+            raw = _decode_chunk(os.pread(fd, size, offset), layout['filters'], mask, dtype.itemsize)
+            chunk = np.frombuffer(raw, dtype=dtype).reshape(chunk_shape)
+            raw_values[tuple(slice(p.start - r.start, p.stop - r.start)
+                             for p, r in zip(part, region))] = \
+                chunk[tuple(slice(p.start - o, p.stop - o) for p, o in zip(part, origin))]
+    return _cf_decode(raw_values, layout['attrs'])
+
+
+def _chunk_edges(n, size):
+    size = n if size is None or size <= 0 else int(size)
+    return [(a, min(a + size, n)) for a in range(0, n, size)]
+
+
+def open_indexed(sidecar, files=None, variable='wbgtmax', chunks=None):
+    """Lazy dataset of the indexed stack, one dask chunk per file by default.
+
+    Parameters
+    ----------
+    sidecar : str
+        Index path; built from ``files`` if missing or stale.
+    files : str or list, optional
+        Glob or paths of the stack. When given, added or removed files also
+        trigger a re-index.
+    variable : str
+        Variable to expose.
+    chunks : dict, optional
+        Dask chunk length per dimension (``time`` counts within each file;
+        missing or None for the whole extent), e.g. from
+        ``chunk_tuner.tune_chunks``. Each chunk reads only the on-disk
+        chunks it overlaps.
+
+    Returns
+    -------
+    xr.Dataset
+        Same layout as ``xr.open_mfdataset(files)[[variable]]``.
+    """
+    import dask
+    import dask.array as dsa
+
+    index = load_index(sidecar, files, variable)
+    dims = index['dims']
+    spatial_dims = [d for d in dims if d != 'time']
+    spatial_shape = [len(index['spatial'][d]) for d in spatial_dims]
+    chunks = dict(chunks or {})
+
+    blocks, times = [], []
+    read = dask.delayed(read_file_variable, pure=True)
+    for entry in index['files']:
+        n = len(entry['time'])
+        if not chunks:
+            blocks.append(dsa.from_delayed(read(entry, variable), shape=[n] + spatial_shape,
+                                           dtype=np.float32))
+        else:
+            edges = [_chunk_edges(size, chunks.get(d))
+                     for d, size in zip(dims, [n] + spatial_shape)]
+
+            def grid(level, region):
+                if level == len(dims):
+                    return dsa.from_delayed(
+                        read(entry, variable, tuple(slice(a, b) for a, b in region)),
+                        shape=[b - a for a, b in region], dtype=np.float32)
+                return [grid(level + 1, region + [edge]) for edge in edges[level]]
+
+            blocks.append(dsa.block(grid(0, [])))
+        times.append(np.asarray(entry['time'], dtype=np.int64))
+
+    data = dsa.concatenate(blocks, axis=dims.index('time'))
+    meta = index['meta']
+    coords = {'time': np.concatenate(times).astype('datetime64[ns]')}
+    for d in spatial_dims:
+        coords[d] = xr.Variable(d, np.asarray(index['spatial'][d]), meta['coord_attrs'].get(d, {}))
+    da = xr.DataArray(data, coords=coords, dims=dims, name=variable, attrs=meta['attrs'])
+    return da.to_dataset()
@@ -0,0 +1,164 @@
+"""Where the independent tasks of a run execute.
+
+The metric tiles of ``metric_registry.compute_metrics`` share nothing but
+their inputs, so they can run side by side. An ``ExecutionBackend`` runs
+such tasks on one of:
+
+* ``synchronous``: one at a time in this process (for debugging);
+* ``threads``: a thread pool; numpy, h5py decoding and zlib release the GIL
+  for most of a tile's work;
+* ``processes``: a process pool, for the Python-level work that does not;
+* ``distributed``: a ``dask.distributed`` LocalCluster whose workers are
+  held to ``worker_memory`` (paused, spilled and restarted by the nanny).
+
+Inside each task dask computes synchronously, so ``workers`` is the number
+of tiles in flight and each one stays within ``worker_budget``:
+
+    with ExecutionBackend('processes', workers=8) as backend:
+        results = backend.map(square, [(1,), (2,), (3,)])
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from run_report import current_stage, peak_rss, reset_peak_rss
+
+BACKENDS = ('synchronous', 'threads', 'processes', 'distributed')
+
+# Tasks per worker when work is split for a pool, for load balance
+TASKS_PER_WORKER = 2
+
+# Share of a distributed worker's memory limit a task may plan for; the
+# nanny starts spilling at 60% and pausing at 80%
+WORKER_MEMORY_FRACTION = 0.6
+
+
+def _run_task(payload):
+    """Run a ``(fn, args)`` task, cloudpickled for the process-based backends.
+
+    Returns the result, the task's wall time and, in a process of its own,
+    its peak RSS. There dask is set to its synchronous scheduler here; in
+    this process ``ExecutionBackend.map`` sets it once around all tasks.
+    """
+    import cloudpickle
+    import dask
+
+    fn, args = cloudpickle.loads(payload) if isinstance(payload, bytes) else payload
+    isolated = not isinstance(payload, tuple)
+    t0 = time.perf_counter()
+    if isolated:
+        reset_peak_rss()
+        with dask.config.set(scheduler='synchronous'):
+            result = fn(*args)
+    else:
+        result = fn(*args)
+    return result, time.perf_counter() - t0, peak_rss() if isolated else None
+
+
+class ExecutionBackend:
+    """Pool of ``workers`` running tasks of one kind of backend.
+
+    Parameters
+    ----------
+    kind : {'synchronous', 'threads', 'processes', 'distributed'}
+        How tasks run.
+    workers : int, optional
+        Concurrent tasks (default: one per CPU; always 1 for
+        ``synchronous``).
+    worker_memory : int, optional
+        Bytes per worker. Caps ``worker_budget``, and is the memory limit of
+        each ``distributed`` worker.
+    threads_per_worker : int
+        Threads of each ``distributed`` worker.
+    """
+
+    def __init__(self, kind='threads', workers=None, worker_memory=None, threads_per_worker=1):
+        if kind not in BACKENDS:
+            raise ValueError(f"Unknown backend {kind!r}; expected one of {BACKENDS}")
+        self.kind = kind
+        self.workers = 1 if kind == 'synchronous' else max(1, int(workers or os.cpu_count()))
+        self.worker_memory = worker_memory
+        self.threads_per_worker = threads_per_worker
+        self._pool = None
+        self._cluster = None
+
+    def __repr__(self):
+        return f'ExecutionBackend({self.kind!r}, workers={self.workers})'
+
+    def worker_budget(self, memory_budget):
+        """Bytes one task may use when ``memory_budget`` is shared by every worker."""
+        budget = int(memory_budget // self.workers)
+        if self.worker_memory:
+            budget = min(budget, int(self.worker_memory * WORKER_MEMORY_FRACTION))
+        return budget
+
+    def __enter__(self):
+        if self.kind == 'threads':
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        elif self.kind == 'processes':
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        elif self.kind == 'distributed':
+            try:
+                from distributed import Client, LocalCluster
+            except ImportError as err:
+                raise ImportError("The 'distributed' backend needs dask.distributed "
+                                  "(pip install distributed)") from err
+            self._cluster = LocalCluster(
+                n_workers=self.workers, threads_per_worker=self.threads_per_worker,
+                memory_limit=self.worker_memory or 'auto', processes=True)
+            self._pool = Client(self._cluster)
+            print(f"  Dask dashboard: {self._pool.dashboard_link}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.kind in ('threads', 'processes'):
+            self._pool.shutdown(cancel_futures=exc_type is not None)
+        elif self.kind == 'distributed':
+            self._pool.close()
+            self._cluster.close()
+        self._pool = self._cluster = None
+        return False
+
+    def map(self, fn, jobs):
+        """``[fn(*args) for args in jobs]``, run on the backend, in order.
+
+        ``fn`` and its arguments may hold lambdas and dask graphs; they are
+        cloudpickled for the process-based backends. A summary of the task
+        times (and per-task peak RSS, where measurable) goes into the
+        current ``run_report`` stage.
+        """
+        import cloudpickle
+        import dask
+
+        if self.kind in ('synchronous', 'threads'):
+            payloads = [(fn, tuple(args)) for args in jobs]
+            # dask's config is process-wide: set in each thread, the tasks
+            # would restore each other's values out of order
+            with dask.config.set(scheduler='synchronous'):
+                if self.kind == 'synchronous':
+                    done = [_run_task(p) for p in payloads]
+                else:
+                    done = list(self._pool.map(_run_task, payloads))
+        else:
+            payloads = [cloudpickle.dumps((fn, tuple(args))) for args in jobs]
+            if self.kind == 'distributed':
+                futures = self._pool.map(_run_task, payloads, pure=False)
+                done = self._pool.gather(futures)
+            else:
+                done = list(self._pool.map(_run_task, payloads))
+
+        seconds = [s for _, s, _ in done]
+        peaks = [p for _, _, p in done if p is not None]
+        stage = current_stage()
+        if stage is not None and done:
+            stage.info['execution'] = {
+                'backend': self.kind, 'workers': self.workers, 'tasks': len(done),
+                'task_seconds': round(sum(seconds), 4), 'max_task_seconds': round(max(seconds), 4),
+            }
+            if peaks:
+                stage.info['execution']['max_task_peak_rss'] = max(peaks)
+        if self.worker_memory and peaks and max(peaks) > self.worker_memory:
+            print(f"  Warning: a task peaked at {max(peaks) / 1024**2:.0f} MB, over the "
+                  f"{self.worker_memory / 1024**2:.0f} MB worker memory")
+        return [result for result, _, _ in done]
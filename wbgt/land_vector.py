@@ -0,0 +1,157 @@
+"""Packed land-only layout of the global grid.
+
+About 70% of the 601x1440 grid is ocean (``BIOME_ID == -1`` in
+``biomes.analog.gridded.nc``). A ``LandVector`` stores the flat indices of
+the land cells once; fields are packed to a 1-D ``cell`` axis for every
+computation and scattered back to the full grid only when a NetCDF or
+GeoTIFF is written.
+"""
+
+import numpy as np
+
+
+def align_biomes(biome_ds, lat, lon, lat_name='lat', lon_name='lon', variable='BIOME_ID'):
+    """``BIOME_ID`` of ``biome_ds`` on the ``lat``/``lon`` cell centres.
+
+    The biome raster uses -180..180 longitudes; ERA5 may use 0..360. Cells
+    are matched to the nearest biome cell within half a grid spacing.
+    """
+    ids = biome_ds[variable]
+    lon = np.asarray(lon)
+    if lon.min() >= 0 and float(ids[lon_name].min()) < 0:
+        ids = ids.assign_coords({lon_name: ids[lon_name] % 360}).sortby(lon_name)
+    tol = 0.5 * float(np.abs(np.diff(ids[lat_name].values[:2]))[0])
+    return ids.sel({lat_name: np.asarray(lat), lon_name: lon}, method='nearest', tolerance=tol)
+
+
+def _pack_block(block, parts, block_info=None):
+    """Land cells of one ``(..., rows, lon)`` block; ``parts`` holds each row band's."""
+    part = parts[block_info[0]['chunk-location'][-2]]
+    return block.reshape(block.shape[:-2] + (-1,))[..., part]
+
+
+class LandVector:
+    """Gather/scatter index between a ``(lat, lon)`` grid and its land cells.
+
+    Parameters
+    ----------
+    mask : array-like of bool, shape (lat, lon)
+        True on land cells.
+    lat, lon : array-like
+        Grid coordinates.
+    dims : tuple of str
+        Names of the latitude and longitude dimensions of the full grid.
+    """
+
+    def __init__(self, mask, lat, lon, dims=('lat', 'lon')):
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+        self.index = np.flatnonzero(mask)
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.dims = tuple(dims)
+
+    @classmethod
+    def from_biomes(cls, biome_ds, lat=None, lon=None, dims=None):
+        """Land cells of the biome raster, optionally on another lat/lon grid."""
+        if lat is None:
+            lat, lon = biome_ds['lat'].values, biome_ds['lon'].values
+            ids = biome_ds['BIOME_ID']
+        else:
+            ids = align_biomes(biome_ds, lat, lon)
+        if dims is None:
+            dims = tuple(getattr(c, 'name', None) or d for c, d in ((lat, 'lat'), (lon, 'lon')))
+        values = ids.values
+        return cls(np.isfinite(values) & (values >= 1), np.asarray(lat), np.asarray(lon), dims)
+
+    @property
+    def n_land(self):
+        return len(self.index)
+
+    @property
+    def mask(self):
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[self.index] = True
+        return mask.reshape(self.shape)
+
+    @property
+    def cell_lat(self):
+        return self.lat[self.index // self.shape[1]]
+
+    @property
+    def cell_lon(self):
+        return self.lon[self.index % self.shape[1]]
+
+    # -------------------------------------------------------------------------
+    # numpy
+    # -------------------------------------------------------------------------
+
+    def pack(self, values):
+        """``(..., lat, lon)`` array -> ``(..., cell)`` land values."""
+        values = np.asarray(values)
+        return values.reshape(values.shape[:-2] + (-1,))[..., self.index]
+
+    def unpack(self, packed, fill_value=np.nan):
+        """``(..., cell)`` land values -> ``(..., lat, lon)`` with ``fill_value`` elsewhere."""
+        packed = np.asarray(packed)
+        dtype = np.result_type(packed.dtype, np.min_scalar_type(fill_value))
+        out = np.full(packed.shape[:-1] + (int(np.prod(self.shape)),), fill_value, dtype=dtype)
+        out[..., self.index] = packed
+        return out.reshape(packed.shape[:-1] + self.shape)
+
+    # -------------------------------------------------------------------------
+    # xarray
+    # -------------------------------------------------------------------------
+
+    def pack_dataarray(self, da):
+        """``(..., lat, lon)`` DataArray -> ``(..., cell)``; stays lazy if dask-backed.
+
+        Dask chunks of whole rows (latitude bands) each become one chunk of
+        their land cells, so the bands stay separate along ``cell``.
+        """
+        import xarray as xr
+        lead = list(da.dims[:-2])
+        data = da.data
+        chunks = getattr(data, 'chunks', None)
+        if chunks is not None and len(chunks[-1]) == 1:
+            rows = np.cumsum((0,) + chunks[-2]) * self.shape[1]
+            parts = [self.index[(self.index >= a) & (self.index < b)] - a
+                     for a, b in zip(rows[:-1], rows[1:])]
+            data = data.map_blocks(_pack_block, parts, drop_axis=data.ndim - 1,
+                                   chunks=chunks[:-2] + (tuple(len(p) for p in parts),),
+                                   dtype=data.dtype)
+        else:
+            data = data.reshape(da.shape[:-2] + (-1,))[..., self.index]
+        coords = {d: da[d] for d in lead if d in da.coords}
+        coords['cell'] = self.index
+        coords[self.dims[0]] = ('cell', self.cell_lat)
+        coords[self.dims[1]] = ('cell', self.cell_lon)
+        return xr.DataArray(data, coords=coords, dims=lead + ['cell'], name=da.name,
+                            attrs=da.attrs)
+
+    def unpack_dataarray(self, da, fill_value=np.nan):
+        """``(..., cell)`` DataArray -> full ``(..., lat, lon)`` grid."""
+        import xarray as xr
+        lead = [d for d in da.dims if d != 'cell']
+        values = self.unpack(da.transpose(*lead, 'cell').values, fill_value)
+        coords = {d: da[d] for d in lead if d in da.coords}
+        coords[self.dims[0]] = self.lat
+        coords[self.dims[1]] = self.lon
+        return xr.DataArray(values, coords=coords, dims=lead + list(self.dims), name=da.name,
+                            attrs=da.attrs)
+
+    # -------------------------------------------------------------------------
+    # Storage
+    # -------------------------------------------------------------------------
+
+    def save(self, path):
+        np.savez(path, index=self.index, shape=self.shape, lat=self.lat, lon=self.lon,
+                 dims=np.array(self.dims))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            mask = np.zeros(int(np.prod(npz['shape'])), dtype=bool)
+            mask[npz['index']] = True
+            return cls(mask.reshape(tuple(npz['shape'])), npz['lat'], npz['lon'],
+                       tuple(str(d) for d in npz['dims']))
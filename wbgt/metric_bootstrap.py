@@ -0,0 +1,245 @@
+"""Year-block bootstrap confidence intervals from per-year metric cubes.
+
+Resampling years with replacement only changes how much each year counts,
+so a bootstrap replicate of a multi-year mean is a weighted mean of the
+per-year values. All replicates of every cell come from one matrix product
+of a ``(replicates, years)`` weight matrix with the ``(years, cells)`` cube
+written with ``keep_years=True``; the daily data are not read again.
+Consecutive years can be drawn in blocks (moving-block bootstrap) to keep
+interannual persistence.
+
+Analog distances are resampled the same way: both cells of a pair take
+their replicate metric values, are standardized with the index's fixed
+mean/std/weights, and give one distance per replicate. Variables without a
+per-year cube (p95) keep their point value.
+
+    python metric_bootstrap.py --yearly wbgt_yearly_metrics.nc -n 1000
+    python metric_bootstrap.py --lat 40.0 --lon -105.25 -k 10
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from analog_index import AnalogIndex
+from metric_store import open_metrics
+
+DEFAULT_LEVELS = (0.025, 0.975)
+
+# Cells per chunk when ranking replicates, bounding each (replicates, cells) block
+CELL_CHUNK = 16384
+
+
+def resampling_weights(n_years, replicates=1000, block_length=1, seed=0):
+    """``(replicates, years)`` weights of a (moving-block) bootstrap.
+
+    Each row draws ``n_years`` years as runs of ``block_length``
+    consecutive years with random starts, and holds how often each year was
+    drawn divided by ``n_years``, so rows sum to one.
+    """
+    rng = np.random.default_rng(seed)
+    block_length = int(min(max(block_length, 1), n_years))
+    n_blocks = -(-n_years // block_length)
+    starts = rng.integers(0, n_years - block_length + 1, size=(replicates, n_blocks))
+    drawn = (starts[:, :, None] + np.arange(block_length)).reshape(replicates, -1)[:, :n_years]
+    rows = np.repeat(np.arange(replicates), n_years)
+    counts = np.bincount(rows * n_years + drawn.ravel(), minlength=replicates * n_years)
+    return (counts.reshape(replicates, n_years) / n_years).astype(np.float32)
+
+
+def bootstrap_replicates(values, weights):
+    """Replicate multi-year means of a ``(year, ...)`` array: ``(replicates, ...)``.
+
+    NaN years are left out per cell and the remaining weights renormalised;
+    a replicate that drew only NaN years of a cell is NaN.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    shape = values.shape[1:]
+    flat = values.reshape(len(values), -1)
+    valid = ~np.isnan(flat)
+    out = weights @ np.where(valid, flat, np.float32(0))
+    if not valid.all():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out /= weights @ valid.astype(np.float32)
+    return out.reshape((len(weights),) + shape)
+
+
+def _quantiles(reps, levels):
+    """Linear-interpolated quantiles over axis 0 of ``(replicates, cells)``.
+
+    Cells without NaN replicates need only the bracketing order statistics,
+    found with one partition of a cell-major copy; the rest use nanquantile.
+    """
+    out = np.full((len(levels), reps.shape[1]), np.nan, dtype=np.float32)
+    complete = ~np.isnan(reps).any(axis=0)
+    if complete.any():
+        pos = np.asarray(levels, dtype=np.float64) * (len(reps) - 1)
+        lo, hi = np.floor(pos).astype(int), np.ceil(pos).astype(int)
+        ranked = np.partition(np.ascontiguousarray(reps[:, complete].T),
+                              np.unique(np.concatenate([lo, hi])), axis=1)
+        frac = (pos - lo)[:, None]
+        out[:, complete] = ranked[:, lo].T * (1 - frac) + ranked[:, hi].T * frac
+    partial = ~complete & ~np.isnan(reps).all(axis=0)
+    if partial.any():
+        out[:, partial] = np.nanquantile(reps[:, partial], levels, axis=0)
+    return out
+
+
+def bootstrap_intervals(values, weights, levels=DEFAULT_LEVELS, chunk=CELL_CHUNK, workers=None):
+    """Bootstrap quantiles and standard error of every cell's multi-year mean.
+
+    Returns ``(len(levels), ...)`` quantiles and the ``(...)`` standard
+    deviation of the replicates, both float32. Cells are processed in
+    chunks, on ``workers`` threads, so only ``replicates x chunk`` values
+    per thread are held at once; cells that are NaN every year are skipped.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    shape = values.shape[1:]
+    flat = values.reshape(len(values), -1)
+    cells = np.flatnonzero(~np.isnan(flat).all(axis=0))
+    quantiles = np.full((len(levels), flat.shape[1]), np.nan, dtype=np.float32)
+    stderr = np.full(flat.shape[1], np.nan, dtype=np.float32)
+
+    def run(chunk_cells):
+        reps = bootstrap_replicates(flat[:, chunk_cells], weights)
+        quantiles[:, chunk_cells] = _quantiles(reps, levels)
+        with np.errstate(invalid='ignore'):
+            stderr[chunk_cells] = np.nanstd(reps, axis=0)
+
+    chunks = [cells[i:i + chunk] for i in range(0, len(cells), chunk)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(run, chunks))
+    return quantiles.reshape((len(levels),) + shape), stderr.reshape(shape)
+
+
+def open_yearly(path):
+    """Per-year cubes from ``wbgt_yearly_metrics.nc`` (or its store).
+
+    Day counts have ``units='days'``; xarray would decode them to
+    timedelta64 and the uint16 fill to NaT, so they are read as numbers,
+    with NaN off land.
+    """
+    return open_metrics(path, decode_timedelta=False)
+
+
+def bootstrap_dataset(cubes, replicates=1000, block_length=1, levels=DEFAULT_LEVELS, seed=0,
+                      workers=None):
+    """Confidence intervals of the multi-year mean of every per-year cube.
+
+    Parameters
+    ----------
+    cubes : dict of str -> xr.DataArray, or xr.Dataset
+        ``(year, ...)`` cubes, as returned with ``keep_years=True`` or read
+        from ``wbgt_yearly_metrics.nc``.
+
+    Returns
+    -------
+    xr.Dataset
+        ``<name>_ci`` with a ``level`` dimension and ``<name>_se``.
+    """
+    out = {}
+    weights = None
+    for name, cube in dict(cubes).items():
+        if 'year' not in cube.dims:
+            continue
+        cube = cube.transpose('year', ...)
+        # A timedelta decode leaves fill cells as NaT (or its int64 sentinel)
+        if cube.dtype.kind == 'm' or (cube.dtype.kind in 'iu' and '_FillValue' in cube.encoding):
+            raise ValueError(f"{name} was decoded without its fill value masked "
+                             f"({cube.dtype}); open the cubes with open_yearly")
+        if weights is None:
+            weights = resampling_weights(cube.sizes['year'], replicates, block_length, seed)
+        dims = list(cube.dims[1:])
+        coords = {d: cube[d] for d in cube.coords if set(cube[d].dims) <= set(dims)}
+        quantiles, stderr = bootstrap_intervals(cube.values, weights, levels, workers=workers)
+        common = {k: cube.attrs[k] for k in ('units', 'grid_mapping') if k in cube.attrs}
+        out[f'{name}_ci'] = xr.DataArray(
+            quantiles, coords={'level': list(levels), **coords}, dims=['level'] + dims,
+            attrs={'long_name': f'Bootstrap quantiles of the multi-year mean of {name}', **common})
+        out[f'{name}_se'] = xr.DataArray(
+            stderr, coords=coords, dims=dims,
+            attrs={'long_name': f'Bootstrap standard error of the multi-year mean of {name}',
+                   **common})
+    return xr.Dataset(out, attrs={'replicates': replicates, 'block_length': block_length,
+                                  'seed': seed})
+
+
+def bootstrap_distances(index, cubes, rows, analog_rows, weights, levels=DEFAULT_LEVELS):
+    """Bootstrap quantiles of analog feature distances.
+
+    Parameters
+    ----------
+    index : AnalogIndex
+        Supplies the variables, standardization and the point values.
+    cubes : dict of str -> xr.DataArray, or xr.Dataset
+        ``(year, lat, lon)`` cubes on the index grid.
+    rows, analog_rows : array-like of int
+        Index rows of each pair's two cells.
+    weights : ndarray
+        ``(replicates, years)`` resampling weights.
+
+    Returns
+    -------
+    ndarray
+        ``(len(levels), pairs)`` distance quantiles.
+    """
+    rows, analog_rows = np.atleast_1d(rows), np.atleast_1d(analog_rows)
+    both = np.concatenate([rows, analog_rows])
+    cells = index.cells[both]
+    features = np.empty((len(weights), len(both), len(index.variables)), dtype=np.float32)
+    for j, v in enumerate(index.variables):
+        if v in cubes and 'year' in cubes[v].dims:
+            cube = cubes[v].transpose('year', ...).values
+            per_year = cube.reshape(len(cube), -1)[:, cells]
+            reps = bootstrap_replicates(per_year, weights)
+        else:
+            reps = np.broadcast_to(index.values[both, j], (len(weights), len(both)))
+        features[:, :, j] = (reps - index.mean[j]) / index.std[j] * index.weights[j]
+    diff = features[:, :len(rows)] - features[:, len(rows):]
+    return _quantiles(np.sqrt((diff * diff).sum(axis=2)), levels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--yearly', default='wbgt_yearly_metrics.nc')
+    parser.add_argument('--index', default='wbgt_analog_index.npz')
+    parser.add_argument('-n', '--replicates', type=int, default=1000)
+    parser.add_argument('--block-length', type=int, default=1,
+                        help='consecutive years per resampled block')
+    parser.add_argument('--levels', type=float, nargs='+', default=list(DEFAULT_LEVELS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='wbgt_bootstrap_ci.nc')
+    parser.add_argument('--lat', type=float, help='report analog distance intervals instead')
+    parser.add_argument('--lon', type=float)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    cubes = open_yearly(args.yearly)
+    if args.lat is None:
+        ds = bootstrap_dataset(cubes, args.replicates, args.block_length, args.levels, args.seed,
+                               args.workers)
+        ds.to_netcdf(args.output)
+        print(f"Bootstrap intervals of {len(ds.data_vars) // 2} metrics -> {args.output}")
+        return
+
+    index = AnalogIndex.load(args.index)
+    row = index.locate(args.lat, args.lon)
+    analogs, dist = index.nearest(index.features[row], k=args.k,
+                                  biomes=[int(index.biome[row])], exclude=row)
+    analogs, dist = analogs[0][analogs[0] >= 0], dist[0][analogs[0] >= 0]
+    weights = resampling_weights(cubes.sizes['year'], args.replicates, args.block_length,
+                                 args.seed)
+    ci = bootstrap_distances(index, cubes, np.full(len(analogs), row), analogs, weights,
+                             args.levels)
+    table = index.describe(analogs, dist)
+    for level, values in reversed(list(zip(args.levels, ci))):
+        table.insert(table.columns.get_loc('distance') + 1, f'distance_q{level:g}', values)
+    print(table.to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,749 @@
+"""Declarative metric registry and fused streaming evaluation.
+
+A ``Metric`` names the per-year accumulators it needs and how one year's
+accumulated state becomes that year's value; the multi-year value is the
+mean over years, skipping years without data. ``compute_metrics`` merges the
+accumulators of every requested metric, so a metric that shares a threshold
+count or a sum with another costs nothing extra, and every metric of a
+variable comes from the same reads of the source data:
+
+* pass 1 feeds every fixed-threshold accumulator and, if any metric needs a
+  quantile, one multi-year quantile sketch;
+* pass 2 runs only when a metric depends on a quantile (a quantile itself,
+  or a count above a per-cell quantile). With exact quantiles, counts above
+  them come from the values collected to resolve the quantile; other
+  quantile-relative state needs one more read.
+
+Run-length state (heat spells) is joined across year boundaries in year
+order, so spells longer than a block or a year are counted whole. Calendar
+windows (seasons, months) get their own copy of every first-pass
+accumulator, fed from the same blocks with the days outside the window
+masked out. Both
+passes are reduced one year at a time and each year's state can be
+cached with ``YearCache``. New metrics only need registering:
+
+    register(Metric('days_above_35C', attrs, [Exceedance(35)],
+                    lambda s: s['exceed_35']))
+"""
+
+import numpy as np
+import xarray as xr
+
+from execution import TASKS_PER_WORKER, ExecutionBackend
+from run_report import current_stage
+from streaming import DEFAULT_MEMORY_BUDGET, iter_time_blocks, plan_tiles
+from streaming_quantiles import make_sketch, sketch_bytes_per_cell
+from year_cache import array_digest
+
+# Bump when the layout of cached per-year state changes
+STATE_VERSION = 2
+
+# Calendar windows (name -> months). As with groupby('time.season'), DJF
+# takes January, February and December of the same calendar year.
+SEASONS = {'DJF': (12, 1, 2), 'MAM': (3, 4, 5), 'JJA': (6, 7, 8), 'SON': (9, 10, 11)}
+MONTHS = {name: (i + 1,) for i, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+
+# =============================================================================
+# Accumulators
+# =============================================================================
+# An accumulator reduces one year of (time, cells) blocks to a few per-cell
+# arrays. It is described by an immutable spec; its state is a plain dict of
+# arrays, which is also what gets cached. Specs with equal keys are shared.
+
+class Accumulator:
+    """Base class of per-year accumulator specs."""
+
+    #: 1 if fed on the first pass, 2 if it needs the first pass's quantiles
+    stage = 1
+    #: per-cell bytes of state, for tile planning
+    bytes_per_cell = 8
+
+    @property
+    def key(self):
+        raise NotImplementedError
+
+    @property
+    def quantile(self):
+        """Quantile this accumulator depends on, if any."""
+        return None
+
+    def init(self, n_cells):
+        raise NotImplementedError
+
+    def update(self, state, block, fields):
+        """Fold a ``(time, cells)`` block into ``state``.
+
+        ``fields`` maps quantiles to their per-cell values on pass 2.
+        """
+        raise NotImplementedError
+
+    #: True if runs in the state continue across year boundaries (see stitch)
+    stitched = False
+
+    def stitch(self, prev, state, carry):
+        """Join what runs on across the boundary between two consecutive years.
+
+        Called in year order with the previous year's state (None before
+        the first year), this year's state (None after the last year or
+        before a gap) and what ran on to the end of ``prev``; updates either
+        state and returns what runs on to the end of ``state``. A year's
+        values are only taken once the following year has been joined.
+        """
+        return None
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.key == other.key
+
+    def __hash__(self):
+        return hash((type(self), self.key))
+
+
+class SumCount(Accumulator):
+    """Sum and count of valid values."""
+
+    bytes_per_cell = 12
+    key = 'sum_count'
+
+    def init(self, n_cells):
+        return {'sum': np.zeros(n_cells, dtype=np.float64),
+                'count': np.zeros(n_cells, dtype=np.int32)}
+
+    def update(self, state, block, fields):
+        valid = ~np.isnan(block)
+        state['sum'] += np.where(valid, block, 0).sum(axis=0, dtype=np.float64)
+        state['count'] += valid.sum(axis=0, dtype=np.int32)
+
+
+class Exceedance(Accumulator):
+    """Count of values ``>=`` a fixed threshold or a per-cell quantile.
+
+    NaN compares False, matching ``xr.where(da >= thr, 1, np.nan).sum()``.
+    """
+
+    bytes_per_cell = 4
+
+    def __init__(self, threshold=None, quantile=None):
+        if (threshold is None) == (quantile is None):
+            raise ValueError("Give exactly one of threshold or quantile")
+        self.threshold = threshold
+        self._quantile = quantile
+        self.stage = 1 if quantile is None else 2
+
+    @property
+    def key(self):
+        if self._quantile is not None:
+            return f'exceed_q{self._quantile:g}'
+        return f'exceed_{self.threshold:g}'
+
+    @property
+    def quantile(self):
+        return self._quantile
+
+    def init(self, n_cells):
+        return {self.key: np.zeros(n_cells, dtype=np.int32)}
+
+    def update(self, state, block, fields):
+        thr = self.threshold if self._quantile is None else fields[self._quantile]
+        state[self.key] += (block >= thr).sum(axis=0, dtype=np.int32)
+
+
+class Spells(Accumulator):
+    """Runs of consecutive days ``>=`` a fixed threshold.
+
+    A spell is a run of at least ``min_days`` days. Per year, the state
+    holds the longest run, the number and total length of spells, and the
+    open runs at either end of the year (``lead``, ``trail``; ``full`` when
+    no day of the year was below the threshold), so only one block is ever
+    in memory. ``stitch`` joins runs across year boundaries, and a spell
+    counts in the year of its last day.
+    """
+
+    bytes_per_cell = 28
+    stitched = True
+
+    def __init__(self, threshold, min_days=1):
+        self.threshold = threshold
+        self.min_days = max(1, int(min_days))
+
+    @property
+    def key(self):
+        return f'spell_{self.threshold:g}_{self.min_days}d'
+
+    def _names(self):
+        return {k: f'{self.key}_{k}' for k in
+                ('lead', 'trail', 'full', 'longest', 'spells', 'spell_days')}
+
+    def init(self, n_cells):
+        n = self._names()
+        state = {n[k]: np.zeros(n_cells, dtype=np.int32)
+                 for k in ('lead', 'trail', 'longest', 'spells', 'spell_days')}
+        state[n['full']] = np.ones(n_cells, dtype=bool)
+        return state
+
+    def _record(self, state, cells, lengths):
+        """Count finished runs of ``lengths`` days in ``cells``."""
+        n = self._names()
+        size = len(state[n['longest']])
+        np.maximum.at(state[n['longest']], cells, lengths.astype(np.int32))
+        spell = lengths >= self.min_days
+        state[n['spells']] += np.bincount(cells[spell], minlength=size).astype(np.int32)
+        state[n['spell_days']] += np.bincount(cells[spell], weights=lengths[spell],
+                                              minlength=size).astype(np.int32)
+
+    def _record_where(self, state, lengths, ended):
+        cells = np.flatnonzero(ended)
+        self._record(state, cells, lengths[cells])
+
+    def update(self, state, block, fields):
+        n = self._names()
+        hot = block >= self.threshold
+        full, trail = state[n['full']], state[n['trail']]
+        n_steps, n_cells = hot.shape
+
+        # The run open at the end of the previous block ends if this one starts cool
+        ended = (trail > 0) & ~hot[0]
+        state[n['lead']] = np.where(ended & full, trail, state[n['lead']])
+        self._record_where(state, trail, ended & ~full)
+
+        # Runs of the block from the edges of a cell-major mask padded with a
+        # cool day on either side: only the runs themselves are visited
+        padded = np.zeros((n_cells, n_steps + 2), dtype=bool)
+        padded[:, 1:-1] = hot.T
+        edges = np.flatnonzero(padded[:, 1:] != padded[:, :-1])
+        # Every row starts and ends cool, so edges alternate start, stop
+        starts, stops = edges[0::2], edges[1::2]
+        cells = starts // (n_steps + 1)
+        first = starts % (n_steps + 1) == 0
+        lengths = stops - starts + np.where(first, trail[cells], 0)
+        still_open = stops % (n_steps + 1) == n_steps
+        lead = first & full[cells] & ~still_open
+
+        state[n['lead']][cells[lead]] = lengths[lead]
+        done = ~still_open & ~lead
+        self._record(state, cells[done], lengths[done])
+        new_trail = np.zeros(n_cells, dtype=np.int32)
+        new_trail[cells[still_open]] = lengths[still_open]
+        state[n['trail']] = new_trail
+        state[n['full']] = full & hot.all(axis=0)
+
+    def stitch(self, prev, state, carry):
+        n = self._names()
+        if carry is None:
+            carry = 0
+        if state is None:
+            self._record_where(prev, np.broadcast_to(carry, prev[n['trail']].shape), carry > 0)
+            return None
+        lead, full = state[n['lead']], state[n['full']]
+        if prev is not None:
+            # A run open at the end of the previous year that did not go on
+            self._record_where(prev, np.broadcast_to(carry, lead.shape),
+                               (carry > 0) & (lead == 0) & ~full)
+        self._record_where(state, carry + lead, (lead > 0) & ~full)
+        return np.where(full, carry + state[n['trail']], state[n['trail']])
+
+
+# =============================================================================
+# Metrics
+# =============================================================================
+
+class Metric:
+    """A registered output variable.
+
+    Parameters
+    ----------
+    name : str
+        Output variable name.
+    attrs : dict
+        CF attributes.
+    accumulators : list of Accumulator
+        Per-year state the metric is computed from (all of one stage).
+    yearly : callable, optional
+        ``state -> (cells,) array``: the metric's value for one year, from
+        the merged state of its accumulators. NaN marks a year without data.
+    quantile : float, optional
+        For quantile metrics: the multi-year quantile of the data itself,
+        with no per-year value.
+    year_dtype : str
+        Storage type of the per-year values when they are kept; ``'uint16'``
+        for day counts, which are never NaN.
+    """
+
+    def __init__(self, name, attrs, accumulators=(), yearly=None, quantile=None,
+                 year_dtype='float32'):
+        self.name = name
+        self.attrs = dict(attrs)
+        self.accumulators = list(accumulators)
+        self.yearly = yearly
+        self.quantile = quantile
+        self.year_dtype = np.dtype(year_dtype)
+        stages = {a.stage for a in self.accumulators}
+        if len(stages) > 1:
+            raise ValueError(f"Metric {name!r} mixes first- and second-pass accumulators")
+        self.stage = stages.pop() if stages else 1
+        if (yearly is None) == (quantile is None):
+            raise ValueError(f"Metric {name!r} needs exactly one of yearly or quantile")
+
+    @property
+    def quantiles(self):
+        """Quantiles this metric needs from the first-pass sketch."""
+        qs = {a.quantile for a in self.accumulators if a.quantile is not None}
+        if self.quantile is not None:
+            qs.add(self.quantile)
+        return qs
+
+
+METRICS = {}
+
+
+def register(metric):
+    """Add ``metric`` to the registry (replacing one of the same name)."""
+    METRICS[metric.name] = metric
+    return metric
+
+
+def get_metrics(names):
+    """Registered metrics by name, in the given order."""
+    missing = [n for n in names if n not in METRICS]
+    if missing:
+        raise KeyError(f"Unregistered metrics: {missing}; known: {sorted(METRICS)}")
+    return [METRICS[n] for n in names]
+
+
+class YearMean:
+    """Running mean over years of per-year values, skipping NaN years.
+
+    With ``n_years``, every year's values are also kept, in the order they
+    are added, as a ``(year, cells)`` array of ``dtype``.
+    """
+
+    bytes_per_cell = 12
+
+    def __init__(self, n_cells, n_years=None, dtype=np.float32):
+        self.total = np.zeros(n_cells, dtype=np.float64)
+        self.n = np.zeros(n_cells, dtype=np.int32)
+        self.years = None if n_years is None else np.zeros((n_years, n_cells), dtype=dtype)
+        self._added = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        self.total += np.where(valid, values, 0)
+        self.n += valid
+        if self.years is not None:
+            self.years[self._added] = values
+        self._added += 1
+
+    def result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 0, self.total / self.n, np.nan)
+
+
+# =============================================================================
+# Planner
+# =============================================================================
+
+class MetricPlan:
+    """Accumulators and quantiles shared by a set of metrics."""
+
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        self.stage1 = self._unique(1)
+        self.stage2 = self._unique(2)
+        self.quantiles = sorted(set().union(*(m.quantiles for m in self.metrics)))
+
+    def _unique(self, stage):
+        specs = {}
+        for m in self.metrics:
+            for a in m.accumulators:
+                if a.stage == stage:
+                    specs.setdefault(a.key, a)
+        return list(specs.values())
+
+    def of_stage(self, stage, stitched=None):
+        return [m for m in self.metrics if m.yearly is not None and m.stage == stage
+                and (stitched is None or any(a.stitched for a in m.accumulators) == stitched)]
+
+    def state_bytes_per_cell(self, quantile_method, **sketch_kwargs):
+        n = sum(a.bytes_per_cell for a in self.stage1 + self.stage2)
+        # Stitched state is held back one year
+        n += sum(a.bytes_per_cell for a in self.stage1 if a.stitched)
+        n += YearMean.bytes_per_cell * len(self.metrics)
+        if self.quantiles:
+            # Per-year and multi-year sketches are held together while merging
+            n += 2 * sketch_bytes_per_cell(quantile_method, **sketch_kwargs)
+        return n
+
+
+def _accumulate(specs, n_cells, blocks, fields=None):
+    state = {}
+    for spec in specs:
+        state.update(spec.init(n_cells))
+    for block in blocks:
+        for spec in specs:
+            spec.update(state, block, fields)
+    return state
+
+
+def _window_part(block, inside, was_inside):
+    """Rows of ``block`` to feed a calendar window's accumulators.
+
+    Rows outside the window become NaN, and the run-breaking neighbour rows
+    just outside it are kept, so runs neither leave the window nor join
+    across a stretch outside it. Returns None when nothing is needed.
+    """
+    rows = np.flatnonzero(inside)
+    if not len(rows):
+        return np.full((1,) + block.shape[1:], np.nan, dtype=block.dtype) if was_inside else None
+    a, b = max(rows[0] - 1, 0), min(rows[-1] + 2, len(block))
+    part = block[a:b]
+    if not inside[a:b].all():
+        part = np.where(inside[a:b, None], part, np.nan)
+    return part
+
+
+def _accumulate_windows(specs, n_cells, blocks, windows):
+    """``_accumulate`` of ``(months, block)`` blocks, once for the whole year
+    and once per calendar window; window state keys are ``'<window>/<key>'``."""
+    state = {}
+    parts = {w: {} for w in windows}
+    for spec in specs:
+        state.update(spec.init(n_cells))
+        for w in windows:
+            parts[w].update(spec.init(n_cells))
+    was_inside = dict.fromkeys(windows, False)
+    for months, block in blocks:
+        for spec in specs:
+            spec.update(state, block, None)
+        for w, window_months in windows.items():
+            inside = np.isin(months, window_months)
+            part = _window_part(block, inside, was_inside[w])
+            was_inside[w] = bool(inside[-1])
+            if part is not None:
+                for spec in specs:
+                    spec.update(parts[w], part, None)
+    for w in windows:
+        state.update({f'{w}/{k}': v for k, v in parts[w].items()})
+    return state
+
+
+def _window_state(state, window):
+    prefix = f'{window}/'
+    return {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+
+
+def year_slices(da):
+    """``(year, slice)`` of the consecutive time steps of each calendar year."""
+    years = da['time'].dt.year.values
+    breaks = np.flatnonzero(np.diff(years)) + 1
+    return [(int(years[a]), slice(int(a), int(b)))
+            for a, b in zip(np.r_[0, breaks], np.r_[breaks, len(years)])]
+
+
+def _year_attrs(metric):
+    """Attributes of a metric's per-year cube."""
+    attrs = {k: v for k, v in metric.attrs.items() if k != 'description'}
+    attrs['long_name'] = f"{metric.name} of each year"
+    attrs['cell_methods'] = 'year: point'
+    return attrs
+
+
+def _window_attrs(metric, windows, window_dim):
+    """Attributes of a metric evaluated within calendar windows."""
+    attrs = dict(metric.attrs)
+    attrs['long_name'] = f"{metric.attrs.get('long_name', metric.name)}, by {window_dim}"
+    attrs[f'{window_dim}_months'] = '; '.join(
+        f"{w}: {','.join(str(int(m)) for m in months)}" for w, months in windows.items())
+    return attrs
+
+
+def _year_state(cache, compute, counts, **key_parts):
+    """Per-year state from ``cache`` when available, else ``compute()``.
+
+    ``counts`` tallies the years of each pass and how many of them were read.
+    """
+    name = key_parts['stage']
+    counts[f'{name}_years'] = counts.get(f'{name}_years', 0) + 1
+
+    def counted():
+        counts[f'{name}_years_read'] = counts.get(f'{name}_years_read', 0) + 1
+        return compute()
+
+    if cache is None:
+        return counted()
+    return cache.load_or_compute(cache.key(**key_parts), counted)
+
+
+def _tile_metrics(sub, tile, plan, quantile_method, max_steps, cache, key_base, sources,
+                  n_years, windows, sketch_kwargs):
+    """Every metric of ``plan`` on one tile ``sub`` of the last dimension.
+
+    Runs on its own (see ``execution.ExecutionBackend``), so everything it
+    needs is passed in and everything it produces is returned: ``values``
+    (metric -> flat values), ``years`` (metric -> ``(year, cell)`` values,
+    with ``n_years``), ``windows`` (window -> metric -> flat values) and the
+    ``counts`` of years read and reused.
+    """
+    metrics, qs = plan.metrics, plan.quantiles
+    windowed = plan.of_stage(1)
+    n_time = sub.sizes['time']
+    n_cells = int(np.prod([sub.sizes[d] for d in sub.dims if d != 'time']))
+    years = year_slices(sub)
+    means = {m.name: YearMean(n_cells, n_years, m.year_dtype)
+             for m in metrics if m.yearly is not None}
+    window_means = {w: {m.name: YearMean(n_cells) for m in windowed} for w in windows}
+    months = sub['time'].dt.month.values
+    tally = {}
+
+    def key_parts(stage, year, tslice, specs, **extra):
+        times = sub['time'].values[tslice]
+        return dict(key_base, stage=stage, year=year, tile=[tile.start, tile.stop],
+                    time=[str(times[0]), str(times[-1]), len(times)],
+                    source=sources.get(year), accumulators=sorted(a.key for a in specs),
+                    **extra)
+
+    def blocks(tslice):
+        for _, block in iter_time_blocks(sub.isel(time=tslice), max_steps=max_steps):
+            yield block.reshape(len(block), -1)
+
+    def calendar_blocks(tslice):
+        start = tslice.start
+        for block in blocks(tslice):
+            yield months[start:start + len(block)], block
+            start += len(block)
+
+    # Pass 1: fixed-threshold accumulators and the quantile sketch
+    sketch = make_sketch(quantile_method, n_cells, n_time, **sketch_kwargs) if qs else None
+    stitched = [spec for spec in plan.stage1 if spec.stitched]
+    views = [None] + list(windows)
+    carry = {w: {} for w in views}
+    pending = dict.fromkeys(views)
+    for y, (year, tslice) in enumerate(years):
+        def pass1():
+            year_sketch = (make_sketch(quantile_method, n_cells, n_time, **sketch_kwargs)
+                           if qs else None)
+
+            def sketched():
+                for block_months, block in calendar_blocks(tslice):
+                    if year_sketch is not None:
+                        year_sketch.update(block)
+                    yield block_months, block
+
+            state = _accumulate_windows(plan.stage1, n_cells, sketched(), windows)
+            if year_sketch is not None:
+                state.update(year_sketch.state())
+            return state
+
+        state = _year_state(cache, pass1, tally, **key_parts(
+            'pass1', year, tslice, plan.stage1, quantiles=qs))
+        last = y == len(years) - 1 or years[y + 1][0] != year + 1
+        for w in views:
+            view = state if w is None else _window_state(state, w)
+            target = means if w is None else window_means[w]
+            for m in plan.of_stage(1, stitched=False):
+                target[m.name].add(m.yearly(view))
+            if not stitched:
+                continue
+            # Runs are joined to the previous year, whose values are then final
+            held = {k: view[k] for spec in stitched for k in spec.init(0)}
+            for spec in stitched:
+                carry[w][spec.key] = spec.stitch(pending[w], held, carry[w].get(spec.key))
+            if pending[w] is not None:
+                for m in plan.of_stage(1, stitched=True):
+                    target[m.name].add(m.yearly(pending[w]))
+            pending[w] = held
+            if last:
+                for spec in stitched:
+                    spec.stitch(pending[w], None, carry[w].get(spec.key))
+                for m in plan.of_stage(1, stitched=True):
+                    target[m.name].add(m.yearly(pending[w]))
+                carry[w], pending[w] = {}, None
+        if sketch is not None:
+            sketch.merge(state)
+
+    # Pass 2: quantiles and everything counted against them
+    fields = {}
+    if qs and quantile_method == 'exact':
+        refiner = sketch.refiner(qs)
+        for y, (year, tslice) in enumerate(years):
+            def pass2():
+                parts = [refiner.collect(block) for block in blocks(tslice)]
+                return {name: (np.concatenate([p[name] for p in parts])
+                               if name.startswith(('cells_', 'values_'))
+                               else np.sum([p[name] for p in parts], axis=0))
+                        for name in parts[0]}
+
+            refiner.add(_year_state(cache, pass2, tally, **key_parts(
+                'pass2', year, tslice, [], brackets=refiner.digest)), tag=y)
+        values = refiner.quantiles()
+        fields = dict(zip(qs, values))
+        if plan.stage2:
+            # Counts above each quantile come per year from the collected
+            # brackets; any other second-pass state needs a third read
+            counts = refiner.count_at_or_above_by_tag(values, len(years))
+            others = [a for a in plan.stage2 if not isinstance(a, Exceedance)]
+            digest = array_digest(*values)
+            for y, (year, tslice) in enumerate(years):
+                state = {f'exceed_q{q:g}': counts[i, y] for i, q in enumerate(qs)}
+                if others:
+                    def pass3():
+                        return _accumulate(others, n_cells, blocks(tslice), fields)
+
+                    state.update(_year_state(cache, pass3, tally, **key_parts(
+                        'pass3', year, tslice, others, quantile_fields=digest)))
+                for m in plan.of_stage(2):
+                    means[m.name].add(m.yearly(state))
+    elif qs:
+        fields = dict(zip(qs, sketch.quantiles(qs)))
+        if plan.stage2:
+            digest = array_digest(*[fields[q] for q in qs])
+            for year, tslice in years:
+                def pass2():
+                    return _accumulate(plan.stage2, n_cells, blocks(tslice), fields)
+
+                state = _year_state(cache, pass2, tally, **key_parts(
+                    'pass2', year, tslice, plan.stage2, quantile_fields=digest))
+                for m in plan.of_stage(2):
+                    means[m.name].add(m.yearly(state))
+
+    return {
+        'values': {m.name: fields[m.quantile] if m.quantile is not None else means[m.name].result()
+                   for m in metrics},
+        'years': {name: mean.years for name, mean in means.items() if n_years is not None},
+        'windows': {w: {name: mean.result() for name, mean in window_means[w].items()}
+                    for w in windows},
+        'counts': tally,
+    }
+
+
+def metrics_state_bytes(metrics, n_years, quantile_method='exact', keep_years=False,
+                        windows=None, **sketch_kwargs):
+    """Bytes of accumulator state per cell of ``compute_metrics`` over ``n_years``."""
+    plan = MetricPlan(metrics)
+    n = plan.state_bytes_per_cell(quantile_method, **sketch_kwargs)
+    if keep_years:
+        n += n_years * sum(m.year_dtype.itemsize for m in metrics if m.yearly is not None)
+    n += len(windows or {}) * (sum(a.bytes_per_cell * (1 + a.stitched) for a in plan.stage1)
+                               + YearMean.bytes_per_cell * len(plan.of_stage(1)))
+    return n
+
+
+def compute_metrics(da, metrics, quantile_method='exact', memory_budget=DEFAULT_MEMORY_BUDGET,
+                    cache=None, sources=None, keep_years=False, windows=None,
+                    window_dim='season', backend=None, **sketch_kwargs):
+    """Evaluate ``metrics`` over ``da`` with shared accumulators.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        ``(time, ...)`` data, typically dask-backed and land-packed.
+    metrics : list of str or Metric
+        Registered metric names or ``Metric`` objects.
+    quantile_method : {'exact', 'histogram', 'tdigest'}
+        Quantile estimator, see ``streaming_quantiles``.
+    memory_budget : int
+        Peak bytes for accumulator state plus one loaded time block, shared
+        by the backend's workers.
+    cache : YearCache, optional
+        Store of per-year partial aggregates.
+    sources : dict, optional
+        Year -> source fingerprint, part of each cache key.
+    keep_years : bool
+        Also return every per-year metric for each year (see
+        ``metric_trends`` for trends and decadal means).
+    windows : dict of str -> sequence of int, optional
+        Calendar windows (name -> months, e.g. ``SEASONS`` or ``MONTHS``).
+        Every first-pass metric is also evaluated within each window, from
+        the same reads, as ``<name>_by_<window_dim>``. Quantile-based
+        metrics stay annual.
+    window_dim : str
+        Name of the window dimension.
+    backend : ExecutionBackend, optional
+        Runs the tiles (of whole dask chunks of the last dimension, at
+        least ``TASKS_PER_WORKER`` per worker); the default computes them
+        one after the other in this process.
+    **sketch_kwargs
+        Passed to the quantile sketch.
+
+    Returns
+    -------
+    fields : dict of str -> xr.DataArray
+        One field per metric, with its CF attributes.
+    yearly : dict of str -> xr.DataArray or None
+        With ``keep_years``, the ``(year, ...)`` cube of each per-year
+        metric in the metric's ``year_dtype``; None otherwise.
+    """
+    metrics = [m if isinstance(m, Metric) else METRICS[m] for m in metrics]
+    plan = MetricPlan(metrics)
+    spatial_dims = [d for d in da.dims if d != 'time']
+    shape = [da.sizes[d] for d in spatial_dims]
+    n_time = da.sizes['time']
+    sources = sources or {}
+    backend = backend or ExecutionBackend('synchronous')
+
+    all_years = [year for year, _ in year_slices(da)]
+    yearly = [m for m in metrics if m.yearly is not None] if keep_years else []
+    windows = dict(windows or {})
+    windowed = plan.of_stage(1)
+    state_bytes = metrics_state_bytes(metrics, len(all_years), quantile_method, keep_years,
+                                      windows, **sketch_kwargs)
+    min_tiles = backend.workers * TASKS_PER_WORKER if backend.workers > 1 else 1
+    tiles, max_steps = plan_tiles(da, state_bytes, backend.worker_budget(memory_budget),
+                                  min_tiles)
+    stage = current_stage()
+    if stage is not None:
+        stage.info.update(cells=int(np.prod(shape)), time_steps=n_time, tiles=len(tiles),
+                          max_block_steps=max_steps, state_bytes_per_cell=int(state_bytes))
+    key_base = {'version': STATE_VERSION, 'variable': da.name, 'shape': shape,
+                'quantile_method': quantile_method, 'sketch': sorted(sketch_kwargs.items())}
+    if windows:
+        key_base['windows'] = sorted((w, sorted(int(m) for m in months))
+                                     for w, months in windows.items())
+
+    out = {m.name: np.full(shape, np.nan, dtype=np.float32) for m in metrics}
+    cubes = {m.name: np.zeros([len(all_years)] + shape, dtype=m.year_dtype) for m in yearly}
+    by_window = {m.name: np.full([len(windows)] + shape, np.nan, dtype=np.float32)
+                 for m in windowed if windows}
+    jobs = [(da.isel({spatial_dims[-1]: tile}), tile, plan, quantile_method, max_steps, cache,
+             key_base, sources, len(all_years) if keep_years else None, windows, sketch_kwargs)
+            for tile in tiles]
+    results = backend.map(_tile_metrics, jobs)
+
+    # Run-report statistics come from each tile's values as they are placed
+    for tile, result in zip(tiles, results):
+        tile_shape = shape[:-1] + [tile.stop - tile.start]
+        index = (slice(None),) * (len(shape) - 1) + (tile,)
+        for m in metrics:
+            values = result['values'][m.name]
+            out[m.name][index] = np.reshape(values, tile_shape)
+            if stage is not None:
+                stage.summarize(m.name, values)
+        for m in yearly:
+            cubes[m.name][(slice(None),) + index] = result['years'][m.name].reshape(
+                [len(all_years)] + tile_shape)
+        for i, w in enumerate(windows):
+            for m in windowed:
+                values = result['windows'][w][m.name]
+                by_window[m.name][(i,) + index] = np.reshape(values, tile_shape)
+                if stage is not None:
+                    stage.summarize(f'{m.name}_by_{window_dim}', values)
+        if stage is not None:
+            for counter, n in result['counts'].items():
+                stage.count(counter, n)
+
+    coords = {d: da[d] for d in spatial_dims}
+    fields = {m.name: xr.DataArray(out[m.name], coords=coords, dims=spatial_dims, attrs=m.attrs)
+              for m in metrics}
+    window_coords = dict(coords, **{window_dim: list(windows)})
+    for m in windowed if windows else []:
+        fields[f'{m.name}_by_{window_dim}'] = xr.DataArray(
+            by_window[m.name], coords=window_coords, dims=[window_dim] + spatial_dims,
+            attrs=_window_attrs(m, windows, window_dim))
+    if not keep_years:
+        return fields, None
+    coords['year'] = np.asarray(all_years)
+    return fields, {m.name: xr.DataArray(cubes[m.name], coords=coords,
+                                         dims=['year'] + spatial_dims,
+                                         attrs=_year_attrs(m))
+                    for m in yearly}
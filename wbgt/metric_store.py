@@ -0,0 +1,358 @@
+"""Compact scaled-integer store of metric grids, read through ``np.memmap``.
+
+The NetCDF outputs are zlib-compressed float32, so reading one point or one
+biome means decompressing whole variables. A store is a directory with a
+JSON manifest and one raw file per variable:
+
+* day counts (units ``days`` or ``1``) are packed as ``uint16`` and
+  temperatures (``degC``) as ``int16``, both with CF ``scale_factor`` /
+  ``add_offset`` (0.01 resolution) and a ``_FillValue`` for NaN; integer
+  fields (per-year uint16 counts, int8 flags) are kept as they are and
+  anything else, or a field whose range the packed type cannot hold, as
+  float32.
+* the grid is cut into ``tile x tile`` blocks, written one after another
+  with any leading dims (year, season) inside each block, so a point or a
+  biome bounding box touches only the pages of its blocks.
+* ``compression=None`` files open with ``np.memmap`` and are never read in
+  full; ``compression='zlib'`` compresses every block on its own (with an
+  offset table) and decompresses only the blocks a read needs.
+
+    MetricStore.write('wbgt_metrics.store', ds_out)
+    store = MetricStore('wbgt_metrics.store')
+    store.point(40.0, 254.75)
+    store.cells('days_above_31C', rows, cols)   # e.g. one biome's cells
+"""
+
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+STORE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+# Cells per side of a storage block (64 x 64 uint16 = 8 KiB, two pages)
+TILE = 64
+
+# Packed dtype, scale_factor and add_offset of float fields, by units
+ENCODINGS = {
+    'days': ('uint16', 0.01, 0.0),
+    '1': ('uint16', 0.01, 0.0),
+    'degC': ('int16', 0.01, 0.0),
+}
+
+
+def _grid_names(obj):
+    lat = 'latitude' if 'latitude' in obj.dims else 'lat'
+    lon = 'longitude' if 'longitude' in obj.dims else 'lon'
+    return lat, lon
+
+
+def _fill(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return None
+    info = np.iinfo(dtype)
+    return int(info.max if dtype.kind == 'u' else info.min)
+
+
+def choose_encoding(da, encodings=ENCODINGS):
+    """``{'dtype', 'scale_factor', 'add_offset', '_FillValue'}`` of a field."""
+    if da.dtype.kind in 'iu':
+        return {'dtype': da.dtype.str, 'scale_factor': 1.0, 'add_offset': 0.0,
+                '_FillValue': _fill(da.dtype)}
+    dtype, scale, offset = encodings.get(da.attrs.get('units'), ('float32', 1.0, 0.0))
+    if np.dtype(dtype).kind in 'iu' and not _fits(da.values, dtype, scale, offset):
+        # e.g. mean spell lengths of spells that run on across years
+        dtype, scale, offset = 'float32', 1.0, 0.0
+    return {'dtype': np.dtype(dtype).str, 'scale_factor': scale, 'add_offset': offset,
+            '_FillValue': _fill(dtype)}
+
+
+def _packed_range(dtype):
+    """Usable integer range of ``dtype``; the fill value is reserved for NaN."""
+    info = np.iinfo(dtype)
+    return info.min + (info.kind == 'i'), info.max - (info.kind == 'u')
+
+
+def _fits(values, dtype, scale, offset):
+    finite = np.asarray(values)[np.isfinite(values)]
+    if not finite.size:
+        return True
+    lo, hi = _packed_range(dtype)
+    packed = np.round((np.array([finite.min(), finite.max()]) - offset) / scale)
+    return lo <= packed[0] and packed[1] <= hi
+
+
+def encode(values, encoding):
+    """Pack float values; NaN becomes the fill value. Out-of-range values raise."""
+    values = np.asarray(values)
+    dtype = np.dtype(encoding['dtype'])
+    if dtype.kind == 'f':
+        return values.astype(dtype)
+    if values.dtype.kind in 'iu' and encoding['scale_factor'] == 1 and encoding['add_offset'] == 0:
+        return values.astype(dtype)
+    nan = np.isnan(values)
+    packed = np.round((values - encoding['add_offset']) / encoding['scale_factor'])
+    lo, hi = _packed_range(dtype)
+    bad = ~nan & ((packed < lo) | (packed > hi))
+    if bad.any():
+        raise ValueError(f"{int(bad.sum())} values outside the {dtype} range of scale "
+                         f"{encoding['scale_factor']:g}, offset {encoding['add_offset']:g}")
+    return np.where(nan, encoding['_FillValue'], packed).astype(dtype)
+
+
+def decode(packed, encoding):
+    """Unpack to float32, with NaN at the fill value."""
+    packed = np.asarray(packed)
+    if packed.dtype.kind == 'f':
+        return packed.astype(np.float32)
+    out = packed.astype(np.float32)
+    if encoding['scale_factor'] != 1 or encoding['add_offset'] != 0:
+        out = out * np.float32(encoding['scale_factor']) + np.float32(encoding['add_offset'])
+    if encoding['_FillValue'] is not None:
+        out[packed == encoding['_FillValue']] = np.nan
+    return out
+
+
+def _coord_list(values):
+    values = np.asarray(values)
+    return values.astype(str).tolist() if values.dtype.kind in 'OUS' else values.tolist()
+
+
+class MetricStore:
+    """Read access to a store written by ``MetricStore.write``.
+
+    Parameters
+    ----------
+    path : str
+        Store directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest['version'] != STORE_VERSION:
+            raise ValueError(f"{path}: store version {manifest['version']}, "
+                             f"expected {STORE_VERSION}")
+        self.tile = manifest['tile']
+        self.compression = manifest['compression']
+        self.lat_name, self.lon_name = manifest['grid']
+        self.coords = {name: np.asarray(values) for name, values in manifest['coords'].items()}
+        self.attrs = manifest['attrs']
+        self.variables = manifest['variables']
+        self._maps, self._offsets = {}, {}
+
+    @property
+    def shape(self):
+        return (len(self.coords[self.lat_name]), len(self.coords[self.lon_name]))
+
+    @property
+    def n_tiles(self):
+        return tuple(-(-n // self.tile) for n in self.shape)
+
+    def _block_shape(self, name):
+        lead = tuple(len(self.coords[d]) for d in self.variables[name]['dims'][:-2])
+        return lead + (self.tile, self.tile)
+
+    # -------------------------------------------------------------------------
+    # Writing
+    # -------------------------------------------------------------------------
+
+    @classmethod
+    def write(cls, path, ds, variables=None, tile=TILE, compression=None, encodings=ENCODINGS):
+        """Write the ``(..., lat, lon)`` variables of ``ds`` to a new store.
+
+        Parameters
+        ----------
+        path : str
+            Store directory; replaced if it exists.
+        ds : xr.Dataset or dict of str -> xr.DataArray
+            Metric fields on one regular grid (the last two dims).
+        variables : list of str, optional
+            Variables to store (default: every variable with the grid dims).
+        tile : int
+            Cells per side of a storage block.
+        compression : {None, 'zlib'}
+            ``None`` for memory-mappable files, ``'zlib'`` to compress each
+            block on its own.
+        encodings : dict
+            Units -> (dtype, scale_factor, add_offset) of float fields.
+
+        Returns
+        -------
+        MetricStore
+        """
+        import xarray as xr
+
+        if compression not in (None, 'zlib'):
+            raise ValueError(f"Unknown compression {compression!r}; choose None or 'zlib'")
+        ds = xr.Dataset(dict(ds)) if isinstance(ds, dict) else ds
+        lat_name, lon_name = _grid_names(ds)
+        if variables is None:
+            variables = [v for v, da in ds.data_vars.items()
+                         if da.dims[-2:] == (lat_name, lon_name)]
+        tmp = f'{path}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        coords = {lat_name: _coord_list(ds[lat_name]), lon_name: _coord_list(ds[lon_name])}
+        entries = {}
+        for name in variables:
+            da = ds[name]
+            if da.dims[-2:] != (lat_name, lon_name):
+                da = da.transpose(..., lat_name, lon_name)
+            for d in da.dims[:-2]:
+                coords[d] = _coord_list(da[d] if d in da.coords else np.arange(da.sizes[d]))
+            encoding = choose_encoding(da, encodings)
+            packed = encode(da.values, encoding)
+            n_lat, n_lon = packed.shape[-2:]
+            ty, tx = -(-n_lat // tile), -(-n_lon // tile)
+            fill = encoding['_FillValue'] if encoding['_FillValue'] is not None else np.nan
+            padded = np.full(packed.shape[:-2] + (ty * tile, tx * tile), fill, dtype=packed.dtype)
+            padded[..., :n_lat, :n_lon] = packed
+            # (..., ty, tile, tx, tile) -> (ty, tx, ..., tile, tile)
+            lead = packed.ndim - 2
+            blocks = padded.reshape(packed.shape[:-2] + (ty, tile, tx, tile))
+            blocks = blocks.transpose((lead, lead + 2) + tuple(range(lead)) + (lead + 1, lead + 3))
+            blocks = np.ascontiguousarray(blocks).reshape(ty * tx, -1)
+            with open(os.path.join(tmp, f'{name}.bin'), 'wb') as f:
+                if compression is None:
+                    f.write(blocks.tobytes())
+                else:
+                    offsets = [0]
+                    for block in blocks:
+                        offsets.append(offsets[-1] + f.write(zlib.compress(block.tobytes(), 4)))
+                    np.save(os.path.join(tmp, f'{name}.offsets.npy'), np.asarray(offsets))
+            attrs = {k: v for k, v in da.attrs.items()
+                     if isinstance(v, (str, int, float, list))}
+            entries[name] = {'dims': list(da.dims), 'encoding': encoding, 'attrs': attrs}
+
+        manifest = {
+            'version': STORE_VERSION, 'tile': tile, 'compression': compression,
+            'grid': [lat_name, lon_name], 'coords': coords,
+            'attrs': {k: v for k, v in ds.attrs.items() if isinstance(v, (str, int, float))},
+            'variables': entries,
+        }
+        with open(os.path.join(tmp, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        return cls(path)
+
+    # -------------------------------------------------------------------------
+    # Reading
+    # -------------------------------------------------------------------------
+
+    def blocks(self, name):
+        """Memory map of the packed ``(tile_y, tile_x, ..., tile, tile)`` blocks."""
+        if self.compression is not None:
+            raise ValueError(f"{self.path} is {self.compression}-compressed; use read() or cells()")
+        if name not in self._maps:
+            self._maps[name] = np.memmap(
+                os.path.join(self.path, f'{name}.bin'), mode='r',
+                dtype=np.dtype(self.variables[name]['encoding']['dtype']),
+                shape=self.n_tiles + self._block_shape(name))
+        return self._maps[name]
+
+    def _block(self, name, ty, tx):
+        """One packed ``(..., tile, tile)`` block."""
+        if self.compression is None:
+            return self.blocks(name)[ty, tx]
+        if name not in self._offsets:
+            self._offsets[name] = np.load(os.path.join(self.path, f'{name}.offsets.npy'))
+        offsets = self._offsets[name]
+        i = ty * self.n_tiles[1] + tx
+        with open(os.path.join(self.path, f'{name}.bin'), 'rb') as f:
+            f.seek(int(offsets[i]))
+            raw = zlib.decompress(f.read(int(offsets[i + 1] - offsets[i])))
+        dtype = np.dtype(self.variables[name]['encoding']['dtype'])
+        return np.frombuffer(raw, dtype=dtype).reshape(self._block_shape(name))
+
+    def cells(self, name, rows, cols, decoded=True):
+        """Values of ``name`` at grid cells ``(rows, cols)``: ``(..., cells)``.
+
+        Only the blocks holding those cells are read, so a biome's cells
+        cost its share of the grid, not the whole variable.
+        """
+        rows, cols = np.atleast_1d(rows), np.atleast_1d(cols)
+        ty, tx = rows // self.tile, cols // self.tile
+        y, x = rows % self.tile, cols % self.tile
+        if self.compression is None:
+            mm = self.blocks(name)
+            # Fancy indexing of a memmap touches only the indexed pages
+            packed = np.moveaxis(mm[ty, tx, ..., y, x], 0, -1)
+        else:
+            packed = np.empty(self._block_shape(name)[:-2] + (len(rows),),
+                              dtype=np.dtype(self.variables[name]['encoding']['dtype']))
+            block_ids = ty * self.n_tiles[1] + tx
+            for b in np.unique(block_ids):
+                sel = np.flatnonzero(block_ids == b)
+                block = self._block(name, *divmod(int(b), self.n_tiles[1]))
+                packed[..., sel] = block[..., y[sel], x[sel]]
+        if not decoded:
+            return packed
+        return decode(packed, self.variables[name]['encoding'])
+
+    def read(self, name, lat=slice(None), lon=slice(None), decoded=True):
+        """``(..., lat, lon)`` window of ``name`` given by two index slices.
+
+        The window is assembled block by block; blocks outside it are not read.
+        """
+        r = np.arange(self.shape[0])[lat]
+        c = np.arange(self.shape[1])[lon]
+        dtype = np.dtype(self.variables[name]['encoding']['dtype'])
+        packed = np.empty(self._block_shape(name)[:-2] + (len(r), len(c)), dtype=dtype)
+        for ty in np.unique(r // self.tile):
+            ir = np.flatnonzero(r // self.tile == ty)
+            for tx in np.unique(c // self.tile):
+                ic = np.flatnonzero(c // self.tile == tx)
+                block = self._block(name, int(ty), int(tx))
+                packed[..., ir[:, None], ic[None, :]] = \
+                    block[..., (r[ir] % self.tile)[:, None], (c[ic] % self.tile)[None, :]]
+        if not decoded:
+            return packed
+        return decode(packed, self.variables[name]['encoding'])
+
+    def locate(self, lat, lon):
+        """Grid row and column of the cell nearest to ``(lat, lon)``."""
+        grid_lon = self.coords[self.lon_name]
+        if grid_lon.max() > 180 and lon < 0:
+            lon += 360
+        elif grid_lon.min() < 0 and lon > 180:
+            lon -= 360
+        return (int(np.abs(self.coords[self.lat_name] - lat).argmin()),
+                int(np.abs(grid_lon - lon).argmin()))
+
+    def point(self, lat, lon, variables=None):
+        """Every variable at the cell nearest to ``(lat, lon)``: name -> value or array."""
+        row, col = self.locate(lat, lon)
+        return {name: self.cells(name, row, col)[..., 0]
+                for name in (variables or self.variables)}
+
+    def dataarray(self, name, lat=slice(None), lon=slice(None)):
+        """Decoded window of ``name`` as a DataArray with its coordinates and attributes."""
+        import xarray as xr
+        entry = self.variables[name]
+        values = self.read(name, lat, lon)
+        coords = {d: self.coords[d] for d in entry['dims'][:-2]}
+        coords[self.lat_name] = self.coords[self.lat_name][lat]
+        coords[self.lon_name] = self.coords[self.lon_name][lon]
+        return xr.DataArray(values, coords=coords, dims=entry['dims'], attrs=entry['attrs'])
+
+    def to_dataset(self, variables=None, lat=slice(None), lon=slice(None)):
+        """Decoded Dataset of ``variables`` (default all) over a window."""
+        import xarray as xr
+        return xr.Dataset({name: self.dataarray(name, lat, lon)
+                           for name in (variables or self.variables)}, attrs=self.attrs)
+
+
+def open_metrics(path, **kwargs):
+    """Metric fields as an ``xr.Dataset`` from a store directory or a NetCDF file."""
+    import xarray as xr
+    if os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST)):
+        return MetricStore(path).to_dataset()
+    return xr.open_dataset(path, **kwargs)
@@ -0,0 +1,140 @@
+"""Per-cell linear trends and decadal means of per-year metric cubes.
+
+``compute_annual_metrics(..., keep_years=True)`` returns every metric as a
+compact ``(year, ...)`` cube. The least-squares fit is closed form over the
+whole grid at once: a few masked sums along the year axis give every cell's
+slope, its standard error and a two-sided t-test p-value, with missing
+(NaN) years left out per cell. Decadal means come from one sum per decade,
+so periods can be compared (the 2010s against the 1960s, say) without
+going back to the daily data.
+
+    metrics, cubes = compute_annual_metrics(da, keep_years=True)
+    trends = trend_dataset(cubes)
+    shift = trends['days_above_31C_decadal'].sel(decade=2010) \\
+        - trends['days_above_31C_decadal'].sel(decade=1960)
+"""
+
+import numpy as np
+import xarray as xr
+from scipy import stats
+
+
+def _masked(values):
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    return np.where(valid, values, 0.0), valid
+
+
+def linear_trend(values, years, per=10):
+    """Ordinary least-squares trend of every cell of a ``(year, ...)`` array.
+
+    Parameters
+    ----------
+    values : array-like
+        Per-year values, year first; NaN years are skipped per cell.
+    years : array-like
+        Year of each row of ``values``.
+    per : int
+        Slopes are given per this many years (a decade by default).
+
+    Returns
+    -------
+    dict of str -> np.ndarray
+        ``slope`` and its ``stderr`` (per ``per`` years), the two-sided
+        ``pvalue`` of a zero slope and ``n`` (years used). Cells with fewer
+        than three years have NaN statistics; a constant series has a NaN
+        p-value.
+    """
+    y, valid = _masked(values)
+    x = np.asarray(years, dtype=np.float64)
+    x = (x - x.mean()).reshape((-1,) + (1,) * (y.ndim - 1))
+    xv = np.where(valid, x, 0.0)
+
+    n = valid.sum(axis=0)
+    sx, sy = xv.sum(axis=0), y.sum(axis=0)
+    sxx, sxy, syy = (xv * xv).sum(axis=0), (xv * y).sum(axis=0), (y * y).sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ssx = sxx - sx * sx / n
+        slope = (sxy - sx * sy / n) / ssx
+        ssy = syy - sy * sy / n
+        sse = np.maximum(ssy - slope * (sxy - sx * sy / n), 0.0)
+        stderr = np.sqrt(sse / (n - 2) / ssx)
+        tstat = slope / stderr
+    dof = np.maximum(n - 2, 1)
+    pvalue = 2 * stats.t.sf(np.abs(tstat), dof)
+
+    ok = n >= 3
+    return {
+        'slope': np.where(ok, slope * per, np.nan),
+        'stderr': np.where(ok, stderr * per, np.nan),
+        'pvalue': np.where(ok, pvalue, np.nan),
+        'n': n.astype(np.int32),
+    }
+
+
+def decadal_means(values, years):
+    """Mean of every cell over each calendar decade, skipping NaN years.
+
+    Returns the decades (e.g. 1960 for 1960-1969) and a ``(decade, ...)``
+    array of float32 means.
+    """
+    y, valid = _masked(values)
+    decade = np.asarray(years) // 10 * 10
+    order = np.argsort(decade, kind='stable')
+    decades, starts = np.unique(decade[order], return_index=True)
+    total = np.add.reduceat(y[order], starts, axis=0)
+    count = np.add.reduceat(valid[order].astype(np.int32), starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(count > 0, total / count, np.nan)
+    return decades, means.astype(np.float32)
+
+
+def trend_dataset(cubes, per=10, alpha=0.05):
+    """Trends and decadal means of per-year cubes.
+
+    Parameters
+    ----------
+    cubes : dict of str -> xr.DataArray
+        ``(year, ...)`` cubes, as returned with ``keep_years=True``.
+    per : int
+        Years per trend unit.
+    alpha : float
+        Significance level of the ``_trend_significant`` flag.
+
+    Returns
+    -------
+    xr.Dataset
+        For each cube ``<name>``: ``<name>_trend``, ``<name>_trend_pvalue``,
+        ``<name>_trend_significant`` and ``<name>_decadal`` (dims
+        ``decade, ...``).
+    """
+    out = {}
+    for name, cube in cubes.items():
+        cube = cube.transpose('year', ...)
+        dims = list(cube.dims[1:])
+        coords = {d: cube[d] for d in cube.coords if set(cube[d].dims) <= set(dims)}
+        years = cube['year'].values
+        fit = linear_trend(cube.values, years, per)
+        units = cube.attrs.get('units', '1')
+        common = {k: cube.attrs[k] for k in ('grid_mapping',) if k in cube.attrs}
+        span = f'{int(years.min())}-{int(years.max())}'
+
+        out[f'{name}_trend'] = xr.DataArray(
+            fit['slope'].astype(np.float32), coords=coords, dims=dims,
+            attrs={'long_name': f'Linear trend of {name}, {span}',
+                   'units': f'{units} per {per} years', **common})
+        out[f'{name}_trend_pvalue'] = xr.DataArray(
+            fit['pvalue'].astype(np.float32), coords=coords, dims=dims,
+            attrs={'long_name': f'Two-sided p-value of the {name} trend', 'units': '1',
+                   **common})
+        out[f'{name}_trend_significant'] = xr.DataArray(
+            (fit['pvalue'] < alpha).astype(np.int8), coords=coords, dims=dims,
+            attrs={'long_name': f'{name} trend significant at p < {alpha:g}',
+                   'flag_values': [0, 1], **common})
+
+        decades, means = decadal_means(cube.values, years)
+        out[f'{name}_decadal'] = xr.DataArray(
+            means, coords={'decade': decades, **coords}, dims=['decade'] + dims,
+            attrs={'long_name': f'Decadal mean of {name}', 'units': units, **common})
+    return xr.Dataset(out)
@@ -0,0 +1,303 @@
+"""The WBGT metrics run: daily ERA5 stack in, NetCDF/store/GeoTIFFs out.
+
+``run_metrics`` is the body of ``calc.wbgt.thresholds.py`` as a function,
+so the same run can be started from that script, from the ``metrics``
+subcommand of ``python -m climate_analogs`` or from a notebook, with every
+path and setting passed in rather than edited in place.
+"""
+
+import os
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+
+from chunk_tuner import disk_layout, rechunk_stack, tune_chunks
+from era5_index import load_index, open_indexed
+from execution import ExecutionBackend
+from land_vector import LandVector
+from metric_registry import SEASONS, metrics_state_bytes
+from metric_store import MetricStore
+from metric_trends import trend_dataset
+from raster_export import export_rasters
+from run_report import RunReport
+from streaming import DEFAULT_MEMORY_BUDGET
+from wbgt_metrics import annual_metrics, compute_annual_metrics
+from year_cache import YearCache, source_fingerprints
+
+# Fill value of the float variables on disk
+FILL_VALUE = -9999.0
+
+CRS_ATTRS = {
+    'grid_mapping_name': 'latitude_longitude',
+    'longitude_of_prime_meridian': 0.0,
+    'semi_major_axis': 6378137.0,
+    'inverse_flattening': 298.257223563,
+    'crs_wkt': 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]',
+}
+
+
+def yearly_store_path(store_path):
+    """Path of the per-year store next to ``store_path`` (``<name>_yearly<ext>``)."""
+    root, ext = os.path.splitext(store_path.rstrip('/' + os.sep))
+    return f'{root}_yearly{ext}'
+
+
+def global_attributes():
+    return {
+        'title': 'Wet Bulb Globe Temperature (WBGT) Climate Metrics',
+        'institution': 'NSF NCAR',
+        'source': 'ERA5 reanalysis',
+        'history': f'Created {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}',
+        'author': 'Jacob Stuivenvolt-Allen',
+        'contact': 'jsallen@ucar.edu',
+        'description': 'Multi-year averaged statistics and threshold exceedance metrics for daily maximum WBGT',
+        'references': 'Heat risk thresholds based on occupational health guidelines',
+        'Conventions': 'CF-1.8',
+    }
+
+
+def run_metrics(files, biome_file, start_year=1950, end_year=2020, output_dir='.',
+                index_path='wbgtmax_ERA5_index.json', cache_dir='wbgt_year_cache',
+                quantile_method='exact', memory_budget=DEFAULT_MEMORY_BUDGET,
+                spell_min_days=3, keep_years=True, windows=SEASONS,
+                store_path='wbgt_metrics.store', store_compression=None, geotiffs=True,
+                multiband_path=None, zarr_path=None, report_path='wbgt_run_report.json',
+                backend='threads', workers=None, worker_memory=None, autotune=True,
+                rechunk_dir='wbgt_rechunked'):
+    """Compute every WBGT metric and write the outputs.
+
+    Parameters
+    ----------
+    files : str
+        Glob of the yearly ``wbgtmax_<year>_daily_ERA5.nc`` files.
+    biome_file : str
+        ``biomes.analog.gridded.nc``; only its land cells are reduced.
+    start_year, end_year : int
+        Climatology window (inclusive).
+    output_dir : str
+        Where the NetCDF files, store and GeoTIFFs are written.
+    index_path, cache_dir : str
+        Reference sidecar of the stack and per-year cache directory
+        (relative paths are under ``output_dir``); ``cache_dir=None``
+        disables the cache.
+    quantile_method : {'exact', 'histogram', 'tdigest'}
+        p95 estimator.
+    memory_budget : int
+        Peak bytes for accumulator state plus loaded time blocks, shared by
+        the workers.
+    spell_min_days : int or None
+        Minimum heat-spell length; None skips the spell metrics.
+    keep_years : bool
+        Also write the per-year cube, trends and decadal means.
+    windows : dict or None
+        Calendar windows (``SEASONS``, ``MONTHS``, custom) for the
+        ``<metric>_by_season`` variables.
+    store_path : str or None
+        Also write a ``metric_store`` directory (None to skip); with
+        ``keep_years`` the per-year cube goes to ``yearly_store_path``
+        of it (``wbgt_metrics_yearly.store``).
+    store_compression : {None, 'zlib'}
+        Compression of the store's tiles.
+    geotiffs : bool
+        Export one COG per 2-D variable (needs rasterio).
+    multiband_path, zarr_path : str or None
+        With ``geotiffs``, also write the 2-D variables as the bands of one
+        COG and to a Zarr store (needs zarr); relative to ``output_dir``.
+    report_path : str or None
+        JSON run report: per-stage time, peak memory, bytes read, dask task
+        summary and the statistics of every metric (see ``run_report``).
+    backend : {'synchronous', 'threads', 'processes', 'distributed'}
+        Where the metric tiles run (see ``execution``).
+    workers : int, optional
+        Concurrent tiles (default: one per CPU).
+    worker_memory : int, optional
+        Bytes per worker; the memory limit of ``distributed`` workers.
+    autotune : bool
+        Pick the dask chunking from the files' on-disk chunks and the budget
+        (``chunk_tuner``); otherwise one chunk per yearly file.
+    rechunk_dir : str or None
+        Where the tuner may write a rechunked copy of the stack (relative
+        to ``output_dir``); None never rechunks.
+
+    Returns
+    -------
+    xr.Dataset
+        The dataset written to ``wbgt_annual_metrics.nc``.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    def out(path):
+        return path if os.path.isabs(path) else os.path.join(output_dir, path)
+
+    report = RunReport('metrics', settings={
+        'files': files, 'biome_file': biome_file, 'start_year': start_year,
+        'end_year': end_year, 'quantile_method': quantile_method,
+        'memory_budget': memory_budget, 'spell_min_days': spell_min_days,
+        'keep_years': keep_years, 'windows': windows, 'cache_dir': cache_dir,
+        'store_path': store_path, 'store_compression': store_compression,
+        'geotiffs': geotiffs, 'multiband_path': multiband_path, 'zarr_path': zarr_path,
+        'backend': backend, 'workers': workers, 'worker_memory': worker_memory,
+        'autotune': autotune, 'rechunk_dir': rechunk_dir,
+    })
+    executor = ExecutionBackend(backend, workers, worker_memory)
+    print(f"Computing WBGT metrics {start_year}-{end_year} (p95 method: {quantile_method})")
+    try:
+        # Data are read lazily through the reference index of the yearly files
+        with report.stage('open') as stage:
+            index = load_index(out(index_path), files)
+            da = open_indexed(out(index_path), files)['wbgtmax']
+            da = da.sel(time=slice(str(start_year), str(end_year)))
+            stage.info.update(shape=dict(da.sizes), files=len(da.chunks[0]),
+                              time=[str(da['time'].values[i])[:10] for i in (0, -1)])
+
+        # Only land cells (BIOME_ID >= 1) are reduced; ocean cells are filled back
+        # in when the output is written
+        with report.stage('land_mask') as stage:
+            land = LandVector.from_biomes(xr.open_dataset(biome_file),
+                                          da['latitude'], da['longitude'])
+            stage.info.update(land_cells=int(land.n_land), grid_cells=int(np.prod(land.shape)))
+
+        # Latitude bands for the workers, sized to their share of the budget
+        # and, when the files are chunked against that, read from a copy
+        # rechunked once into bands
+        if autotune:
+            with report.stage('tune') as stage:
+                n_years = len(np.unique(da['time'].dt.year))
+                state_bytes = metrics_state_bytes(
+                    annual_metrics(spell_min_days=spell_min_days), n_years, quantile_method,
+                    keep_years, windows)
+                # State is only held for land cells
+                state_bytes = int(np.ceil(state_bytes * land.n_land / np.prod(land.shape)))
+                layout = disk_layout(index)
+                budget = executor.worker_budget(memory_budget) * executor.workers
+                plan = tune_chunks(layout, budget, executor.workers, 'time',
+                                   state_bytes_per_cell=state_bytes,
+                                   allow_rechunk=rechunk_dir is not None)
+                stage.info.update(plan.as_dict(), disk_layout=layout)
+            print(f"Chunks {plan.chunks} ({executor.workers} {backend} workers, "
+                  f"read amplification {plan.amplification:.1f})")
+            sidecar, stack = out(index_path), files
+            if plan.rechunk:
+                with report.stage('rechunk') as stage:
+                    stack = rechunk_stack(index, out(rechunk_dir), plan.disk_chunks,
+                                          executor.worker_budget(memory_budget))
+                    sidecar = os.path.join(out(rechunk_dir), os.path.basename(index_path))
+                    stage.info.update(path=out(rechunk_dir), disk_chunks=plan.disk_chunks)
+            da = open_indexed(sidecar, stack, chunks=plan.chunks)['wbgtmax']
+            da = da.sel(time=slice(str(start_year), str(end_year)))
+
+        cache = None if cache_dir is None else YearCache(out(cache_dir))
+        sources = source_fingerprints(files)
+
+        # Every variable from TWO reads of the data: pass 1 updates the annual
+        # mean, the fixed-threshold counts, the heat-spell runs and a p95 sketch
+        # from the same time chunks; pass 2 resolves p95 and the days above it.
+        # The per-variable statistics of the report come from the same pass.
+        with report.stage('compute'), executor:
+            metrics, yearly = compute_annual_metrics(
+                land.pack_dataarray(da), quantile_method=quantile_method,
+                memory_budget=memory_budget, cache=cache, sources=sources,
+                spell_min_days=spell_min_days, keep_years=keep_years, windows=windows,
+                backend=executor)
+
+        # Back to the full grid for writing
+        metrics = {name: land.unpack_dataarray(values) for name, values in metrics.items()}
+        del da
+
+        crs_var = xr.DataArray(0, attrs=CRS_ATTRS)
+        global_attrs = global_attributes()
+        ds_out = xr.Dataset(data_vars={**metrics, 'crs': crs_var}, attrs=global_attrs)
+
+        encoding = {
+            var: {'zlib': True, 'complevel': 4, 'dtype': 'float32', '_FillValue': FILL_VALUE}
+            for var in ds_out.data_vars if var != 'crs'
+        }
+        encoding['crs'] = {'dtype': 'int32'}
+
+        output_file = out('wbgt_annual_metrics.nc')
+        with report.stage('write_netcdf') as stage:
+            ds_out.to_netcdf(output_file, encoding=encoding)
+            stage.info.update(path=output_file, variables=len(metrics))
+        print(f"NetCDF output saved to: {output_file}")
+
+        if store_path is not None:
+            with report.stage('write_store') as stage:
+                MetricStore.write(out(store_path), ds_out, compression=store_compression)
+                stage.info['path'] = out(store_path)
+            print(f"Metric store saved to: {out(store_path)}")
+
+        # =========================================================================
+        # Per-year cube, trends and decadal means
+        # =========================================================================
+        # Day counts stay uint16 on disk (65535 off land); trends are fitted in
+        # closed form on the packed land cells, then filled out to the grid.
+
+        if yearly is not None:
+            with report.stage('write_yearly') as stage:
+                uint16_fill = np.iinfo(np.uint16).max
+                yearly_ds = xr.Dataset(
+                    {name: land.unpack_dataarray(cube,
+                                                 uint16_fill if cube.dtype == np.uint16 else np.nan)
+                               .astype(cube.dtype)
+                     for name, cube in yearly.items()},
+                    attrs=dict(global_attrs, description='Per-year WBGT metrics'))
+                yearly_ds['crs'] = crs_var
+                yearly_encoding = {
+                    var: {'zlib': True, 'complevel': 4, 'dtype': str(yearly_ds[var].dtype),
+                          '_FillValue': (uint16_fill if yearly_ds[var].dtype == np.uint16
+                                         else FILL_VALUE),
+                          'chunksizes': (1,) + yearly_ds[var].shape[1:]}
+                    for var in yearly
+                }
+                yearly_ds.to_netcdf(out('wbgt_yearly_metrics.nc'), encoding=yearly_encoding)
+                stage.info['path'] = out('wbgt_yearly_metrics.nc')
+                if store_path is not None:
+                    yearly_store = out(yearly_store_path(store_path))
+                    MetricStore.write(yearly_store, yearly_ds, compression=store_compression)
+                    stage.info['store'] = yearly_store
+            print(f"Per-year metrics saved to: {out('wbgt_yearly_metrics.nc')}")
+
+            with report.stage('trends') as stage:
+                trends = trend_dataset(yearly)
+                trends_ds = xr.Dataset(
+                    {name: land.unpack_dataarray(values, -1 if values.dtype == np.int8 else np.nan)
+                               .astype(values.dtype)
+                     for name, values in trends.data_vars.items()},
+                    attrs=dict(global_attrs, description='Per-cell linear trends (per decade), '
+                               'trend significance and decadal means of the per-year WBGT metrics'))
+                trends_ds['crs'] = crs_var
+                trends_ds.to_netcdf(out('wbgt_metric_trends.nc'), encoding={
+                    var: {'zlib': True, 'complevel': 4,
+                          '_FillValue': -1 if trends_ds[var].dtype == np.int8 else FILL_VALUE}
+                    for var in trends.data_vars})
+                stage.info['path'] = out('wbgt_metric_trends.nc')
+            print(f"Trends and decadal means saved to: {out('wbgt_metric_trends.nc')}")
+
+        # =========================================================================
+        # Export Cloud-Optimized GeoTIFFs
+        # =========================================================================
+        # Written from the in-memory arrays (no re-read of the NetCDF), one COG
+        # per variable with internal overviews, concurrently.
+
+        if geotiffs:
+            with report.stage('geotiffs') as stage:
+                variables_to_convert = [name for name, values in metrics.items()
+                                        if values.ndim == 2]
+                written = export_rasters(
+                    ds_out, variables_to_convert, prefix=out('wbgt_'), nodata=FILL_VALUE,
+                    multiband_path=out(multiband_path) if multiband_path else None,
+                    zarr_path=out(zarr_path) if zarr_path else None)
+                stage.info['files'] = len(written)
+
+    finally:
+        # Also written when a stage fails, with that stage marked as failed
+        if report_path is not None:
+            print(f"Run report saved to: {report.write(out(report_path))}")
+
+    print("\nVariable statistics (land cells):")
+    for name, stats in report.field_stats().items():
+        if stats['count']:
+            print(f"  {name:<36} mean {stats['mean']:8.2f}  min {stats['min']:8.2f}  "
+                  f"max {stats['max']:8.2f}")
+    return ds_out
@@ -0,0 +1,152 @@
+"""In-process GeoTIFF export of the metric fields.
+
+Each variable is written straight from the in-memory grid as a
+Cloud-Optimized GeoTIFF: 512x512 internal tiles, DEFLATE compression with a
+floating-point predictor, nodata tagged, and averaged overview levels down
+to a single tile so viewers can read any zoom level without touching the
+full raster. Variables are written concurrently on threads; GDAL releases
+the GIL while encoding. A multi-band GeoTIFF and/or a Zarr store of the same
+variables can be written alongside.
+
+Requires rasterio built against GDAL >= 3.1 (for the COG driver).
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_NODATA = -9999.0
+
+# Creation options of the COG driver
+COG_OPTIONS = {
+    'compress': 'DEFLATE',
+    'predictor': 'YES',
+    'blocksize': 512,
+    'overviews': 'AUTO',
+    'overview_resampling': 'AVERAGE',
+    'bigtiff': 'IF_SAFER',
+}
+
+
+def grid_transform(lat, lon):
+    """Affine transform of a regular cell-centre grid, north-up.
+
+    Returns the transform and whether rows must be flipped (ascending
+    latitude) to put north at the top.
+    """
+    from rasterio.transform import from_origin
+
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    dy = float(abs(lat[1] - lat[0]))
+    dx = float(abs(lon[1] - lon[0]))
+    flip = lat[0] < lat[-1]
+    return from_origin(float(lon.min()) - dx / 2, float(lat.max()) + dy / 2, dx, dy), flip
+
+
+def _band_array(da, nodata):
+    values = np.asarray(da.values, dtype=np.float32)
+    return np.where(np.isfinite(values), values, np.float32(nodata))
+
+
+def _band_tags(da):
+    return {k: str(v) for k, v in da.attrs.items() if k in ('units', 'long_name', 'standard_name')}
+
+
+def write_geotiff(path, bands, transform, names=None, tags=None, nodata=DEFAULT_NODATA,
+                  cog=True):
+    """Write ``(band, y, x)`` float32 ``bands`` to ``path``.
+
+    The raster is assembled in memory and copied to the COG driver (or to a
+    tiled, compressed plain GeoTIFF with ``cog=False``), so only the final
+    file is ever written. The file appears atomically.
+    """
+    import rasterio
+    import rasterio.shutil
+    from rasterio.io import MemoryFile
+
+    bands = np.asarray(bands, dtype=np.float32)
+    if bands.ndim == 2:
+        bands = bands[None]
+    count, height, width = bands.shape
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'count': count, 'height': height,
+               'width': width, 'crs': 'EPSG:4326', 'transform': transform, 'nodata': nodata}
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(bands)
+            for i in range(count):
+                if names is not None:
+                    dst.set_band_description(i + 1, names[i])
+                if tags is not None and tags[i]:
+                    dst.update_tags(i + 1, **tags[i])
+        with memfile.open() as src:
+            if cog:
+                rasterio.shutil.copy(src, tmp, driver='COG', **COG_OPTIONS)
+            else:
+                rasterio.shutil.copy(src, tmp, driver='GTiff', tiled=True, blockxsize=512,
+                                     blockysize=512, compress='DEFLATE', predictor=3,
+                                     bigtiff='IF_SAFER')
+    os.replace(tmp, path)
+    return path
+
+
+def export_rasters(ds, variables, prefix='wbgt_', nodata=DEFAULT_NODATA, workers=None,
+                   multiband_path=None, zarr_path=None):
+    """Write one COG per variable of ``ds`` (``<prefix><var>.tif``).
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Metric fields on a regular ``(lat, lon)`` grid (the last two dims).
+    variables : list of str
+        Variables to export.
+    nodata : float
+        Value written where the field is NaN.
+    workers : int, optional
+        Concurrent writers (default: one per variable).
+    multiband_path : str, optional
+        Also write every variable as one band of a single COG.
+    zarr_path : str, optional
+        Also write the variables to a Zarr store (requires zarr).
+
+    Returns
+    -------
+    list of str
+        Paths written. Any failed write raises after the others finish.
+    """
+    first = ds[variables[0]]
+    lat_name, lon_name = first.dims[-2:]
+    transform, flip = grid_transform(ds[lat_name], ds[lon_name])
+
+    def band(var):
+        values = _band_array(ds[var].transpose(lat_name, lon_name), nodata)
+        return values[::-1] if flip else values
+
+    jobs = {f'{prefix}{var}.tif': ([band(var)], [var], [_band_tags(ds[var])])
+            for var in variables}
+    if multiband_path is not None:
+        jobs[multiband_path] = ([band(var) for var in variables], list(variables),
+                                [_band_tags(ds[var]) for var in variables])
+
+    written, errors = [], []
+    with ThreadPoolExecutor(max_workers=workers or len(jobs)) as pool:
+        futures = {path: pool.submit(write_geotiff, path, np.stack(bands), transform, names,
+                                     tags, nodata)
+                   for path, (bands, names, tags) in jobs.items()}
+        for path, future in futures.items():
+            try:
+                written.append(future.result())
+                print(f"Created: {path}")
+            except Exception as e:
+                errors.append(f"{path}: {type(e).__name__}: {e}")
+
+    if zarr_path is not None:
+        ds[list(variables)].to_zarr(zarr_path, mode='w')
+        written.append(zarr_path)
+        print(f"Created: {zarr_path}")
+
+    if errors:
+        raise RuntimeError("GeoTIFF export failed for:\n  " + "\n  ".join(errors))
+    return written
@@ -0,0 +1,226 @@
+"""Sparse regridding weights between regular lat/lon grids.
+
+The ERA5 metrics (``latitude``/``longitude``, 0..360), the CPC-aligned biome
+raster (``lat``/``lon``, -180..180) and CMIP model grids are all regular, so
+the weights separate into a latitude matrix and a longitude matrix. The full
+weight matrix is their Kronecker product, stored sparse (CSR) on disk and
+keyed by both grids. Moving a field to another grid is then a single sparse
+mat-vec over the flattened ``(lat, lon)`` axes, for any number of leading
+(time) steps at once.
+
+``conservative`` weights are cell-overlap areas (overlap in sin(latitude)
+times overlap in longitude) normalised per target cell; ``bilinear``
+interpolates between the four surrounding source cell centres. Longitude is
+treated as periodic when the source grid spans the globe. NaN source cells
+are left out and the remaining weights renormalised.
+
+    rg = Regridder.cached(era5_lat, era5_lon, biome_lat, biome_lon, 'conservative')
+    on_biome_grid = rg.apply_dataarray(metrics['wbgtmax_p95'])
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+
+WEIGHTS_VERSION = 1
+METHODS = ('conservative', 'bilinear')
+
+
+def _grid_names(obj):
+    lat = 'latitude' if 'latitude' in obj.dims else 'lat'
+    lon = 'longitude' if 'longitude' in obj.dims else 'lon'
+    return lat, lon
+
+
+def _edges(centres, lo=None, hi=None):
+    """Cell edges from centres (midpoints, half-step extrapolated ends)."""
+    c = np.asarray(centres, dtype=np.float64)
+    mid = (c[1:] + c[:-1]) / 2
+    edges = np.concatenate([[c[0] - (mid[0] - c[0])], mid, [c[-1] + (c[-1] - mid[-1])]])
+    if lo is not None:
+        edges = np.clip(edges, lo, hi)
+    return edges
+
+
+def _is_periodic(lon):
+    lon = np.asarray(lon, dtype=np.float64)
+    step = abs(lon[1] - lon[0])
+    return abs(len(lon) * step - 360) < 1e-6 * 360
+
+
+def _overlap(src_edges, dst_edges, period=None):
+    """(dst, src) lengths of overlap between two sets of 1-D intervals."""
+    s_lo = np.minimum(src_edges[:-1], src_edges[1:])[None, :]
+    s_hi = np.maximum(src_edges[:-1], src_edges[1:])[None, :]
+    d_lo = np.minimum(dst_edges[:-1], dst_edges[1:])[:, None]
+    d_hi = np.maximum(dst_edges[:-1], dst_edges[1:])[:, None]
+    shifts = (0.0,) if period is None else (-period, 0.0, period)
+    out = np.zeros((d_lo.shape[0], s_lo.shape[1]))
+    for shift in shifts:
+        out += np.clip(np.minimum(d_hi, s_hi + shift) - np.maximum(d_lo, s_lo + shift), 0, None)
+    return out
+
+
+def _linear(src, dst, period=None):
+    """(dst, src) 1-D linear interpolation weights; zero rows outside ``src``."""
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    order = np.argsort(src)
+    s = src[order]
+    if period is not None:
+        # Append the first point one period on, so the seam interpolates too
+        s = np.append(s, s[0] + period)
+        order = np.append(order, order[0])
+        dst = (dst - s[0]) % period + s[0]
+    hi = np.clip(np.searchsorted(s, dst, side='right'), 1, len(s) - 1)
+    lo = hi - 1
+    t = (dst - s[lo]) / (s[hi] - s[lo])
+    inside = (dst >= s[0]) & (dst <= s[-1])
+    rows = np.arange(len(dst))
+    w = sp.coo_matrix((np.concatenate([(1 - t)[inside], t[inside]]),
+                       (np.concatenate([rows[inside], rows[inside]]),
+                        np.concatenate([order[lo][inside], order[hi][inside]]))),
+                      shape=(len(dst), len(src)))
+    return w.tocsr()
+
+
+class Regridder:
+    """Sparse ``(dst cells, src cells)`` weights between two lat/lon grids.
+
+    Parameters
+    ----------
+    weights : scipy.sparse matrix
+        Rows are flattened target cells, columns flattened source cells,
+        both in ``(lat, lon)`` row-major order.
+    src_lat, src_lon, dst_lat, dst_lon : array-like
+        Grid coordinates.
+    method : str
+        How the weights were made.
+    """
+
+    def __init__(self, weights, src_lat, src_lon, dst_lat, dst_lon, method):
+        self.weights = sp.csr_matrix(weights)
+        self.src_lat, self.src_lon = np.asarray(src_lat), np.asarray(src_lon)
+        self.dst_lat, self.dst_lon = np.asarray(dst_lat), np.asarray(dst_lon)
+        self.method = method
+
+    @property
+    def src_shape(self):
+        return (len(self.src_lat), len(self.src_lon))
+
+    @property
+    def dst_shape(self):
+        return (len(self.dst_lat), len(self.dst_lon))
+
+    @classmethod
+    def build(cls, src_lat, src_lon, dst_lat, dst_lon, method='conservative'):
+        """Compute the weights from the grid coordinates."""
+        period = 360.0 if _is_periodic(src_lon) else None
+        if method == 'conservative':
+            # Areas on the sphere are proportional to d(sin lat) * d(lon)
+            w_lat = _overlap(np.sin(np.deg2rad(_edges(src_lat, -90, 90))),
+                             np.sin(np.deg2rad(_edges(dst_lat, -90, 90))))
+            w_lon = _overlap(_edges(src_lon), _edges(dst_lon), period)
+            w = sp.kron(sp.csr_matrix(w_lat), sp.csr_matrix(w_lon), format='csr')
+            total = np.asarray(w.sum(axis=1)).ravel()
+            scale = np.divide(1.0, total, out=np.zeros_like(total), where=total > 0)
+            w = sp.diags(scale) @ w
+        elif method == 'bilinear':
+            w = sp.kron(_linear(src_lat, dst_lat), _linear(src_lon, dst_lon, period), format='csr')
+        else:
+            raise ValueError(f"Unknown regridding method {method!r}; choose from {METHODS}")
+        w.eliminate_zeros()
+        return cls(w, src_lat, src_lon, dst_lat, dst_lon, method)
+
+    # -------------------------------------------------------------------------
+    # Storage
+    # -------------------------------------------------------------------------
+
+    @staticmethod
+    def key(src_lat, src_lon, dst_lat, dst_lon, method):
+        h = hashlib.sha256(f'{WEIGHTS_VERSION}:{method}'.encode())
+        for c in (src_lat, src_lon, dst_lat, dst_lon):
+            c = np.ascontiguousarray(c, dtype=np.float64)
+            h.update(str(c.shape).encode())
+            h.update(c.tobytes())
+        return h.hexdigest()[:24]
+
+    @classmethod
+    def cached(cls, src_lat, src_lon, dst_lat, dst_lon, method='conservative',
+               cache_dir='regrid_weights'):
+        """Weights from ``cache_dir`` if these grids were seen before, else build and save."""
+        path = os.path.join(cache_dir, f'{method}_{cls.key(src_lat, src_lon, dst_lat, dst_lon, method)}.npz')
+        if os.path.exists(path):
+            return cls.load(path)
+        rg = cls.build(src_lat, src_lon, dst_lat, dst_lon, method)
+        os.makedirs(cache_dir, exist_ok=True)
+        rg.save(path)
+        return rg
+
+    def save(self, path):
+        w = self.weights
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, data=w.data, indices=w.indices, indptr=w.indptr, shape=w.shape,
+                 src_lat=self.src_lat, src_lon=self.src_lon, dst_lat=self.dst_lat,
+                 dst_lon=self.dst_lon, method=self.method)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            w = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                              shape=tuple(npz['shape']))
+            return cls(w, npz['src_lat'], npz['src_lon'], npz['dst_lat'], npz['dst_lon'],
+                       str(npz['method']))
+
+    # -------------------------------------------------------------------------
+    # Applying
+    # -------------------------------------------------------------------------
+
+    def apply(self, values):
+        """``(..., src_lat, src_lon)`` array -> ``(..., dst_lat, dst_lon)``.
+
+        All leading steps go through one sparse product. Target cells whose
+        source cells are all NaN (or outside the source grid) are NaN.
+        """
+        values = np.asarray(values)
+        lead = values.shape[:-2]
+        flat = values.reshape(-1, values.shape[-2] * values.shape[-1]).T
+        valid = np.isfinite(flat)
+        out = self.weights @ np.where(valid, flat, 0).astype(np.float64)
+        if valid.all():
+            norm = np.asarray(self.weights.sum(axis=1))
+        else:
+            norm = self.weights @ valid.astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where(norm > 1e-12, out / norm, np.nan)
+        dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+        return out.T.astype(dtype).reshape(lead + self.dst_shape)
+
+    def apply_dataarray(self, da, lat_name='lat', lon_name='lon'):
+        """Regrid a DataArray's last two (lat, lon) dims; dask arrays stay lazy per chunk."""
+        src_lat, src_lon = _grid_names(da)
+        if da.chunks is not None:
+            da = da.chunk({src_lat: -1, src_lon: -1})
+        out = xr.apply_ufunc(
+            self.apply, da,
+            input_core_dims=[[src_lat, src_lon]],
+            output_core_dims=[[lat_name, lon_name]],
+            exclude_dims={src_lat, src_lon},
+            dask='parallelized',
+            output_dtypes=[da.dtype if da.dtype.kind == 'f' else np.float64],
+            dask_gufunc_kwargs={'output_sizes': {lat_name: self.dst_shape[0],
+                                                 lon_name: self.dst_shape[1]}},
+            keep_attrs=True,
+        )
+        return out.assign_coords({lat_name: self.dst_lat, lon_name: self.dst_lon})
+
+    def apply_dataset(self, ds, lat_name='lat', lon_name='lon'):
+        """Regrid every variable of ``ds`` on the source grid."""
+        src_lat, src_lon = _grid_names(ds)
+        regridded = {v: self.apply_dataarray(da, lat_name, lon_name)
+                     for v, da in ds.data_vars.items() if {src_lat, src_lon} <= set(da.dims)}
+        return xr.Dataset(regridded, attrs=ds.attrs)
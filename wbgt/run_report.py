@@ -0,0 +1,361 @@
+"""Per-stage instrumentation of a pipeline run and its JSON report.
+
+A ``RunReport`` wraps each stage of a run in ``report.stage(name)``, which
+records wall time, peak resident memory, bytes read and written and, when
+dask computes anything inside the stage, a summary of its task stream. Code
+running inside a stage adds to the current stage's record through
+``current_stage()`` (cache hits, per-field statistics) without any extra
+parameters, and is unaffected when no report is active:
+
+    report = RunReport('metrics', settings={'quantile_method': 'exact'})
+    with report.stage('compute') as stage:
+        ...
+        stage.info['cells'] = n_cells
+    report.write('wbgt_run_report.json')
+
+Peak memory is the VmHWM high-water mark, reset at the start of each stage
+(Linux); where the reset is not permitted, a thread samples RSS instead,
+and elsewhere the process-lifetime ``ru_maxrss`` is reported. Bytes read
+are the characters returned by read calls (page-cache hits included) and,
+separately, what came from the block device; reads by worker processes a
+stage starts are not counted.
+"""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+REPORT_VERSION = 1
+
+MB = 1024 ** 2
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Task-key prefixes listed per stage, by total time
+TOP_PREFIXES = 10
+
+_active = []
+
+
+# -----------------------------------------------------------------------------
+# Resource counters of the current process
+# -----------------------------------------------------------------------------
+
+def reset_peak_rss():
+    """Restart the VmHWM high-water mark (Linux >= 4.0); False if not permitted."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """Resident bytes of this process now, or None without ``/proc``."""
+    return _status_kb('VmRSS')
+
+
+def peak_rss():
+    """Peak resident bytes of this process (since the last reset on Linux)."""
+    peak = _status_kb('VmHWM')
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def io_counters():
+    """``{rchar, wchar, read_bytes, write_bytes}`` of this process, or {}."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {k: int(counters[k]) for k in ('rchar', 'wchar', 'read_bytes', 'write_bytes')}
+
+
+def code_version():
+    """``git describe`` of the repository, or None outside a checkout."""
+    try:
+        return subprocess.run(['git', '-C', REPO, 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def host_info():
+    import dask
+    import xarray
+
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'xarray': xarray.__version__,
+        'dask': dask.__version__,
+    }
+
+
+class _RssSampler(threading.Thread):
+    """Polls RSS while a stage runs, where VmHWM cannot be reset."""
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss() or 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return max(self.peak, current_rss() or 0)
+
+
+# -----------------------------------------------------------------------------
+# Dask task stream
+# -----------------------------------------------------------------------------
+
+def _task_stream():
+    """Callback recording task times of dask's local schedulers, or None.
+
+    Only built when dask has already been imported, i.e. when the stage
+    can compute anything with it.
+    """
+    if 'dask' not in sys.modules:
+        return None
+    from dask.callbacks import Callback
+    from dask.utils import key_split
+
+    class TaskStream(Callback):
+        def __init__(self):
+            super().__init__()
+            self.computes = 0
+            self.graph_tasks = 0
+            self.by_prefix = {}
+            self._started = {}
+
+        def _start(self, dsk):
+            self.computes += 1
+            self.graph_tasks += len(dsk)
+
+        def _pretask(self, key, dsk, state):
+            self._started[key] = time.perf_counter()
+
+        def _posttask(self, key, result, dsk, state, worker_id):
+            seconds = time.perf_counter() - self._started.pop(key, time.perf_counter())
+            entry = self.by_prefix.setdefault(key_split(key), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+        def unregister(self):
+            # Concurrent computes (tiles on a thread pool) each swap the set
+            # of active callbacks out and back, so this one may be gone
+            Callback.active.discard(self._callback)
+
+        def summary(self):
+            ranked = sorted(self.by_prefix.items(), key=lambda kv: -kv[1][1])
+            return {
+                'computes': self.computes,
+                'graph_tasks': self.graph_tasks,
+                'tasks': sum(n for n, _, _ in self.by_prefix.values()),
+                'task_seconds': round(sum(s for _, s, _ in self.by_prefix.values()), 4),
+                'by_prefix': {prefix: {'tasks': n, 'seconds': round(s, 4),
+                                       'max_seconds': round(m, 4)}
+                              for prefix, (n, s, m) in ranked[:TOP_PREFIXES]},
+            }
+
+    return TaskStream()
+
+
+# -----------------------------------------------------------------------------
+# Stages
+# -----------------------------------------------------------------------------
+
+class FieldStats:
+    """Count, mean, min and max of a field, merged from the parts it is built from."""
+
+    def __init__(self):
+        self.count, self.total = 0, 0.0
+        self.min, self.max = np.inf, -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        finite = values[np.isfinite(values)]
+        if finite.size:
+            self.count += finite.size
+            self.total += finite.sum()
+            self.min = min(self.min, finite.min())
+            self.max = max(self.max, finite.max())
+
+    def as_dict(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': round(self.total / self.count, 4),
+                'min': round(float(self.min), 4), 'max': round(float(self.max), 4)}
+
+
+class Stage:
+    """Measurements of one stage; ``info``, ``counters`` and ``fields`` are
+    filled in by the code running in it. Stages are not nested."""
+
+    def __init__(self, name, report=None):
+        self.name = name
+        self.report = report
+        self.info = {}
+        self.counters = {}
+        self.fields = {}
+        self.record = {}
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def summarize(self, field, values):
+        """Fold ``values`` (a part of ``field``, e.g. one tile) into its statistics."""
+        self.fields.setdefault(field, FieldStats()).add(values)
+
+    def __enter__(self):
+        self._peak_reset = reset_peak_rss()
+        self._sampler = None
+        if not self._peak_reset and current_rss() is not None:
+            self._sampler = _RssSampler()
+            self._sampler.start()
+        self._tasks = _task_stream()
+        if self._tasks is not None:
+            self._tasks.register()
+        self._rss_start = current_rss()
+        self._io = io_counters()
+        self._started = datetime.now()
+        self._clock = time.perf_counter()
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _active.remove(self)
+        seconds = time.perf_counter() - self._clock
+        io = io_counters()
+        if self._tasks is not None:
+            self._tasks.unregister()
+        peak = self._sampler.stop() if self._sampler is not None else peak_rss()
+        self.record = {
+            'name': self.name,
+            'status': 'ok' if exc_type is None else 'failed',
+            'started': self._started.isoformat(timespec='seconds'),
+            'seconds': round(seconds, 4),
+            'rss_start': self._rss_start,
+            'rss_end': current_rss(),
+            'peak_rss': peak,
+            # Without a reset or sampler the peak covers the whole process
+            'peak_rss_scope': 'stage' if self._peak_reset or self._sampler else 'process',
+            'bytes_read': io['rchar'] - self._io['rchar'] if io else None,
+            'disk_bytes_read': io['read_bytes'] - self._io['read_bytes'] if io else None,
+            'bytes_written': io['wchar'] - self._io['wchar'] if io else None,
+        }
+        if exc_type is not None:
+            self.record['error'] = f'{exc_type.__name__}: {exc}'
+        if self._tasks is not None and self._tasks.computes:
+            self.record['dask'] = self._tasks.summary()
+        for key in ('info', 'counters'):
+            if getattr(self, key):
+                self.record[key] = getattr(self, key)
+        if self.fields:
+            self.record['fields'] = {k: v.as_dict() for k, v in self.fields.items()}
+        if self.report is not None:
+            self.report._finished(self)
+        return False
+
+
+def current_stage():
+    """The innermost active stage, or None outside any ``RunReport.stage``."""
+    return _active[-1] if _active else None
+
+
+class RunReport:
+    """Stage records of one run, printed as they finish and written as JSON.
+
+    Parameters
+    ----------
+    run : str
+        Name of the pipeline (``metrics``).
+    settings : dict, optional
+        The run's settings, stored as given (must be JSON-serializable).
+    verbose : bool
+        Print one line per finished stage.
+    """
+
+    def __init__(self, run, settings=None, verbose=True):
+        self.run = run
+        self.settings = dict(settings or {})
+        self.verbose = verbose
+        self.stages = []
+        self.started = datetime.now()
+        self._clock = time.perf_counter()
+
+    def stage(self, name):
+        """Context manager measuring stage ``name``; yields its ``Stage``."""
+        return Stage(name, self)
+
+    def _finished(self, stage):
+        self.stages.append(stage)
+        if not self.verbose:
+            return
+        r = stage.record
+        line = f"  {r['name']:<16} {r['seconds']:8.2f} s  {r['peak_rss'] / MB:7.0f} MB peak"
+        if r['bytes_read'] is not None:
+            line += f"  {r['bytes_read'] / MB:8.1f} MB read"
+        if 'dask' in r:
+            line += f"  {r['dask']['tasks']} dask tasks"
+        if r['status'] != 'ok':
+            line += f"  FAILED ({r['error']})"
+        print(line)
+
+    def field_stats(self):
+        """``{field: stats}`` summarized by every finished stage."""
+        return {name: stats.as_dict() for stage in self.stages
+                for name, stats in stage.fields.items()}
+
+    def as_dict(self):
+        return {
+            'report_version': REPORT_VERSION,
+            'run': self.run,
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - self._clock, 4),
+            'version': code_version(),
+            'host': host_info(),
+            'settings': self.settings,
+            'stages': [stage.record for stage in self.stages],
+        }
+
+    def write(self, path):
+        """Write the report as JSON; returns ``path``."""
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, default=str)
+        os.replace(tmp, path)
+        return path
@@ -0,0 +1,166 @@
+"""Load test of a running ``analog_service``.
+
+Sends a mix of point, analog and tile requests from concurrent keep-alive
+connections and reports throughput, latency percentiles and non-2xx
+responses per endpoint. Points are drawn from land cells that have analogs
+(found by probing the service before the clock starts); tiles at random
+positions of the given zoom levels, so the cache hit rate depends on how
+many distinct requests fit in the service's caches.
+
+    python service_loadtest.py --url http://127.0.0.1:8765 -n 5000 -c 16
+"""
+
+import argparse
+import http.client
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+def land_points(url, n=200, attempts=5000, seed=0):
+    """Up to ``n`` ``(lat, lon)`` of land cells the service has analogs for.
+
+    Candidates are drawn over -55..70 latitude and kept if ``/point`` gives
+    a biome and an ``/analogs`` query with ``k=1`` (a key the test itself
+    does not use, so its caches stay cold) succeeds.
+    """
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port)
+    rng = random.Random(seed)
+    points = []
+
+    def get(path):
+        conn.request('GET', path)
+        response = conn.getresponse()
+        body = response.read()
+        return response.status, body
+
+    for _ in range(attempts):
+        if len(points) >= n:
+            break
+        lat, lon = round(rng.uniform(-55, 70), 2), round(rng.uniform(-180, 180), 2)
+        status, body = get(f'/point?lat={lat}&lon={lon}')
+        if status != 200 or json.loads(body)['biome'] is None:
+            continue
+        if get(f'/analogs?lat={lat}&lon={lon}&k=1')[0] == 200:
+            points.append((lat, lon))
+    conn.close()
+    if not points:
+        raise RuntimeError(f"No land cell with analogs found in {attempts} tries")
+    return points
+
+
+def make_requests(n, variables, points, zooms=(2, 3, 4), mix=(0.4, 0.2, 0.4), seed=0):
+    """``(kind, path)`` of ``n`` requests in the proportions point/analogs/tile.
+
+    Point and analog requests are at ``points`` (see ``land_points``).
+    """
+    rng = random.Random(seed)
+    kinds = rng.choices(['point', 'analogs', 'tile'], weights=mix, k=n)
+    out = []
+    for kind in kinds:
+        lat, lon = rng.choice(points)
+        if kind == 'point':
+            out.append((kind, f'/point?lat={lat}&lon={lon}'))
+        elif kind == 'analogs':
+            out.append((kind, f'/analogs?lat={lat}&lon={lon}&k=10'))
+        else:
+            z = rng.choice(zooms)
+            x, y = rng.randrange(2 ** z), rng.randrange(2 ** z)
+            out.append((kind, f'/tiles/{rng.choice(variables)}/{z}/{x}/{y}.png'))
+    return out
+
+
+def run(url, requests, concurrency=8):
+    """Send ``requests`` over ``concurrency`` connections.
+
+    Returns the wall time and per-request ``(kind, status, seconds)``; a
+    request whose connection failed has status 0.
+    """
+    parts = urlsplit(url)
+    shares = [requests[i::concurrency] for i in range(concurrency)]
+
+    def worker(share):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port)
+        results = []
+        for kind, path in share:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port)
+                status = 0
+            results.append((kind, status, time.perf_counter() - start))
+        conn.close()
+        return results
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [r for rs in pool.map(worker, shares) for r in rs]
+    return time.perf_counter() - start, results
+
+
+def report(wall, results):
+    """Print requests per second and p50/p99 latency, overall and per endpoint.
+
+    Latencies are of successful (2xx) responses only; every other response
+    or failed connection is an error, counted per endpoint.
+    """
+    ok = sum(200 <= r[1] < 300 for r in results)
+    print(f"{len(results)} requests in {wall:.2f} s: {len(results) / wall:.1f} req/s "
+          f"({ok / wall:.1f} successful)")
+    print(f"{'endpoint':<10}{'n':>7}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind in ['all'] + sorted({r[0] for r in results}):
+        rows = [r for r in results if kind in ('all', r[0])]
+        ms = np.array([r[2] for r in rows if 200 <= r[1] < 300]) * 1000
+        errors = len(rows) - len(ms)
+        if len(ms):
+            p50, p99 = np.percentile(ms, [50, 99])
+            timing = f"{p50:>10.2f}{p99:>10.2f}{ms.max():>10.2f}"
+        else:
+            timing = f"{'-':>10}{'-':>10}{'-':>10}"
+        print(f"{kind:<10}{len(rows):>7}{errors:>8}{timing}")
+    statuses = sorted({r[1] for r in results if not 200 <= r[1] < 300})
+    for status in statuses:
+        by_kind = {k: sum(1 for r in results if r[0] == k and r[1] == status)
+                   for k in sorted({r[0] for r in results})}
+        print(f"  status {status or 'no response'}: "
+              + ', '.join(f'{k} {n}' for k, n in by_kind.items() if n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8765')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--zooms', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--mix', type=float, nargs=3, default=[0.4, 0.2, 0.4],
+                        metavar=('POINT', 'ANALOGS', 'TILE'))
+    parser.add_argument('--points', type=int, default=200,
+                        help='distinct land cells of the point and analog requests')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    parts = urlsplit(args.url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port)
+    conn.request('GET', '/variables')
+    info = json.loads(conn.getresponse().read())
+    conn.close()
+    variables = [name for name, v in info.items() if len(v['dims']) == 2]
+
+    points = land_points(args.url, args.points, seed=args.seed)
+    print(f"Querying {len(points)} land cells")
+    requests = make_requests(args.requests, variables, points, args.zooms, args.mix, args.seed)
+    report(*run(args.url, requests, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
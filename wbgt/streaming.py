@@ -0,0 +1,103 @@
+"""Time-block streaming over a ``(time, lat, lon)`` DataArray.
+
+Every reduction in this directory consumes the daily stack through these
+helpers, so a memory budget sets how much of it is in RAM at once.
+"""
+
+import numpy as np
+
+# Default peak-memory budget for a streaming pass (bytes)
+DEFAULT_MEMORY_BUDGET = 8 * 1024**3
+
+# Working bytes per loaded value: the float32 value, NaN mask and temporaries
+BLOCK_BYTES_PER_VALUE = 16
+
+
+def time_block_bounds(da, time_chunk=365, max_steps=None):
+    """(start, stop) index pairs covering the time axis of ``da``.
+
+    When ``da`` is dask-backed the bounds follow its time chunks, so every
+    on-disk chunk is read exactly once. ``max_steps`` further splits blocks
+    that would not fit the memory budget.
+    """
+    n_time = da.sizes['time']
+    if da.chunks is not None:
+        edges = np.cumsum((0,) + da.chunks[da.get_axis_num('time')])
+    else:
+        edges = np.append(np.arange(0, n_time, time_chunk), n_time)
+
+    bounds = []
+    for a, b in zip(edges[:-1], edges[1:]):
+        step = (b - a) if max_steps is None else max(1, int(max_steps))
+        for start in range(int(a), int(b), step):
+            bounds.append((start, min(start + step, int(b))))
+    return bounds
+
+
+def iter_time_blocks(da, time_chunk=365, max_steps=None):
+    """Yield ``(years, values)`` for consecutive time blocks of ``da``.
+
+    ``values`` is a loaded ``(time, ...)`` numpy array and ``years`` the
+    calendar year of each of its time steps.
+    """
+    years = da['time'].dt.year.values
+    for start, stop in time_block_bounds(da, time_chunk, max_steps):
+        block = da.isel(time=slice(start, stop)).values
+        yield years[start:stop], block
+
+
+def split_by_year(years, block):
+    """Yield ``(year, values)`` runs of consecutive time steps in one year."""
+    breaks = np.flatnonzero(np.diff(years)) + 1
+    for start, stop in zip(np.r_[0, breaks], np.r_[breaks, len(years)]):
+        yield int(years[start]), block[start:stop]
+
+
+def plan_tiles(da, state_bytes_per_cell, memory_budget=DEFAULT_MEMORY_BUDGET, min_tiles=1):
+    """Split the last (longitude) dimension and the time axis to fit a budget.
+
+    Half of ``memory_budget`` is reserved for per-cell accumulator state and
+    the rest for the loaded time block. ``min_tiles`` asks for about that
+    many tiles, so concurrent workers each get some. When ``da`` is
+    dask-backed, tiles are made of whole chunks of the last dimension; a
+    chunk is only split when it does not fit the budget or there are fewer
+    chunks than ``min_tiles``, since every tile of a chunk reads all of it.
+
+    Returns
+    -------
+    tiles : list of slice
+        Slices of the last dimension; each tile is streamed separately, so
+        more than one tile means the time axis is read once per tile.
+    max_steps : int
+        Longest time block that fits next to one tile's state.
+    """
+    n_time = da.sizes['time']
+    spatial = [da.sizes[d] for d in da.dims if d != 'time']
+    n_lon = spatial[-1]
+    n_rows = int(np.prod(spatial[:-1]))
+
+    state_budget = memory_budget // 2
+    tile_lon = int(min(n_lon, max(1, state_budget // max(state_bytes_per_cell * n_rows, 1))))
+    chunks = da.chunks[-1] if da.chunks is not None else (n_lon,)
+    target = min(tile_lon, -(-n_lon // max(1, int(min_tiles))))
+    if len(chunks) < min_tiles:
+        tile_lon = target
+
+    tiles, start, stop = [], 0, 0
+    for size in chunks:
+        if stop > start and (stop - start + size > target or size > tile_lon):
+            tiles.append(slice(start, stop))
+            start = stop
+        stop += size
+        if size > tile_lon:
+            # A chunk larger than a tile is split evenly
+            edges = np.linspace(start, stop, -(-size // tile_lon) + 1).round().astype(int)
+            tiles += [slice(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+            start = stop
+    if stop > start:
+        tiles.append(slice(start, stop))
+
+    tile_cells = max(t.stop - t.start for t in tiles) * n_rows
+    block_budget = memory_budget - tile_cells * state_bytes_per_cell
+    max_steps = int(min(n_time, max(1, block_budget // (tile_cells * BLOCK_BYTES_PER_VALUE))))
+    return tiles, max_steps
@@ -0,0 +1,465 @@
+"""Bounded-memory per-cell quantile estimation over the time axis.
+
+Three estimators consume ``(time, cells)`` blocks one after another, so the
+full daily series of a cell never has to be in memory:
+
+``histogram``
+    Fixed-width bins per cell. Each order statistic is placed within its bin
+    and quantiles interpolate between them, so for values inside
+    ``value_range`` the error is within about one bin width.
+``tdigest``
+    A merging t-digest per cell with a fixed number of centroids; accuracy
+    is best in the tails, where the p90/p95/p99 thresholds live.
+``exact``
+    Two passes: a coarse histogram locates the bin holding each requested
+    rank, then only the values inside that bin are collected and sorted.
+    Reproduces ``np.nanquantile(..., method='linear')``.
+
+Any list of quantiles is answered from the same sketch.
+"""
+
+import numpy as np
+import xarray as xr
+
+from run_report import current_stage
+from streaming import DEFAULT_MEMORY_BUDGET, iter_time_blocks, plan_tiles
+from year_cache import array_digest
+
+QUANTILE_METHODS = ('histogram', 'tdigest', 'exact')
+
+# Histogram defaults for daily WBGT (degC)
+DEFAULT_VALUE_RANGE = (-40.0, 50.0)
+DEFAULT_BIN_WIDTH = 0.1
+
+
+# =============================================================================
+# Fixed-bin histogram
+# =============================================================================
+
+class HistogramSketch:
+    """Per-cell fixed-width histogram of a value stream.
+
+    Values outside ``value_range`` fall into the first/last bin; the per-cell
+    minimum and maximum keep interpolation in those bins bounded.
+    """
+
+    def __init__(self, n_cells, value_range=DEFAULT_VALUE_RANGE,
+                 bin_width=DEFAULT_BIN_WIDTH, max_count=np.iinfo(np.uint32).max):
+        self.lo, self.hi = value_range
+        self.bin_width = bin_width
+        self.n_bins = int(np.ceil((self.hi - self.lo) / bin_width))
+        dtype = np.uint16 if max_count <= np.iinfo(np.uint16).max else np.uint32
+        self.counts = np.zeros((n_cells, self.n_bins), dtype=dtype)
+        self.n = np.zeros(n_cells, dtype=np.int64)
+        self.vmin = np.full(n_cells, np.inf, dtype=np.float32)
+        self.vmax = np.full(n_cells, -np.inf, dtype=np.float32)
+        self._cells = np.arange(n_cells)
+
+    @staticmethod
+    def bytes_per_cell(value_range=DEFAULT_VALUE_RANGE, bin_width=DEFAULT_BIN_WIDTH, **kwargs):
+        # counts + uint32 cumulative counts and a mask when quantiles are read
+        n_bins = int(np.ceil((value_range[1] - value_range[0]) / bin_width))
+        return n_bins * 9 + 24
+
+    def bin_index(self, values):
+        idx = np.floor((values - self.lo) / self.bin_width)
+        return np.clip(idx, 0, self.n_bins - 1).astype(np.intp)
+
+    def update(self, block):
+        """Add a ``(time, cells)`` block."""
+        for values in block:
+            # One time step holds each cell at most once, so the fancy-index
+            # increment never sees a duplicate (cell, bin) pair.
+            valid = ~np.isnan(values)
+            self.counts[self._cells[valid], self.bin_index(values[valid])] += 1
+        self.n += (~np.isnan(block)).sum(axis=0)
+        self.vmin = np.fmin(self.vmin, np.fmin.reduce(block, axis=0))
+        self.vmax = np.fmax(self.vmax, np.fmax.reduce(block, axis=0))
+
+    def state(self):
+        """Arrays that fully describe the sketch, for caching."""
+        return {'sketch_counts': self.counts, 'sketch_n': self.n,
+                'sketch_vmin': self.vmin, 'sketch_vmax': self.vmax}
+
+    def merge(self, state):
+        """Add a sketch of the same cells built from other time steps."""
+        self.counts += state['sketch_counts'].astype(self.counts.dtype)
+        self.n += state['sketch_n']
+        self.vmin = np.fmin(self.vmin, state['sketch_vmin'])
+        self.vmax = np.fmax(self.vmax, state['sketch_vmax'])
+
+    def locate(self, ranks):
+        """Bin holding 0-based rank ``ranks`` of each cell, and the count below it."""
+        cum = np.cumsum(self.counts, axis=1, dtype=np.uint32)
+        b = np.minimum((cum <= ranks[:, None]).sum(axis=1), self.n_bins - 1)
+        below = cum[self._cells, b].astype(np.int64) - self.counts[self._cells, b]
+        return b, below
+
+    def bin_bounds(self, b):
+        """Edges of bins ``b``, clamped to the observed range of each cell."""
+        lo = np.maximum(self.lo + b * self.bin_width, self.vmin)
+        hi = np.minimum(self.lo + (b + 1) * self.bin_width, self.vmax)
+        return lo, np.maximum(hi, lo)
+
+    def order_statistics(self, ranks):
+        """Estimated value of 0-based rank ``ranks`` of each cell.
+
+        The values of a bin are taken as evenly spread over it; the lowest and
+        highest ranks are the cell's minimum and maximum.
+        """
+        b, below = self.locate(ranks)
+        count = self.counts[self._cells, b].astype(np.float64)
+        lo, hi = self.bin_bounds(b)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.clip((ranks - below + 0.5) / count, 0, 1)
+            values = np.where(ranks <= 0, self.vmin, lo + frac * (hi - lo))
+        return np.where(ranks >= self.n - 1, self.vmax, values)
+
+    def quantiles(self, qs):
+        """``(len(qs), cells)`` quantiles, interpolating between ranks.
+
+        As ``np.nanquantile(..., method='linear')``: rank ``q * (n - 1)`` lies
+        between two order statistics, each estimated within its own bin, so
+        sparse tail bins do not pull the estimate to a bin edge.
+        """
+        out = np.full((len(qs), len(self.n)), np.nan, dtype=np.float32)
+        has_data = self.n > 0
+        last = (self.n - 1).clip(0)
+        for i, q in enumerate(qs):
+            h = last * q
+            r = np.floor(h)
+            lower = self.order_statistics(r)
+            upper = self.order_statistics(np.minimum(r + 1, last))
+            # Empty cells have an infinite range and are NaN anyway
+            with np.errstate(invalid='ignore'):
+                out[i] = np.where(has_data, lower + (h - r) * (upper - lower), np.nan)
+        return out
+
+    def refiner(self, qs):
+        """Second-pass collector that turns this histogram into exact quantiles."""
+        return QuantileRefiner(self, qs)
+
+
+# =============================================================================
+# Merging t-digest
+# =============================================================================
+
+class TDigestSketch:
+    """Per-cell merging t-digest with at most ``compression`` centroids.
+
+    New values are merged with the existing centroids and re-binned with the
+    arcsine scale function, so centroids stay small near both tails.
+    """
+
+    def __init__(self, n_cells, compression=100):
+        self.compression = int(compression)
+        self.means = np.full((n_cells, self.compression), np.inf, dtype=np.float32)
+        self.weights = np.zeros((n_cells, self.compression), dtype=np.float32)
+        self.vmin = np.full(n_cells, np.inf, dtype=np.float32)
+        self.vmax = np.full(n_cells, -np.inf, dtype=np.float32)
+        self._cells = np.arange(n_cells)
+
+    @staticmethod
+    def bytes_per_cell(compression=100, **kwargs):
+        # centroids plus the merge workspace for one block
+        return compression * 8 * 4 + 16
+
+    def update(self, block):
+        """Add a ``(time, cells)`` block."""
+        values = block.T.astype(np.float32)
+        valid = ~np.isnan(values)
+        self._compress(np.where(valid, values, np.inf), valid.astype(np.float32))
+        self.vmin = np.fmin(self.vmin, np.fmin.reduce(block, axis=0))
+        self.vmax = np.fmax(self.vmax, np.fmax.reduce(block, axis=0))
+
+    def state(self):
+        """Arrays that fully describe the sketch, for caching."""
+        return {'sketch_means': self.means, 'sketch_weights': self.weights,
+                'sketch_vmin': self.vmin, 'sketch_vmax': self.vmax}
+
+    def merge(self, state):
+        """Add a digest of the same cells built from other time steps."""
+        self._compress(state['sketch_means'], state['sketch_weights'])
+        self.vmin = np.fmin(self.vmin, state['sketch_vmin'])
+        self.vmax = np.fmax(self.vmax, state['sketch_vmax'])
+
+    def _compress(self, new_means, new_weights):
+        """Merge ``(cells, m)`` centroids into the digest and re-bin."""
+        means = np.concatenate([self.means, new_means], axis=1)
+        weights = np.concatenate([self.weights, new_weights], axis=1)
+
+        order = np.argsort(means, axis=1, kind='stable')
+        means = np.take_along_axis(means, order, axis=1)
+        weights = np.take_along_axis(weights, order, axis=1)
+
+        total = weights.sum(axis=1, keepdims=True)
+        cum_before = np.cumsum(weights, axis=1) - weights
+        with np.errstate(invalid='ignore', divide='ignore'):
+            q = np.where(total > 0, cum_before / total, 0)
+        k = self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5)
+        bins = np.minimum(np.floor(k), self.compression - 1).astype(np.intp)
+
+        flat = (bins + self._cells[:, None] * self.compression).ravel()
+        size = len(self._cells) * self.compression
+        new_w = np.bincount(flat, weights=weights.ravel(), minlength=size)
+        new_mw = np.bincount(flat, weights=(np.where(weights > 0, means, 0) * weights).ravel(),
+                             minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_m = np.where(new_w > 0, new_mw / new_w, np.inf)
+
+        self.weights = new_w.reshape(-1, self.compression).astype(np.float32)
+        self.means = new_m.reshape(-1, self.compression).astype(np.float32)
+
+    def quantiles(self, qs):
+        """``(len(qs), cells)`` quantiles interpolated between centroids."""
+        order = np.argsort(self.means, axis=1, kind='stable')
+        means = np.take_along_axis(self.means, order, axis=1).astype(np.float64)
+        weights = np.take_along_axis(self.weights, order, axis=1).astype(np.float64)
+        n = weights.sum(axis=1)
+
+        # Centroid centres on the rank axis, bracketed by (0, min) and (n, max);
+        # empty centroids sort last and collapse onto (n, max).
+        centres = np.cumsum(weights, axis=1) - weights / 2
+        empty = weights == 0
+        centres = np.where(empty, n[:, None], centres)
+        means = np.where(empty, self.vmax[:, None], means)
+        x = np.concatenate([np.zeros((len(n), 1)), centres, n[:, None]], axis=1)
+        y = np.concatenate([self.vmin[:, None], means, self.vmax[:, None]], axis=1)
+
+        out = np.full((len(qs), len(n)), np.nan, dtype=np.float32)
+        for i, q in enumerate(qs):
+            # Singleton centroids sit at rank + 0.5, so this target reproduces
+            # linear interpolation between order statistics.
+            target = (n - 1).clip(0) * q + 0.5
+            j = np.clip((x < target[:, None]).sum(axis=1), 1, x.shape[1] - 1)
+            x0, x1 = x[self._cells, j - 1], x[self._cells, j]
+            y0, y1 = y[self._cells, j - 1], y[self._cells, j]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac = np.where(x1 > x0, (target - x0) / (x1 - x0), 1.0)
+            out[i] = np.where(n > 0, y0 + frac * (y1 - y0), np.nan)
+        return out
+
+
+# =============================================================================
+# Exact two-pass refinement
+# =============================================================================
+
+class QuantileRefiner:
+    """Collects the values bracketing each requested rank on a second pass.
+
+    The first-pass histogram fixes, per cell and quantile, the bins holding
+    the two order statistics either side of the rank. Only values falling in
+    those bins are kept (in a CSR buffer sized from the histogram counts), so
+    memory scales with the bin width rather than with the time axis.
+    """
+
+    def __init__(self, hist, qs):
+        self.hist = hist
+        self.qs = list(qs)
+        n = hist.n
+        self.brackets = []
+        for q in self.qs:
+            h = (n - 1).clip(0) * q
+            k0 = np.floor(h).astype(np.int64)
+            k1 = np.minimum(k0 + 1, (n - 1).clip(0))
+            b0, below = hist.locate(k0.astype(np.float64))
+            b1, _ = hist.locate(k1.astype(np.float64))
+            cum_b1 = np.cumsum(hist.counts, axis=1, dtype=np.uint32)[hist._cells, b1]
+            sizes = cum_b1.astype(np.int64) - below
+            offsets = np.r_[0, np.cumsum(sizes)]
+            self.brackets.append({
+                'h': h, 'k0': k0, 'k1': k1, 'b0': b0, 'b1': b1, 'below': below,
+                'above': n - cum_b1.astype(np.int64), 'offsets': offsets,
+                'values': np.empty(offsets[-1], dtype=np.float32),
+                'fill': np.zeros(len(n), dtype=np.int64),
+            })
+
+    @property
+    def nbytes(self):
+        return sum(b['values'].nbytes for b in self.brackets)
+
+    @property
+    def digest(self):
+        """Hash of the brackets; second-pass state is only valid for these."""
+        return array_digest(*[a for br in self.brackets for a in (br['b0'], br['b1'])])
+
+    def collect(self, block):
+        """Bracketed values of a ``(time, cells)`` block, as per-quantile
+        ``cells_<i>``/``values_<i>`` arrays in time order, plus ``above_<i>``,
+        the per-cell count of values above the bracket."""
+        found = [([], []) for _ in self.brackets]
+        above = [np.zeros(len(self.hist.n), dtype=np.int32) for _ in self.brackets]
+        for values in block:
+            valid = ~np.isnan(values)
+            idx = np.where(valid, self.hist.bin_index(np.where(valid, values, 0)), -1)
+            for br, (cells, kept), n_above in zip(self.brackets, found, above):
+                inside = np.flatnonzero((idx >= br['b0']) & (idx <= br['b1']))
+                cells.append(inside)
+                kept.append(values[inside].astype(np.float32))
+                n_above += idx > br['b1']
+        out = {}
+        for i, (cells, kept) in enumerate(found):
+            out[f'cells_{i}'] = np.concatenate(cells) if cells else np.empty(0, np.intp)
+            out[f'values_{i}'] = np.concatenate(kept) if kept else np.empty(0, np.float32)
+            out[f'above_{i}'] = above[i]
+        return out
+
+    def add(self, collected, tag=None):
+        """Store values returned by ``collect`` (blocks must be added in time order).
+
+        ``tag`` (e.g. the year's position) labels the values so that
+        ``count_at_or_above_by_tag`` can split exceedances by it.
+        """
+        for i, br in enumerate(self.brackets):
+            cells, values = collected[f'cells_{i}'], collected[f'values_{i}']
+            # Within one call a cell can appear many times; number its repeats
+            order = np.argsort(cells, kind='stable')
+            sorted_cells = cells[order]
+            first = np.searchsorted(sorted_cells, sorted_cells, side='left')
+            repeat = np.empty(len(cells), dtype=np.int64)
+            repeat[order] = np.arange(len(cells)) - first
+            slots = br['offsets'][cells] + br['fill'][cells] + repeat
+            br['values'][slots] = values
+            if tag is not None:
+                if 'tags' not in br:
+                    br['tags'] = np.full(len(br['values']), -1, dtype=np.int16)
+                    br['above_by_tag'] = {}
+                br['tags'][slots] = tag
+                above = br['above_by_tag'].setdefault(tag, np.zeros(len(br['fill']), np.int32))
+                above += collected[f'above_{i}']
+            br['fill'] += np.bincount(cells, minlength=len(br['fill']))
+
+    def update(self, block):
+        """Add a ``(time, cells)`` block (the same stream as the first pass)."""
+        self.add(self.collect(block))
+
+    def _sorted(self, br):
+        segment = np.repeat(self.hist._cells, np.diff(br['offsets']))
+        return br['values'][np.lexsort((br['values'], segment))], segment
+
+    def quantiles(self):
+        """``(len(qs), cells)`` exact linear-interpolated quantiles."""
+        n = self.hist.n
+        out = np.full((len(self.qs), len(n)), np.nan, dtype=np.float64)
+        for i, br in enumerate(self.brackets):
+            values, _ = self._sorted(br)
+            has_data = n > 0
+            start = br['offsets'][:-1]
+            i0 = np.where(has_data, start + br['k0'] - br['below'], 0)
+            i1 = np.where(has_data, start + br['k1'] - br['below'], 0)
+            if len(values) == 0:
+                continue
+            v0 = values[np.clip(i0, 0, len(values) - 1)].astype(np.float64)
+            v1 = values[np.clip(i1, 0, len(values) - 1)].astype(np.float64)
+            out[i] = np.where(has_data, v0 + (br['h'] - br['k0']) * (v1 - v0), np.nan)
+        return out
+
+    def count_at_or_above(self, thresholds):
+        """Per-cell count of values ``>=`` each quantile, without another pass.
+
+        Everything above the bracket exceeds the quantile and nothing below
+        it can, so only the collected bracket values need comparing.
+        """
+        counts = np.zeros((len(self.qs), len(self.hist.n)), dtype=np.int64)
+        for i, br in enumerate(self.brackets):
+            values, segment = self._sorted(br)
+            hits = values >= thresholds[i][segment]
+            counts[i] = br['above'] + np.bincount(segment[hits], minlength=len(self.hist.n))
+        return counts
+
+    def count_at_or_above_by_tag(self, thresholds, n_tags):
+        """``(len(qs), n_tags, cells)`` counts of values ``>=`` each quantile,
+        split by the ``tag`` given to ``add``."""
+        n_cells = len(self.hist.n)
+        counts = np.zeros((len(self.qs), n_tags, n_cells), dtype=np.int32)
+        for i, br in enumerate(self.brackets):
+            segment = np.repeat(self.hist._cells, np.diff(br['offsets']))
+            hits = (br['values'] >= thresholds[i][segment]) & (br['tags'] >= 0)
+            flat = br['tags'][hits].astype(np.int64) * n_cells + segment[hits]
+            counts[i] = np.bincount(flat, minlength=n_tags * n_cells).reshape(n_tags, n_cells)
+            for tag, above in br['above_by_tag'].items():
+                counts[i, tag] += above
+        return counts
+
+
+# =============================================================================
+# Driver
+# =============================================================================
+
+def make_sketch(method, n_cells, n_time, **kwargs):
+    """First-pass sketch for ``method`` over ``n_cells`` cells."""
+    if method in ('histogram', 'exact'):
+        return HistogramSketch(n_cells, max_count=n_time,
+                               **{k: v for k, v in kwargs.items()
+                                  if k in ('value_range', 'bin_width')})
+    if method == 'tdigest':
+        return TDigestSketch(n_cells, **{k: v for k, v in kwargs.items() if k == 'compression'})
+    raise ValueError(f"Unknown quantile method {method!r}; expected one of {QUANTILE_METHODS}")
+
+
+def sketch_bytes_per_cell(method, **kwargs):
+    """Approximate per-cell state of the ``method`` sketch (bytes)."""
+    if method in ('histogram', 'exact'):
+        return HistogramSketch.bytes_per_cell(**kwargs)
+    if method == 'tdigest':
+        return TDigestSketch.bytes_per_cell(**kwargs)
+    raise ValueError(f"Unknown quantile method {method!r}; expected one of {QUANTILE_METHODS}")
+
+
+def streaming_quantiles(da, quantiles=(0.95,), method='exact',
+                        memory_budget=DEFAULT_MEMORY_BUDGET, **kwargs):
+    """Per-cell quantiles of ``da`` over time in bounded memory.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        ``(time, lat, lon)`` data, typically dask-backed.
+    quantiles : sequence of float
+        Quantiles in [0, 1], all estimated in the same pass.
+    method : {'histogram', 'tdigest', 'exact'}
+        Estimator; ``exact`` reads the data twice.
+    memory_budget : int
+        Peak bytes for sketch state plus the loaded time block. The grid is
+        split into longitude tiles only if one tile's state would not fit.
+    **kwargs
+        ``value_range``/``bin_width`` for the histogram methods,
+        ``compression`` for ``tdigest``.
+
+    Returns
+    -------
+    xr.DataArray
+        Quantiles with a leading ``quantile`` dimension.
+    """
+    quantiles = list(np.atleast_1d(quantiles))
+    spatial_dims = [d for d in da.dims if d != 'time']
+    shape = [da.sizes[d] for d in spatial_dims]
+    n_time = da.sizes['time']
+    tiles, max_steps = plan_tiles(da, sketch_bytes_per_cell(method, **kwargs), memory_budget)
+
+    stage = current_stage()
+    if stage is not None:
+        stage.info.update(quantile_tiles=len(tiles), max_block_steps=max_steps)
+
+    out = np.full([len(quantiles)] + shape, np.nan, dtype=np.float32)
+    for tile in tiles:
+        sub = da.isel({spatial_dims[-1]: tile})
+        n_cells = int(np.prod([sub.sizes[d] for d in spatial_dims]))
+        sketch = make_sketch(method, n_cells, n_time, **kwargs)
+        for _, block in iter_time_blocks(sub, max_steps=max_steps):
+            sketch.update(block.reshape(len(block), -1))
+
+        if method == 'exact':
+            refiner = sketch.refiner(quantiles)
+            if stage is not None:
+                stage.count('refine_bytes', int(refiner.nbytes))
+            for _, block in iter_time_blocks(sub, max_steps=max_steps):
+                refiner.update(block.reshape(len(block), -1))
+            values = refiner.quantiles()
+        else:
+            values = sketch.quantiles(quantiles)
+        out[(slice(None),) + (slice(None),) * (len(shape) - 1) + (tile,)] = \
+            values.reshape([len(quantiles)] + [sub.sizes[d] for d in spatial_dims])
+
+    coords = {d: da[d] for d in spatial_dims}
+    coords['quantile'] = quantiles
+    return xr.DataArray(out, coords=coords, dims=['quantile'] + spatial_dims)
@@ -0,0 +1,206 @@
+"""Synthetic daily ``wbgtmax`` stacks and biome rasters for benchmarks.
+
+The real 1950-2020 archive only exists on the NCAR filesystem. These files
+have its layout (one ``wbgtmax_<year>_daily_ERA5.nc`` per year on a
+``latitude``/``longitude`` grid from 90N to 60S, 0..360 longitudes, deflated
+float32) and a field that exercises every metric: a latitude-dependent
+climatology with spatial texture, a seasonal cycle of opposite phase in
+each hemisphere, a warming trend and persistent day-to-day anomalies, so
+thresholds, heat spells and p95 are all non-trivial. The matching biome
+raster has about 30% land split into the 15 ``BIOME_ID`` classes by
+latitude band.
+
+Each year is written from a dask array one time block at a time, so the
+full 0.25 degree grid fits in the memory of a laptop.
+
+    python synthetic_era5.py --size small --output wbgt_benchmark/data
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+# (resolution in degrees, number of years) of the named sizes
+SIZES = {
+    'tiny': (2.0, 2),
+    'small': (1.0, 5),
+    'medium': (0.5, 20),
+    'era5': (0.25, 71),
+}
+
+MANIFEST = 'synthetic.json'
+FILE_PATTERN = 'wbgtmax_{year}_daily_ERA5.nc'
+BIOME_FILE = 'biomes.synthetic.gridded.nc'
+
+LAT_RANGE = (90.0, -60.0)
+LAND_FRACTION = 0.29
+
+# BIOME_ID classes drawn in each absolute-latitude band
+BIOME_BANDS = [
+    (15, [14, 13, 4, 3]),
+    (30, [2, 13, 12, 11]),
+    (50, [8, 10, 5, 2, 6]),
+    (65, [1, 9]),
+    (75, [15, 1]),
+    (91, [7, 15]),
+]
+
+
+def grid(resolution):
+    """ERA5 ``(latitude, longitude)`` and biome ``(lat, lon)`` coordinates."""
+    lat = np.linspace(*LAT_RANGE, int(round((LAT_RANGE[0] - LAT_RANGE[1]) / resolution)) + 1)
+    n_lon = int(round(360 / resolution))
+    era5_lon = np.arange(n_lon) * resolution
+    biome_lon = era5_lon - 180.0
+    return lat, era5_lon, biome_lon
+
+
+def smooth_field(lat, lon, seed, waves=16, max_wavenumber=6):
+    """Unit-variance field of a few random low-wavenumber waves on the sphere."""
+    rng = np.random.default_rng(seed)
+    phi, lam = np.deg2rad(lat)[:, None], np.deg2rad(lon)[None, :]
+    field = np.zeros((len(lat), len(lon)))
+    for _ in range(waves):
+        k, m = rng.integers(1, max_wavenumber + 1, size=2)
+        phase = rng.uniform(0, 2 * np.pi, size=2)
+        field += np.cos(k * phi + phase[0]) * np.cos(m * lam + phase[1])
+    return (field - field.mean()) / field.std()
+
+
+def biome_raster(resolution, seed=0):
+    """``BIOME_ID`` dataset with NaN ocean, on the ``lat``/``lon`` biome grid."""
+    import xarray as xr
+
+    from biome_figures import BIOME_NAMES
+
+    lat, _, lon = grid(resolution)
+    land = smooth_field(lat, lon, seed)
+    land = land > np.quantile(land, 1 - LAND_FRACTION)
+    # Uniform in [0, 1) by rank, so every class of a band is drawn
+    choice = smooth_field(lat, lon, seed + 1)
+    choice = np.argsort(np.argsort(choice, axis=None)).reshape(choice.shape) / choice.size
+    biome = np.full(land.shape, np.nan)
+    abs_lat = np.broadcast_to(np.abs(lat)[:, None], land.shape)
+    lower = 0
+    for upper, ids in BIOME_BANDS:
+        band = land & (abs_lat >= lower) & (abs_lat < upper)
+        pick = np.clip((choice * len(ids)).astype(int), 0, len(ids) - 1)
+        biome[band] = np.asarray(ids)[pick[band]]
+        lower = upper
+    return xr.Dataset({'BIOME_ID': (('lat', 'lon'), biome)},
+                      coords={'lat': lat, 'lon': lon},
+                      attrs={'eco_name_mapping': str(BIOME_NAMES)})
+
+
+def _year_block(block, lat, lon, days, year, climatology, seed, block_info=None):
+    """One ``(time, lat, lon)`` block of a year's daily maxima."""
+    from scipy.signal import lfilter
+
+    start = block_info[None]['array-location'][0][0]
+    doy = days[start:start + block.shape[0]]
+    rng = np.random.default_rng([seed, year, start])
+    abs_lat = np.abs(lat)[None, :, None]
+    # Peak in late July north of the equator and late January south of it
+    season = np.cos(2 * np.pi * (doy[:, None, None] - 205) / 365.25)
+    season = np.where(lat[None, :, None] >= 0, season, -season)
+    amplitude = 2 + 10 * np.sin(np.deg2rad(np.minimum(abs_lat, 70)))
+    trend = 0.02 * (year - 1950)
+    # AR(1) anomalies, so exceedances come in multi-day spells
+    noise = lfilter([1.0], [1.0, -0.7], rng.normal(0, 1.2, block.shape), axis=0)
+    return (climatology[None] + amplitude * season + trend + noise).astype(np.float32)
+
+
+def write_year(path, year, resolution, seed=0, time_block=31, chunks=None, complevel=1):
+    """Write one year's ``wbgtmax`` file.
+
+    ``chunks`` is the on-disk HDF5 chunk shape (default one day per chunk).
+    """
+    import dask.array as dsa
+    import pandas as pd
+    import xarray as xr
+
+    lat, lon, _ = grid(resolution)
+    time = pd.date_range(f'{year}-01-01', f'{year}-12-31', freq='D')
+    climatology = (29 - 24 * np.sin(np.deg2rad(lat))[:, None] ** 2
+                   + 2 * smooth_field(lat, lon, seed + 2))
+    template = dsa.zeros((len(time), len(lat), len(lon)), dtype=np.float32,
+                         chunks=(time_block, len(lat), len(lon)))
+    values = template.map_blocks(_year_block, lat, lon, np.asarray(time.dayofyear), year,
+                                 climatology, seed, dtype=np.float32)
+    ds = xr.Dataset(
+        {'wbgtmax': (('time', 'latitude', 'longitude'), values,
+                     {'units': 'degC', 'long_name': 'daily maximum wet bulb globe temperature'})},
+        coords={'time': time, 'latitude': lat, 'longitude': lon})
+    chunks = chunks or (1, len(lat), len(lon))
+    ds.to_netcdf(path, encoding={'wbgtmax': {'zlib': True, 'complevel': complevel,
+                                             'chunksizes': tuple(chunks)}})
+    return path
+
+
+def ensure_synthetic(directory, resolution, years, start_year=1950, seed=0, chunks=None):
+    """Generate the stack and biome raster in ``directory`` unless present.
+
+    Files are reused when ``synthetic.json`` records the same parameters, so
+    repeated benchmark runs read identical inputs.
+
+    Returns
+    -------
+    dict
+        ``files`` (glob of the yearly files), ``biome_file``, the year range
+        and the grid shape.
+    """
+    params = {'resolution': resolution, 'years': years, 'start_year': start_year,
+              'seed': seed, 'chunks': list(chunks) if chunks else None}
+    manifest = os.path.join(directory, MANIFEST)
+    info = {
+        'files': os.path.join(directory, FILE_PATTERN.format(year='*')),
+        'biome_file': os.path.join(directory, BIOME_FILE),
+        'start_year': start_year,
+        'end_year': start_year + years - 1,
+        'shape': [years] + [len(c) for c in grid(resolution)[:2]],
+    }
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f) == params:
+                return info
+        os.remove(manifest)
+
+    # Also clears the files of an interrupted run, which the glob would match
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith('wbgtmax_') or name == BIOME_FILE:
+            os.remove(os.path.join(directory, name))
+    biome_raster(resolution, seed).to_netcdf(info['biome_file'])
+    for year in range(start_year, start_year + years):
+        print(f"  Writing synthetic {year} ({resolution} deg)")
+        write_year(os.path.join(directory, FILE_PATTERN.format(year=year)), year, resolution,
+                   seed=seed, chunks=chunks)
+    with open(manifest, 'w') as f:
+        json.dump(params, f)
+    return info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', choices=list(SIZES), default='small')
+    parser.add_argument('--resolution', type=float, help='grid spacing in degrees '
+                                                         '(overrides --size)')
+    parser.add_argument('--years', type=int, help='number of years (overrides --size)')
+    parser.add_argument('--start-year', type=int, default=1950)
+    parser.add_argument('--chunks', type=int, nargs=3, metavar=('TIME', 'LAT', 'LON'),
+                        help='on-disk chunk shape (default: one day per chunk)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='wbgt_benchmark/data')
+    args = parser.parse_args(argv)
+
+    resolution, years = SIZES[args.size]
+    info = ensure_synthetic(args.output, args.resolution or resolution, args.years or years,
+                            args.start_year, args.seed, args.chunks)
+    print(f"{info['files']} ({' x '.join(map(str, info['shape']))} year x lat x lon), "
+          f"{info['biome_file']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""The annual WBGT metrics, as entries of the metric registry.
+
+Each metric declares the per-year accumulators it needs (sum/count,
+threshold counts, counts above the per-cell p95, heat-spell runs) and its
+CF attributes;
+``metric_registry.compute_metrics`` evaluates any set of them with shared
+accumulators from the same reads of the daily ``wbgtmax`` stack.
+"""
+
+import numpy as np
+
+from metric_registry import (Exceedance, Metric, Spells, SumCount, compute_metrics,
+                             get_metrics, register)
+from streaming import DEFAULT_MEMORY_BUDGET
+
+# =============================================================================
+# Output variable attributes (CF)
+# =============================================================================
+
+ANNUAL_MEAN_ATTRS = {
+    'long_name': 'Multi-year mean of annual maximum wet bulb globe temperature',
+    'units': 'degC',
+    'description': 'Mean of annual maximum WBGT values averaged across all years',
+    'grid_mapping': 'crs'
+}
+
+P95_ATTRS = {
+    'long_name': '95th percentile of daily maximum wet bulb globe temperature',
+    'units': 'degC',
+    'description': '95th percentile threshold across entire time period',
+    'grid_mapping': 'crs'
+}
+
+DAYS_ABOVE_P95_ATTRS = {
+    'long_name': 'Mean annual days exceeding 95th percentile WBGT',
+    'units': 'days',
+    'description': 'Average number of days per year exceeding the 95th percentile threshold',
+    'grid_mapping': 'crs'
+}
+
+# Fixed heat-risk thresholds (degC) and their risk level
+RISK_THRESHOLDS = {27: 'moderate', 29: 'high', 31: 'extreme'}
+
+
+def threshold_attrs(threshold, risk_level):
+    """CF attributes of a ``days_above_<threshold>C`` variable."""
+    return {
+        'long_name': f'Mean annual days with WBGT ≥ {threshold}°C',
+        'units': 'days',
+        'description': (f'Average number of days per year with {risk_level} heat risk '
+                        f'(WBGT ≥ {threshold}°C)'),
+        'risk_level': risk_level,
+        'grid_mapping': 'crs'
+    }
+
+
+def spell_attrs(threshold, risk_level, min_days):
+    """CF attributes of the heat-spell variables above ``threshold``."""
+    spell = f'spells of at least {min_days} consecutive days with WBGT ≥ {threshold}°C'
+    common = {'risk_level': risk_level, 'spell_min_days': min_days, 'grid_mapping': 'crs'}
+    return {
+        'longest': {
+            'long_name': f'Mean annual longest run of days with WBGT ≥ {threshold}°C',
+            'units': 'days',
+            'description': (f'Longest run of consecutive days with {risk_level} heat risk, '
+                            'averaged across years; runs crossing a year end count in the '
+                            'year they end'),
+            **common},
+        'count': {
+            'long_name': f'Mean annual number of {spell}',
+            'units': '1',
+            'description': f'Average number per year of {spell}, counted in the year they end',
+            **common},
+        'length': {
+            'long_name': f'Mean length of {spell}',
+            'units': 'days',
+            'description': (f'Mean length of {spell} within each year, averaged across years '
+                            'with at least one spell'),
+            **common},
+    }
+
+
+# =============================================================================
+# Registered metrics
+# =============================================================================
+
+def _year_mean(state):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(state['count'] > 0, state['sum'] / state['count'], np.nan)
+
+
+register(Metric('wbgtmax_annual_mean', ANNUAL_MEAN_ATTRS, [SumCount()], _year_mean))
+register(Metric('wbgtmax_p95', P95_ATTRS, quantile=0.95))
+register(Metric('days_above_p95', DAYS_ABOVE_P95_ATTRS, [Exceedance(quantile=0.95)],
+                lambda state: state['exceed_q0.95'], year_dtype='uint16'))
+
+
+def threshold_metric(threshold, risk_level):
+    """Register (or return) the ``days_above_<threshold>C`` metric."""
+    name = f'days_above_{threshold}C'
+    acc = Exceedance(threshold)
+    return register(Metric(name, threshold_attrs(threshold, risk_level), [acc],
+                           lambda state, key=acc.key: state[key], year_dtype='uint16'))
+
+
+def spell_metrics(threshold, risk_level, min_days=3):
+    """Register (or return) the heat-spell metrics above ``threshold``.
+
+    ``longest_spell_<thr>C``, ``spells_<thr>C`` and ``mean_spell_length_<thr>C``
+    share one run accumulator.
+    """
+    acc = Spells(threshold, min_days)
+    attrs = spell_attrs(threshold, risk_level, acc.min_days)
+    key = acc.key
+
+    def mean_length(state):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(state[f'{key}_spells'] > 0,
+                            state[f'{key}_spell_days'] / state[f'{key}_spells'], np.nan)
+
+    return [
+        register(Metric(f'longest_spell_{threshold}C', attrs['longest'], [acc],
+                        lambda state: state[f'{key}_longest'], year_dtype='uint16')),
+        register(Metric(f'spells_{threshold}C', attrs['count'], [acc],
+                        lambda state: state[f'{key}_spells'], year_dtype='uint16')),
+        register(Metric(f'mean_spell_length_{threshold}C', attrs['length'], [acc], mean_length)),
+    ]
+
+
+for _thr, _risk in RISK_THRESHOLDS.items():
+    threshold_metric(_thr, _risk)
+    spell_metrics(_thr, _risk)
+
+
+def annual_metrics(thresholds=RISK_THRESHOLDS, spell_min_days=None):
+    """The registered metrics ``compute_annual_metrics`` evaluates."""
+    names = ['wbgtmax_annual_mean', 'wbgtmax_p95', 'days_above_p95']
+    names += [threshold_metric(thr, risk).name for thr, risk in thresholds.items()]
+    if spell_min_days is not None:
+        names += [m.name for thr, risk in thresholds.items()
+                  for m in spell_metrics(thr, risk, spell_min_days)]
+    return get_metrics(names)
+
+
+def compute_annual_metrics(da, thresholds=RISK_THRESHOLDS, quantile_method='exact',
+                           memory_budget=DEFAULT_MEMORY_BUDGET, cache=None, sources=None,
+                           spell_min_days=None, keep_years=False, windows=None,
+                           window_dim='season', backend=None, **sketch_kwargs):
+    """Compute the annual WBGT metrics of ``da`` in two reads of the data.
+
+    The first pass updates the annual mean, every fixed threshold count and
+    a p95 sketch from the same blocks. The second pass resolves p95 and the
+    days above it; see ``metric_registry.compute_metrics``.
+
+    Parameters
+    ----------
+    da : xr.DataArray
+        Daily maximum WBGT with dims ``(time, latitude, longitude)``.
+    thresholds : dict
+        Fixed thresholds in degC mapped to their risk level.
+    quantile_method : {'exact', 'histogram', 'tdigest'}
+        p95 estimator, see ``streaming_quantiles``.
+    memory_budget : int
+        Peak bytes for accumulator state plus one loaded time block.
+    cache : YearCache, optional
+        Store of per-year partial aggregates.
+    sources : dict, optional
+        Year -> source fingerprint (see ``source_fingerprints``); part of each
+        cache key so re-processed input files invalidate their years.
+    spell_min_days : int, optional
+        Also compute the heat-spell metrics of every threshold, with spells
+        of at least this many days. They are fed on the first pass.
+    keep_years : bool
+        Also return the per-year cube of every metric but p95 (uint16 for
+        day counts, float32 otherwise).
+    windows : dict, optional
+        Calendar windows (e.g. ``SEASONS``, ``MONTHS``); every metric but
+        p95 and days above p95 is also returned per window as
+        ``<name>_by_<window_dim>``, from the same pass.
+    window_dim : str
+        Name of the window dimension.
+    backend : ExecutionBackend, optional
+        Where the tiles run (default: one after the other, in-process).
+    **sketch_kwargs
+        Passed to the quantile sketch (``bin_width``, ``compression``, ...).
+
+    Returns
+    -------
+    fields : dict of str -> xr.DataArray
+        ``wbgtmax_annual_mean``, ``wbgtmax_p95``, ``days_above_p95`` and
+        ``days_above_<thr>C`` (then ``longest_spell_<thr>C``,
+        ``spells_<thr>C`` and ``mean_spell_length_<thr>C`` if requested),
+        each with its CF attributes.
+    yearly : dict of str -> xr.DataArray or None
+        With ``keep_years``, the ``(year, ...)`` cubes; None otherwise.
+    """
+    return compute_metrics(da, annual_metrics(thresholds, spell_min_days),
+                           quantile_method=quantile_method, memory_budget=memory_budget,
+                           cache=cache, sources=sources, keep_years=keep_years, windows=windows,
+                           window_dim=window_dim, backend=backend, **sketch_kwargs)
@@ -0,0 +1,99 @@
+"""Content-keyed on-disk cache of per-year reduced state.
+
+Each entry holds the small per-year aggregates of one streaming pass (sums,
+counts, exceedance counts, quantile sketch state) for one spatial tile. The
+key hashes everything the state depends on, so appending a year or changing
+the analysis window only computes the missing entries, and a run killed
+part-way resumes from the last completed year.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+
+def source_fingerprints(paths, pattern=r'_(\d{4})_'):
+    """Map each year to a fingerprint of the source files that hold it.
+
+    The year is parsed from each file name with ``pattern`` (ERA5 files are
+    named ``wbgtmax_<year>_daily_ERA5.nc``); the fingerprint is the file name,
+    size and modification time, so a re-processed file invalidates its year.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    fingerprints = {}
+    for path in paths:
+        match = re.search(pattern, os.path.basename(path))
+        if match is None:
+            continue
+        st = os.stat(path)
+        fingerprints.setdefault(int(match.group(1)), []).append(
+            f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}')
+    return {year: '|'.join(sorted(fps)) for year, fps in fingerprints.items()}
+
+
+def array_digest(*arrays):
+    """Short hash of array contents, for keys that depend on computed fields."""
+    h = hashlib.sha256()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype, arr.shape)).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()[:16]
+
+
+class YearCache:
+    """Directory of ``.npz`` entries keyed by a hash of their inputs.
+
+    Parameters
+    ----------
+    directory : str
+        Cache location; created if missing.
+    config : dict
+        JSON-serialisable settings shared by every entry (variable, grid,
+        thresholds, sketch parameters). Changing any of them changes every key.
+    """
+
+    def __init__(self, directory, config=None):
+        self.directory = directory
+        self.config = dict(config or {})
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, **parts):
+        payload = json.dumps({**self.config, **parts}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def load(self, key):
+        """Arrays stored under ``key``, or None if absent or unreadable."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as npz:
+                return {name: npz[name] for name in npz.files}
+        except (OSError, ValueError):
+            # Truncated by a crash mid-write on a filesystem without atomic rename
+            return None
+
+    def save(self, key, arrays):
+        """Store ``arrays`` under ``key``; the rename makes the write atomic."""
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+
+    def load_or_compute(self, key, compute):
+        """Return the cached arrays for ``key``, computing and storing them if missing."""
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = compute()
+            self.save(key, arrays)
+        return arrays
@@ -0,0 +1,140 @@
+"""Per-zone summary table of every metric variable.
+
+Zones are the ``BIOME_ID`` raster (``biomes.analog.gridded.nc``) and,
+optionally, an ecoregion raster made by the same rasterizer with
+``eco_field="ECO_NAME"`` (it also stores its labels as ``BIOME_ID``). Each
+zone layer is indexed once with ``BiomeIndex``; every variable then costs
+one gather, a few segment reductions and one sort, so the full table takes
+seconds instead of a masked pass over the grid per zone.
+
+Statistics can be weighted by cos(latitude) so that means, spreads and
+percentiles reflect area rather than cell count:
+
+    python zonal_stats.py --metrics wbgt_annual_metrics.nc --area-weighted \\
+        --ecoregions ../biomes/ecoregions.analog.gridded.nc --output wbgt_zonal_stats.parquet
+"""
+
+import argparse
+import ast
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from analog_index import feature_fields
+from biome_index import BiomeIndex
+from land_vector import align_biomes
+from metric_store import open_metrics
+
+DEFAULT_PERCENTILES = (5, 15, 50, 85, 95)
+
+
+def _grid_names(ds):
+    lat = 'latitude' if 'latitude' in ds.dims else 'lat'
+    lon = 'longitude' if 'longitude' in ds.dims else 'lon'
+    return lat, lon
+
+
+def zone_names(zone_ds):
+    """``{id: name}`` from the rasterizer's ``eco_name_mapping`` attribute."""
+    mapping = zone_ds.attrs.get('eco_name_mapping')
+    if not mapping:
+        return {}
+    # numpy >= 2 writes integer keys as e.g. np.int32(3)
+    mapping = re.sub(r'np\.\w+\((-?\d+)\)', r'\1', mapping)
+    return {int(k): str(v) for k, v in ast.literal_eval(mapping).items()}
+
+
+def zonal_statistics(metrics_ds, zones, percentiles=DEFAULT_PERCENTILES, area_weighted=False,
+                     variables=None):
+    """Count, mean, std, min, max and percentiles of each variable per zone.
+
+    Parameters
+    ----------
+    metrics_ds : xr.Dataset
+        Metric fields on a ``(lat, lon)`` grid (``latitude``/``longitude``
+        also accepted). A variable with other dimensions, e.g.
+        ``days_above_29C_by_season``, is summarized per label, as
+        ``days_above_29C_by_season[JJA]``.
+    zones : dict
+        ``{layer_name: zone_ds}``; each dataset holds ``BIOME_ID`` labels.
+    percentiles : sequence of float
+        Percentiles in [0, 100].
+    area_weighted : bool
+        Weight cells by cos(latitude).
+    variables : list of str, optional
+        Subset of ``metrics_ds`` to summarize (default: every gridded variable).
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per (layer, zone, variable or variable label).
+    """
+    lat_name, lon_name = _grid_names(metrics_ds)
+    lat, lon = metrics_ds[lat_name], metrics_ds[lon_name]
+    variables = list(variables or [v for v, da in metrics_ds.data_vars.items()
+                                   if {lat_name, lon_name} <= set(da.dims)])
+    weights = None
+    if area_weighted:
+        weights = np.broadcast_to(np.cos(np.deg2rad(lat.values))[:, None], (len(lat), len(lon)))
+
+    labels, _, values = feature_fields(metrics_ds, variables)
+    fields = dict(zip(labels, values))
+
+    tables = []
+    for layer, zone_ds in zones.items():
+        index = BiomeIndex(align_biomes(zone_ds, lat.values, lon.values).values)
+        names = zone_names(zone_ds)
+        for v, values in fields.items():
+            stats = index.statistics(values, weights)
+            table = pd.DataFrame({
+                'layer': layer,
+                'zone_id': index.ids,
+                'zone_name': [names.get(int(b), '') for b in index.ids],
+                'variable': v,
+                'cells': index.counts,
+                **stats,
+            })
+            if len(percentiles):
+                pct = index.percentiles(values, percentiles, weights=weights)
+                for j, q in enumerate(percentiles):
+                    table[f'p{q:g}'] = pct[:, j]
+            tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def write_table(table, path):
+    """Parquet for ``.parquet`` paths (needs pyarrow or fastparquet), CSV otherwise."""
+    if str(path).endswith('.parquet'):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--metrics', default='wbgt_annual_metrics.nc',
+                        help='metrics NetCDF file or metric store directory')
+    parser.add_argument('--biomes', default='/glade/u/home/jsallen/projects/tnc_2025/analogs/'
+                                            'biomes/biomes.analog.gridded.nc')
+    parser.add_argument('--ecoregions', default=None,
+                        help='Ecoregion raster from the biome rasterizer (optional)')
+    parser.add_argument('--variables', nargs='*', default=None)
+    parser.add_argument('--percentiles', type=float, nargs='*', default=list(DEFAULT_PERCENTILES))
+    parser.add_argument('--area-weighted', action='store_true',
+                        help='Weight cells by cos(latitude)')
+    parser.add_argument('--output', default='wbgt_zonal_stats.csv')
+    args = parser.parse_args(argv)
+
+    zones = {'biome': xr.open_dataset(args.biomes)}
+    if args.ecoregions:
+        zones['ecoregion'] = xr.open_dataset(args.ecoregions)
+    table = zonal_statistics(open_metrics(args.metrics, decode_timedelta=False), zones,
+                             args.percentiles, args.area_weighted, args.variables)
+    write_table(table, args.output)
+    print(f"{len(table)} rows ({table['zone_id'].nunique()} zones) -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()